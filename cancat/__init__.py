@@ -2,12 +2,29 @@ import os
 import sys
 import cmd
 import time
+import errno
+import re
 import serial
 import struct
 import threading
+import subprocess
+import collections
 import cPickle as pickle
 
 from cancat import iso_tp
+from cancat.capture import CanCapture, INDEX_SCAN_RATIO
+from cancat.baseline import Baseline, reprNovelty
+from cancat.journal import CanJournal, isJournal, loadJournal, REC_FRAME, REC_BOOKMARK, REC_COMMENT
+from cancat.session import isSession, loadSession, readSession, saveSession
+from cancat.logformats import detectFormat, loadLog, exportLog, CAN_EFF_FLAG, CAN_EFF_MASK
+try:
+    from cancat import arrays
+except ImportError:
+    # no numpy: toArrays() isn't available and analysis stays pure Python
+    arrays = None
+from cancat.query import Query, QueryError
+from cancat.search import compilePatterns, genStreamMatches, asciiRegex, genStreamRuns, genIsoTpRuns, ASCII_CLASS
+from cancat.dispatch import Subscription, SUB_QUEUE_LEN, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_DISCONNECT
 
 # defaults for Linux:
 serialdev = '/dev/ttyACM0'  # FIXME:  if Windows:  "COM10" is default
@@ -43,6 +60,31 @@ CMD_CAN_SEND_ISOTP          = 0x46
 CMD_CAN_RECV_ISOTP          = 0x47
 CMD_CAN_SENDRECV_ISOTP      = 0x48
 
+# commands the writer thread sends ahead of anything else queued.  only
+# ones whose order against the rest doesn't matter: a CMD_CAN_BAUD or 
+# CMD_CAN_MODE jumping ahead of queued CMD_CAN_SENDs would change what
+# bus (and speed) they go out on
+PRIORITY_CMDS = (CMD_PING,)
+
+# getBitHeatmap(): never flipped, then flipped in up to 1/8, 2/8 ... all messages
+HEATMAP_CHARS = '.:-=+*#%@'
+
+# messages genReprCanMsgs() pulls from the capture at a time
+REPR_CHUNK = 65536
+# lines writeLines() gathers up per write
+WRITE_BATCH = 256
+
+# sliding windows (in seconds) getRxStats() reports frames per second over
+RX_FPS_WINDOWS = (1, 10, 60)
+
+# longest a mailbox waiter sleeps between wakeups from the reaper thread,
+# so Ctrl-C gets through (see _waitForMailbox())
+WAIT_SLICE = .1
+
+# mailboxes holding received CAN messages are kept in columnar CanCapture
+# stores instead of lists (see cancat/capture.py)
+CAPTURE_CMDS = (CMD_CAN_RECV, CMD_ISO_RECV)
+
 
 CAN_RESP_OK                 = (0)
 CAN_RESP_FAILINIT           = (1)
@@ -87,6 +129,9 @@ TIMING_FAST         = 0
 TIMING_REAL         = 1
 TIMING_INTERACTIVE  = 2
 
+# default number of CMD_CAN_SEND requests CANxmitMulti() keeps in flight
+XMIT_WINDOW         = 8
+
 # message id's and metadata (soon to be moved into modules)
 GM_messages = {
         }
@@ -132,6 +177,9 @@ def handleLogHexToScreen(message, canbuf):
     num = struct.unpack("<L", message)
     print('LOG: %x' % num)
 
+def printCanMsgDuringSniff(idx, ts, arbid, data):
+    print reprCanMsg(idx, ts, arbid, data)
+
 def handleCanMsgsDuringSniff(message, canbuf, arbids=None):
     idx, ts = canbuf._submitMessage(CMD_CAN_RECV, message)
     ts = time.time()
@@ -150,24 +198,100 @@ default_cmdhandlers = {
 
 
 def loadCanBuffer(filename):
-    return pickle.load(file(filename))
+    if isJournal(filename):
+        return loadJournal(filename)
+    if isSession(filename):
+        return loadSession(filename)
+    if detectFormat(filename) != None:
+        return loadCanLog(filename)
+    return pickle.load(file(filename, 'rb'))
+
+def loadCanLog(filename, newMailbox=None, fmt=None):
+    '''
+    returns a session dictionary (like CanInterface.saveSession() returns)
+    holding the frames of a candump, Vector ASC or CSV log file (see 
+    cancat/logformats.py), read straight into a CanCapture.  newMailbox(cmd)
+    creates the capture.
+    '''
+    if newMailbox == None:
+        capture = CanCapture()
+    else:
+        capture = newMailbox(CMD_CAN_RECV)
+
+    if fmt == None:
+        fmt = detectFormat(filename)
+    loadLog(filename, capture, fmt)
+    return { 'messages' : { CMD_CAN_RECV : capture },
+            'bookmarks' : [],
+            'bookmark_info' : {},
+            'comments' : ['imported from %s log %s' % (fmt, filename)],
+            }
 
 class CanInterface:
-    def __init__(self, port=serialdev, baud=baud, verbose=False, cmdhandlers=None, comment='', load_filename=None, orig_iface=None):
+    def __init__(self, port=serialdev, baud=baud, verbose=False, cmdhandlers=None, comment='', load_filename=None, orig_iface=None, coalesce_writes=False, max_capture_memory=None, spill_dir=None):
         '''
         CAN Analysis Workspace
         This can be subclassed by vendor to allow more vendor-specific code 
         based on the way each vendor uses the varios Buses
+
+        coalesce_writes=True hands everything sent to the CanCat transceiver
+        to a dedicated writer thread, which batches whatever has queued up
+        into a single serial write (see _txthread()).  If a write fails, the
+        next call that sends something raises the error
+
+        max_capture_memory (bytes) caps how much memory received CAN messages
+        may use.  Older messages spill to a temporary file (in spill_dir)
+        and are read back on demand (see cancat/capture.py)
         '''
         if orig_iface != None:
             self._consumeInterface(orig_iface)
             return
 
         self._go = False
-        self._inbuf = ''
+        self._inbuf = bytearray()
         self._trash = []
         self._messages = {}
         self._queuelock = threading.Lock()
+        self._mbox_conds = {}
+        # [deadline, cond] for each thread blocked in _waitForMailbox()
+        self._mbox_waiters = []
+        self._reaper_cond = threading.Condition(self._queuelock)
+        self._reaper_obj = None
+        self._xmit_lock = threading.RLock()
+        self._rx_stats = { 'bytes_read' : 0,
+                'reads' : 0,
+                'resyncs' : 0,
+                'trash_bytes' : 0,
+                }
+        self._rx_pkt_counts = [0] * 256
+        self._rx_handler_times = {}
+        # per-second CAN frame counts, indexed by (second % len)
+        self._rx_fps_secs = [0] * (max(RX_FPS_WINDOWS) + 1)
+        self._rx_fps_counts = [0] * (max(RX_FPS_WINDOWS) + 1)
+        self._coalesce_writes = coalesce_writes
+        self._max_capture_memory = max_capture_memory
+        self._spill_dir = spill_dir
+        self._journal = None
+        self._filename = None
+        # what's in self._filename, for appending only what's new to it
+        self._saved = None
+        # cmd -> tuple of Subscriptions (replaced, never modified, on change)
+        self._subscriptions = {}
+        self._sub_lock = threading.Lock()
+        self._outq = collections.deque()
+        self._outq_priority = collections.deque()
+        self._outq_cond = threading.Condition(threading.Lock())
+        self._txthread_obj = None
+        # sys.exc_info() of a failed write, for the next _send() to raise
+        self._tx_error = None
+        self._tx_stats = { 'packets' : 0,
+                'writes' : 0,
+                'bytes' : 0,
+                'queue_depth_max' : 0,
+                'flush_packets_max' : 0,
+                'write_errors' : 0,
+                'packets_lost' : 0,
+                }
         self._shutdown = False
         self.verbose = verbose
         self.port = port
@@ -200,6 +324,13 @@ class CanInterface:
 
         self._reconnect()
         self._startRxThread()
+        if coalesce_writes:
+            self._startTxThread()
+
+    def _startTxThread(self):
+        self._txthread_obj = threading.Thread(target=self._txthread)
+        self._txthread_obj.setDaemon(True)
+        self._txthread_obj.start()
 
     def _startRxThread(self):
         self._go = True
@@ -208,11 +339,58 @@ class CanInterface:
         self._commsthread.start()
 
     def register_handler(self, cmd, handler):
+        '''
+        Replace the handling of cmd messages with handler(message, self), 
+        called inline on the receiver thread (so keep it quick!).  To watch 
+        messages without taking over storage, see subscribe()
+        '''
         self._cmdhandlers[cmd] = handler
 
     def remove_handler(self, cmd):
         self._cmdhandlers[cmd] = None
 
+    def subscribe(self, cmd=CMD_CAN_RECV, arbids=None, maxlen=SUB_QUEUE_LEN, overflow=OVERFLOW_DROP_OLDEST, callback=None):
+        '''
+        Subscribe to messages as they are filed into the cmd mailbox.  Any
+        number of subscribers can watch the same mailbox, each with its own
+        bounded queue (maxlen messages) and overflow policy, so a slow
+        consumer never holds up the receiver thread or storage.
+        see cancat/dispatch.py
+
+        returns a Subscription: iterate it or call get(), or pass a callback
+        to have each message handed to callback(msg) on its own thread.
+        '''
+        sub = Subscription(cmd, arbids=arbids, maxlen=maxlen, overflow=overflow, callback=callback)
+
+        self._sub_lock.acquire()
+        try:
+            self._subscriptions[cmd] = self._subscriptions.get(cmd, ()) + (sub,)
+        finally:
+            self._sub_lock.release()
+
+        return sub
+
+    def unsubscribe(self, sub):
+        '''
+        Stop delivering messages to a Subscription and close it
+        '''
+        self._sub_lock.acquire()
+        try:
+            subs = self._subscriptions.get(sub.cmd, ())
+            self._subscriptions[sub.cmd] = tuple([x for x in subs if x is not sub])
+        finally:
+            self._sub_lock.release()
+
+        # the receiver thread may be the one giving up on this subscriber
+        # (OVERFLOW_DISCONNECT), and it must not wait on a callback thread
+        if threading.currentThread() != self._commsthread:
+            sub.close()
+        else:
+            sub.active = False
+
+    def getSubscriptions(self, cmd=CMD_CAN_RECV):
+        return list(self._subscriptions.get(cmd, ()))
+
     def _consumeInterface(self, other):
         other._go = False
 
@@ -233,7 +411,11 @@ class CanInterface:
             self._io.close()
 
         self._io = serial.Serial(port=self.port, baudrate=self._baud, dsrdtr=True)
-        self._io.setDTR(True)
+        try:
+            self._io.setDTR(True)
+        except IOError:
+            # pseudo-terminals (eg. cancat.emulator) have no modem control lines
+            pass
 
         # clear all locks and free anything waiting for them
         if self._in_lock != None:
@@ -260,6 +442,20 @@ class CanInterface:
         if isinstance(self._io, serial.Serial):
             self._io.close()
         self._shutdown = True
+
+        if self._journal != None:
+            self.stopJournal()
+
+        for subs in self._subscriptions.values():
+            for sub in subs:
+                self.unsubscribe(sub)
+
+        # wake up the writer thread so it notices
+        self._outq_cond.acquire()
+        try:
+            self._outq_cond.notifyAll()
+        finally:
+            self._outq_cond.release()
         if self._commsthread != None:
             self._commsthread.wait()
 
@@ -277,6 +473,10 @@ class CanInterface:
         Receiver thread runner.  Internal use only.
         Processes data from the CanCat transceiver, parses and places messages
         into correct mailboxes and/or hands off to pre-configured handlers.
+
+        Everything waiting on the serial port is read in one call and 
+        appended to the self._inbuf bytearray, then as many complete 
+        packets as possible are parsed out of it (see _parseInbuf())
         '''
         self._rxtx_state = RXTX_SYNC
 
@@ -300,10 +500,10 @@ class CanInterface:
                     self._rxtx_state = RXTX_SYNC
                     continue
 
-                # fill the queue
+                # fill the queue: grab everything available, or block for one byte
                 self._in_lock.acquire()
                 try:
-                    char = self._io.read()
+                    data = self._io.read(self._io.inWaiting() or 1)
 
                 except serial.serialutil.SerialException, e:
                     self.errorcode = e
@@ -317,78 +517,213 @@ class CanInterface:
                     if self._in_lock.locked_lock():
                         self._in_lock.release()
 
-                self._inbuf += char
-                self.log("RECV: %s" % repr(self._inbuf))
+                if not data:
+                    continue
+
+                self._inbuf.extend(data)
+                self._rx_stats['bytes_read'] += len(data)
+                self._rx_stats['reads'] += 1
+                if self.verbose:
+                    self.log("RECV: %s" % repr(data))
 
-                # make sure we're synced
-                if self._rxtx_state == RXTX_SYNC:
-                    if self._inbuf[0] != "@":
-                        self._queuelock.acquire()
-                        try:
-                            idx = self._inbuf.find('@')
-                            if idx == -1:
-                                self.log("sitting on garbage...", 3)
-                                continue
+                self._parseInbuf()
 
-                            trash = self._inbuf[:idx]
-                            self._trash.append(trash)
+            except:
+                if self.verbose:
+                    sys.excepthook(*sys.exc_info())
 
-                            self._inbuf = self._inbuf[idx:]
-                        finally:
-                            self._queuelock.release()
+    def _parseInbuf(self):
+        '''
+        Parse every complete "@<len><cmd><data>" packet out of self._inbuf, 
+        walking it with an offset cursor and only compacting the buffer once
+        at the end.  Internal use only (called from the receiver thread).
 
-                    self._rxtx_state = RXTX_GO
+        Anything between packets that isn't a '@' is moved to self._trash
+        '''
+        inbuf = self._inbuf
+        buflen = len(inbuf)
+        view = memoryview(inbuf)
+        offset = 0
+        pkt_counts = self._rx_pkt_counts
 
-                # handle buffer if we have anything in it
-                if self._rxtx_state == RXTX_GO:
-                    if len(self._inbuf) < 3: continue
-                    if self._inbuf[0] != '@': 
+        try:
+            while offset < buflen:
+                # make sure we're synced
+                if inbuf[offset] != 0x40:       # '@'
+                    idx = inbuf.find('@', offset)
+                    if idx == -1:
+                        self.log("sitting on garbage...", 3)
+                        self._discard(view[offset:].tobytes())
                         self._rxtx_state = RXTX_SYNC
-                        continue
+                        offset = buflen
+                        break
 
-                    pktlen = ord(self._inbuf[1]) + 2        # <size>, doesn't include "@"
+                    self._discard(view[offset:idx].tobytes())
+                    offset = idx
+                    self._rxtx_state = RXTX_SYNC
 
-                    if len(self._inbuf) >= pktlen:
-                        self._queuelock.acquire()
-                        try:
-                            cmd = ord(self._inbuf[2])                # first bytes are @<size>
-                            message = self._inbuf[3:pktlen]  
-                            self._inbuf = self._inbuf[pktlen:]
-                        finally:
-                            self._queuelock.release()
-
-                        #if we have a handler, use it
-                        cmdhandler = self._cmdhandlers.get(cmd)
-                        if cmdhandler != None:
-                            cmdhandler(message, self)
-
-                        # otherwise, file it
-                        else:
-                            self._submitMessage(cmd, message)
-                        self._rxtx_state = RXTX_SYNC
+                self._rxtx_state = RXTX_GO
 
-                
-            except:
-                if self.verbose:
-                    sys.excepthook(*sys.exc_info())
+                if buflen - offset < 3: 
+                    break
+
+                pktlen = inbuf[offset+1] + 2        # <size>, doesn't include "@"
+                if pktlen < 3:
+                    # bogus size byte, can't be a real packet.  resync past the '@'
+                    self._discard(view[offset:offset+1].tobytes())
+                    offset += 1
+                    continue
+
+                if buflen - offset < pktlen:
+                    break
+
+                cmd = inbuf[offset+2]                # first bytes are @<size>
+                message = view[offset+3:offset+pktlen].tobytes()
+                offset += pktlen
+                pkt_counts[cmd] += 1
+
+                #if we have a handler, use it
+                cmdhandler = self._cmdhandlers.get(cmd)
+                if cmdhandler != None:
+                    start = time.time()
+                    try:
+                        cmdhandler(message, self)
+                    finally:
+                        self._timeHandler(cmd, time.time() - start)
+
+                # otherwise, file it
+                else:
+                    self._submitMessage(cmd, message)
+
+        finally:
+            # the memoryview has to go away before the bytearray can be resized
+            del view
+            del inbuf[:offset]
+
+    def _discard(self, trash):
+        '''
+        drop bytes that aren't part of a packet into self._trash
+        '''
+        self._trash.append(trash)
+        self._rx_stats['trash_bytes'] += len(trash)
+        if self._rxtx_state == RXTX_GO:
+            self._rx_stats['resyncs'] += 1
+
+    def _timeHandler(self, cmd, elapsed):
+        '''
+        account for time spent in a cmdhandler: [calls, total, max]
+        '''
+        times = self._rx_handler_times.get(cmd)
+        if times == None:
+            times = [0, 0.0, 0.0]
+            self._rx_handler_times[cmd] = times
+
+        times[0] += 1
+        times[1] += elapsed
+        if elapsed > times[2]:
+            times[2] = elapsed
+
+    def getRxStats(self):
+        '''
+        returns a snapshot of the receive path counters:
+            bytes_read, reads       - from the serial port
+            packets                 - {cmd: packets parsed}
+            resyncs, trash_bytes    - times we lost sync, and the bytes 
+                                      discarded into self._trash
+            handlers                - {cmd: (calls, total_secs, max_secs)}
+            mailboxes               - {cmd: messages waiting / stored}
+            fps                     - {window_secs: CAN frames per second}
+                                      over the last complete seconds
+            inbuf                   - bytes waiting for the rest of a packet
+        '''
+        stats = dict(self._rx_stats)
+        stats['packets'] = dict([(cmd, count) for cmd, count in enumerate(self._rx_pkt_counts) if count])
+        stats['handlers'] = dict([(cmd, tuple(times)) for cmd, times in self._rx_handler_times.items()])
+        stats['mailboxes'] = dict([(cmd, len(mbox)) for cmd, mbox in self._messages.items()])
+        stats['inbuf'] = len(self._inbuf)
+
+        now = int(time.time())
+        fps = {}
+        for window in RX_FPS_WINDOWS:
+            count = 0
+            for sec, secount in zip(self._rx_fps_secs, self._rx_fps_counts):
+                if 0 < now - sec <= window:
+                    count += secount
+            fps[window] = float(count) / window
+        stats['fps'] = fps
+
+        return stats
 
     def _submitMessage(self, cmd, message):
         '''
         submits a message to the cmd mailbox.  creates mbox if doesn't exist.
+        wakes up anyone waiting on that mailbox.
         *threadsafe*
         '''
         timestamp = time.time()
 
-        self._queuelock.acquire()
+        cond = self._getMailboxCond(cmd)
+        cond.acquire()
         try:
             mbox = self._messages.get(cmd)
-            if mbox == None:
-                mbox = []
+            # "is": comparing a CanCapture to None with "==" is slow
+            if mbox is None:
+                mbox = self._newMailbox(cmd)
                 self._messages[cmd] = mbox
             mbox.append((timestamp, message))
+            cond.notifyAll()
+
+            journal = self._journal
+            if journal is not None and cmd in CAPTURE_CMDS:
+                journal.logFrame(cmd, timestamp, message)
+            idx = len(mbox) - 1
         finally:
-            self._queuelock.release()
-        return len(mbox)-1, timestamp
+            cond.release()
+
+        subs = self._subscriptions.get(cmd)
+        if subs:
+            if cmd in CAPTURE_CMDS:
+                arbid, data = self._splitCanMsg(message)
+                msg = (idx, timestamp, arbid, data)
+            else:
+                arbid = None
+                msg = (idx, timestamp, message)
+
+            for sub in subs:
+                if not sub.publish(msg, arbid):
+                    self.unsubscribe(sub)
+
+        if cmd == CMD_CAN_RECV:
+            # frames/sec buckets for getRxStats().  not CMD_ISO_RECV: in CITM
+            # mode those are copies of frames already counted
+            sec = int(timestamp)
+            bucket = sec % len(self._rx_fps_secs)
+            if self._rx_fps_secs[bucket] != sec:
+                self._rx_fps_secs[bucket] = sec
+                self._rx_fps_counts[bucket] = 0
+            self._rx_fps_counts[bucket] += 1
+
+        return idx, timestamp
+
+    def _newMailbox(self, cmd):
+        '''
+        returns an empty mailbox for the given cmd.  Received CAN messages
+        get a columnar CanCapture, everything else gets a deque.
+        '''
+        if cmd in CAPTURE_CMDS:
+            return CanCapture(max_memory=self._max_capture_memory, spill_dir=self._spill_dir)
+        return collections.deque()
+
+    def _getMailboxCond(self, cmd):
+        '''
+        returns the condition variable used to wait on the cmd mailbox.
+        all of them share self._queuelock, but each cmd has its own so
+        _submitMessage() only wakes threads waiting on that mailbox.
+        '''
+        cond = self._mbox_conds.get(cmd)
+        if cond == None:
+            cond = self._mbox_conds.setdefault(cmd, threading.Condition(self._queuelock))
+        return cond
 
     def log(self, message, verbose=1):
         '''
@@ -397,24 +732,103 @@ class CanInterface:
         if self.verbose >= verbose:
             print "%.2f %s: %s" % (time.time(), self.name, message)
 
+    def _waitForMailbox(self, cmd, count, wait):
+        '''
+        block until the cmd mailbox holds at least count messages, or wait 
+        seconds have passed (wait=None doesn't block at all).
+        MUST be called with the mailbox condition acquired.  
+        returns the mailbox (or None if it doesn't exist yet)
+        '''
+        cond = self._getMailboxCond(cmd)
+        mbox = self._messages.get(cmd)
+        if wait == None:
+            return mbox
+
+        if (mbox != None and len(mbox) >= count) or wait <= 0:
+            return mbox
+
+        # Python 2's timed Condition.wait() sleep-polls (backing off to 50ms
+        # between looks), so wait untimed, which wakes the moment
+        # _submitMessage() notifies, and let the reaper thread wake us each
+        # WAIT_SLICE to check the deadline (and let KeyboardInterrupt in)
+        deadline = time.time() + wait
+        waiter = [deadline, cond]
+        self._mbox_waiters.append(waiter)
+        self._startReaper()
+        try:
+            while mbox == None or len(mbox) < count:
+                if time.time() >= deadline:
+                    break
+                cond.wait()
+                mbox = self._messages.get(cmd)
+        finally:
+            self._mbox_waiters.remove(waiter)
+
+        return mbox
+
+    def _startReaper(self):
+        '''
+        start the reaper thread if it isn't running, and poke it about a new 
+        waiter.  MUST be called with self._queuelock held.
+        '''
+        if self._reaper_obj == None:
+            self._reaper_obj = threading.Thread(target=self._reaper)
+            self._reaper_obj.setDaemon(True)
+            self._reaper_obj.start()
+        self._reaper_cond.notify()
+
+    def _reaper(self):
+        '''
+        Reaper thread runner.  Internal use only.
+        Sleeps (untimed) while nobody is in _waitForMailbox(), otherwise 
+        wakes every waiter at least every WAIT_SLICE seconds, and at the 
+        earliest deadline, so they can give up on time.
+        '''
+        try:
+            self._queuelock.acquire()
+            try:
+                while not self._shutdown:
+                    if not self._mbox_waiters:
+                        self._reaper_cond.wait()
+                        continue
+
+                    nap = min([deadline for deadline, cond in self._mbox_waiters]) - time.time()
+                    nap = max(min(nap, WAIT_SLICE), .001)
+
+                    self._queuelock.release()
+                    try:
+                        time.sleep(nap)
+                    finally:
+                        self._queuelock.acquire()
+
+                    for deadline, cond in self._mbox_waiters:
+                        cond.notifyAll()
+            finally:
+                self._queuelock.release()
+        except:
+            # a nap can run past interpreter teardown, which empties module
+            # globals out from under daemon threads.  nobody's waiting by then
+            if sys != None:
+                raise
+
     def recv(self, cmd, wait=None):
         '''
         Warning: Destructive:
             removes a message from a mailbox and returns it.
             For CMD_CAN_RECV mailbox, this will alter analysis results!
+
+        waits up to "wait" seconds for a message to arrive, returning 
+        (None, None) if none did.
         '''
-        start = time.time()
-        while (time.time() - start) < wait:
-            mbox = self._messages.get(cmd)
+        cond = self._getMailboxCond(cmd)
+        cond.acquire()
+        try:
+            mbox = self._waitForMailbox(cmd, 1, wait)
             if mbox != None and len(mbox):
-                self._queuelock.acquire()
-                try:
-                    timestamp, message = mbox.pop(0)
-                finally:
-                    self._queuelock.release()
+                return mbox.popleft()
+        finally:
+            cond.release()
 
-                return timestamp, message
-            time.sleep(.01)
         return None, None
 
     def recvall(self, cmd):
@@ -431,12 +845,48 @@ class CanInterface:
         self._queuelock.acquire()
         try:
             messages = list(mbox)
-            self._messages[cmd] = []
+            self._messages[cmd] = self._newMailbox(cmd)
         finally:
             self._queuelock.release()
 
         return messages
 
+    def peek(self, cmd, idx=0, wait=None):
+        '''
+        Non-destructive:
+            returns the (timestamp, message) at index "idx" of a mailbox
+            without removing it, waiting up to "wait" seconds for it to
+            arrive.  returns (None, None) if it isn't there.
+        '''
+        cond = self._getMailboxCond(cmd)
+        cond.acquire()
+        try:
+            mbox = self._waitForMailbox(cmd, idx+1, wait)
+            if mbox != None and -len(mbox) <= idx < len(mbox):
+                return mbox[idx]
+        finally:
+            cond.release()
+
+        return None, None
+
+    def waitForCount(self, cmd, count, wait=None):
+        '''
+        Non-destructive:
+            wait up to "wait" seconds for a mailbox to hold at least "count"
+            messages (eg. for CMD_CAN_RECV, wait until message index 
+            count-1 has been received).
+            returns the number of messages in the mailbox.
+        '''
+        cond = self._getMailboxCond(cmd)
+        cond.acquire()
+        try:
+            mbox = self._waitForMailbox(cmd, count, wait)
+            if mbox == None:
+                return 0
+            return len(mbox)
+        finally:
+            cond.release()
+
     def _inWaiting(self, cmd):
         '''
         Does the given cmd mailbox have any messages??
@@ -449,10 +899,37 @@ class CanInterface:
     def _send(self, cmd, message):
         '''
         Send a message to the CanCat transceiver (not the CAN bus)
+
+        with coalesce_writes=True, raises whatever made the writer thread 
+        fail to write earlier packets (those are gone) instead of sending
         '''
         msgchar = struct.pack(">H", len(message) + 3) # 2 byte Big Endian
         msg = msgchar + chr(cmd) + message
-        self.log("XMIT: %s" % repr(msg))
+        if self.verbose:
+            self.log("XMIT: %s" % repr(msg))
+
+        if self._txthread_obj != None:
+            # queue it up for the writer thread
+            self._outq_cond.acquire()
+            try:
+                error = self._tx_error
+                if error != None:
+                    self._tx_error = None
+                    raise error[0], error[1], error[2]
+
+                if cmd in PRIORITY_CMDS:
+                    self._outq_priority.append(msg)
+                else:
+                    self._outq.append(msg)
+
+                depth = len(self._outq) + len(self._outq_priority)
+                if depth > self._tx_stats['queue_depth_max']:
+                    self._tx_stats['queue_depth_max'] = depth
+
+                self._outq_cond.notify()
+            finally:
+                self._outq_cond.release()
+            return
 
         self._out_lock.acquire()
         try:
@@ -461,6 +938,79 @@ class CanInterface:
             self._out_lock.release()
         # FIXME: wait for response?
 
+    def _txthread(self):
+        '''
+        Writer thread runner.  Internal use only.
+        Waits for _send() to queue packets, then writes everything pending
+        (priority commands first) to the CanCat transceiver in one call.
+        '''
+        while not self._shutdown:
+            try:
+                self._outq_cond.acquire()
+                try:
+                    while not (self._outq or self._outq_priority or self._shutdown):
+                        self._outq_cond.wait()
+
+                    pkts = list(self._outq_priority)
+                    pkts.extend(self._outq)
+                    self._outq_priority.clear()
+                    self._outq.clear()
+                finally:
+                    self._outq_cond.release()
+
+                if not pkts:
+                    continue
+
+                data = ''.join(pkts)
+                self._out_lock.acquire()
+                try:
+                    self._io.write(data)
+                except:
+                    error = sys.exc_info()
+                else:
+                    error = None
+                finally:
+                    self._out_lock.release()
+
+                stats = self._tx_stats
+                if error != None:
+                    self._outq_cond.acquire()
+                    try:
+                        self._tx_error = error
+                    finally:
+                        self._outq_cond.release()
+                    stats['write_errors'] += 1
+                    stats['packets_lost'] += len(pkts)
+                    continue
+
+                stats['packets'] += len(pkts)
+                stats['writes'] += 1
+                stats['bytes'] += len(data)
+                if len(pkts) > stats['flush_packets_max']:
+                    stats['flush_packets_max'] = len(pkts)
+
+            except:
+                if self.verbose:
+                    sys.excepthook(*sys.exc_info())
+
+    def getTxStats(self):
+        '''
+        returns a snapshot of the writer thread counters (coalesce_writes=True):
+            packets, writes, bytes      - totals written so far
+            packets_per_write           - average flush size
+            flush_packets_max           - largest single flush
+            queue_depth / _max          - packets waiting now / at worst
+            write_errors, packets_lost  - failed writes, and the packets 
+                                          that went with them
+        '''
+        stats = dict(self._tx_stats)
+        stats['queue_depth'] = len(self._outq) + len(self._outq_priority)
+        if stats['writes']:
+            stats['packets_per_write'] = float(stats['packets']) / stats['writes']
+        else:
+            stats['packets_per_write'] = 0.0
+        return stats
+
     def CANrecv(self, count=1):
         '''
         Warning: Destructive:
@@ -473,16 +1023,34 @@ class CanInterface:
         for x in range(count):
             yield self.recv(CMD_CAN_RECV)
 
-    def CANxmit(self, arbid, message, extflag=0, timeout=3, count=1):
+    def CANxmit(self, arbid, message, extflag=0, timeout=3, count=1, window=1):
         '''
         Transmit a CAN message on the attached CAN bus
         Currently returns the *last* result
+
+        an arbid with CAN_EFF_FLAG (from a loaded log) is sent as extended
+
+        window > 1 keeps that many copies in flight at once when count > 1
+        (see CANxmitMulti())
         '''
-        msg = struct.pack('>I', arbid) + chr(extflag) + message
+        if count > 1 and window > 1:
+            results = self.CANxmitMulti([(arbid, message)] * count, extflag, timeout, window)
+            return results[-1]
 
-        for i in range(count):
-            self._send(CMD_CAN_SEND, msg)
-            ts, result = self.recv(CMD_CAN_SEND_RESULT, timeout)
+        msg = self._packCanSend(arbid, message, extflag)
+
+        self._xmit_lock.acquire()
+        try:
+            # results that turned up after an earlier call gave up on them
+            self.recvall(CMD_CAN_SEND_RESULT)
+            for i in range(count):
+                self._send(CMD_CAN_SEND, msg)
+                ts, result = self.recv(CMD_CAN_SEND_RESULT, timeout)
+                if result == None:
+                    # a late answer would be taken for the next one's
+                    break
+        finally:
+            self._xmit_lock.release()
 
         if result == None:
             print "CANxmit:  Return is None!?"
@@ -492,6 +1060,83 @@ class CanInterface:
 
         return resval
 
+    def CANxmitMulti(self, msgs, extflag=0, timeout=3, window=XMIT_WINDOW):
+        '''
+        Transmit a sequence of CAN messages on the attached CAN bus, keeping
+        up to "window" CMD_CAN_SEND requests in flight instead of waiting for 
+        each one's result before sending the next.
+
+        msgs is an iterable of (arbid, data) tuples (arbids with CAN_EFF_FLAG
+        are sent as extended, like CANxmit()).  The transceiver answers
+        in order, so results are matched up to messages by position.  Once a
+        result times out that matching can't be trusted any more, so nothing 
+        else is sent and every message from there on gets None.
+
+        returns a list with one result per message: a CAN_RESP_* value, or 
+        None if the transceiver never answered that one (or it wasn't sent)
+        '''
+        results = []
+        inflight = 0
+        unsent = 0
+        msgs = iter(msgs)
+
+        self._xmit_lock.acquire()
+        try:
+            # results that turned up after an earlier call gave up on them
+            self.recvall(CMD_CAN_SEND_RESULT)
+
+            for arbid, data in msgs:
+                if inflight >= window:
+                    resval = self._recvXmitResult(timeout)
+                    if resval == None:
+                        unsent = 1
+                        break
+                    results.append(resval)
+                    inflight -= 1
+
+                self._send(CMD_CAN_SEND, self._packCanSend(arbid, data, extflag))
+                inflight += 1
+
+            else:
+                while inflight:
+                    resval = self._recvXmitResult(timeout)
+                    if resval == None:
+                        break
+                    results.append(resval)
+                    inflight -= 1
+
+            if inflight:
+                results.extend([None] * (inflight + unsent))
+                results.extend([None for msg in msgs])
+        finally:
+            self._xmit_lock.release()
+
+        for idx, resval in enumerate(results):
+            if resval == None:
+                print "CANxmitMulti: Return for message %d is None!?" % idx
+            elif resval != 0:
+                print "CANxmitMulti() failed for message %d: %s" % (idx, CAN_RESPS.get(resval))
+
+        return results
+
+    def _packCanSend(self, arbid, data, extflag):
+        '''
+        returns the body of a CMD_CAN_SEND
+        '''
+        if arbid & CAN_EFF_FLAG:
+            arbid &= CAN_EFF_MASK
+            extflag = 1
+        return struct.pack('>I', arbid) + chr(extflag) + data
+
+    def _recvXmitResult(self, timeout):
+        '''
+        wait for the next CMD_CAN_SEND_RESULT.  returns its value or None
+        '''
+        ts, result = self.recv(CMD_CAN_SEND_RESULT, timeout)
+        if result == None:
+            return None
+        return ord(result)
+
     def ISOTPxmit(self, tx_arbid, rx_arbid, message, extflag=0, timeout=3, count=1):
         '''
         Transmit an ISOTP can message. tx_arbid is the arbid we're transmitting,
@@ -570,6 +1215,7 @@ class CanInterface:
         starttime = lasttime = time.time()
 
         while not complete and (not timeout or (lasttime-starttime < timeout)):
+            seen = self.getCanMsgCount()
             msgs = [msg for msg in self.genCanMsgs(start=start_index, arbids=[rx_arbid])]
 
             if len(msgs):
@@ -596,30 +1242,43 @@ class CanInterface:
                     #print e # debugging only, this is expected
                     pass
 
-            time.sleep(0.1)
+            # wait for more CAN messages to arrive instead of polling
+            if timeout:
+                wait = timeout - (time.time() - starttime)
+            else:
+                wait = 1
+            self.waitForCount(CMD_CAN_RECV, seen + 1, wait)
             lasttime = time.time()
             #print "_isotp_get_msg: status: %r - %r (%r) > %r" % (lasttime, starttime, (lasttime-starttime),  timeout)
 
         print "_isotp_get_msg: Timeout: %r - %r (%r) > %r" % (lasttime, starttime, (lasttime-starttime),  timeout)
         return None
 
-    def CANsniff(self, arbids=None):
+    def CANsniff(self, arbids=None, maxlen=SUB_QUEUE_LEN):
         '''
-        set a handler for CMD_CAN_RECV messages that print them to stdout.
+        subscribe to CMD_CAN_RECV messages and print them to stdout.
         Messages are still stored in the CMD_CAN_RECV mailbox for analysis,
         this simply allows you to see the as they are received... not always
         advisable, as there are *MANY* almost all the time :)
+
+        printing happens on its own thread; if it can't keep up, the oldest
+        unprinted messages (more than maxlen behind) are skipped
         '''
-        self.register_handler(CMD_CAN_RECV, lambda msg, obj: handleCanMsgsDuringSniff(msg, obj, arbids))
+        sub = self.subscribe(CMD_CAN_RECV, arbids=arbids, maxlen=maxlen, 
+                callback=lambda msg: printCanMsgDuringSniff(*msg))
         try:
             raw_input("Press Enter to stop sniffing")
         finally:
-            self.remove_handler(CMD_CAN_RECV)
+            self.unsubscribe(sub)
 
-    def CANreplay(self, start_bkmk=None, stop_bkmk=None, start_msg=0, stop_msg=None, arbids=None, timing=TIMING_FAST):
+        if sub.dropped:
+            print "(%d messages not printed, couldn't keep up)" % sub.dropped
+
+    def CANreplay(self, start_bkmk=None, stop_bkmk=None, start_msg=0, stop_msg=None, arbids=None, timing=TIMING_FAST, window=XMIT_WINDOW):
         '''
         Replay packets between two bookmarks.
         timing = TIMING_FAST: just slam them down the CAN bus as fast as possible
+                    (keeping "window" messages in flight, see CANxmitMulti())
         timing = TIMING_READ: send the messages using similar timing to how they 
                     were received
         timing = TIMING_INTERACTIVE: wait for the user to press Enter between each
@@ -631,6 +1290,10 @@ class CanInterface:
         if stop_bkmk != None:
             stop_msg = self.getMsgIndexFromBookmark(stop_bkmk)
 
+        if timing == TIMING_FAST:
+            msgs = ((arbid, data) for idx,ts,arbid,data in self.genCanMsgs(start_msg, stop_msg, arbids=arbids))
+            return self.CANxmitMulti(msgs, window=window)
+
         last_time = -1
         newstamp = time.time()
         for idx,ts,arbid,data in self.genCanMsgs(start_msg, stop_msg, arbids=arbids):
@@ -690,27 +1353,67 @@ class CanInterface:
         response = self.recv(CMD_PING_RESPONSE, wait=3)
         return response
 
-    def genCanMsgs(self, start=0, stop=None, arbids=None):
+    def genCanMsgs(self, start=0, stop=None, arbids=None, start_time=None, stop_time=None):
         '''
         CAN message generator.  takes in start/stop indexes as well as a list
         of desired arbids (list)
+
+        start_time/stop_time (time.time() style timestamps, inclusive) further
+        limit the messages to those received in that window, eg. the two 
+        seconds after a bookmark:
+            >>> ts = c.getBookmarkTime(3)
+            >>> c.genCanMsgs(start_time=ts, stop_time=ts+2)
         '''
-        messages = self._messages.get(CMD_CAN_RECV, [])
-        if stop == None:
-            stop = len(messages)
-        else:
-            stop = stop + 1 # This makes the stop index inclusive if specified
+        messages = self._messages.get(CMD_CAN_RECV)
+        if messages == None:
+            return
 
-        for idx in xrange(start, stop):
-            ts, msg = messages[idx]
+        start, stop = self._limitByTime(messages, start, stop, start_time, stop_time)
 
-            arbid, data = self._splitCanMsg(msg)
+        # stop is inclusive if specified
+        for msg in messages.genCanMsgs(start, stop, arbids):
+            yield msg
 
-            if arbids != None and arbid not in arbids:
-                # allow filtering of arbids
-                continue
+    def _limitByTime(self, messages, start, stop, start_time, stop_time):
+        '''
+        narrow a start/stop (inclusive) message index range down to the 
+        messages stamped start_time through stop_time
+        '''
+        if start_time == None and stop_time == None:
+            return start, stop
 
-            yield((idx, ts, arbid, data))
+        time_start, time_stop = messages.getIndexRangeByTime(start_time, stop_time)
+        if stop == None or time_stop < stop:
+            stop = time_stop
+        return max(start, time_start), stop
+
+    def getMsgIndexFromTime(self, ts, after=False):
+        '''
+        returns the index of the first CAN message received at or after ts 
+        (or strictly after, if after=True).  binary search, so it's quick on
+        any size capture.
+        '''
+        messages = self._messages.get(CMD_CAN_RECV)
+        if messages == None:
+            return 0
+        return messages.getIndexAtTime(ts, after)
+
+    def getMsgIndexRangeByTime(self, start_time=None, stop_time=None):
+        '''
+        returns (start_msg, stop_msg) for the CAN messages received between
+        start_time and stop_time (inclusive), for use with anything that
+        takes message indexes
+        '''
+        messages = self._messages.get(CMD_CAN_RECV)
+        if messages == None:
+            return 0, -1
+        return messages.getIndexRangeByTime(start_time, stop_time)
+
+    def getMsgTime(self, msg_index):
+        '''
+        returns the timestamp of a CAN message
+        '''
+        return self._messages.get(CMD_CAN_RECV)[msg_index][0]
 
     def _splitCanMsg(self, msg):
         '''
@@ -724,6 +1427,21 @@ class CanInterface:
         data = msg[4:]
         return arbid, data
 
+    def setMaxCaptureMemory(self, max_memory, spill_dir=None):
+        '''
+        Cap the memory used to store received CAN messages at max_memory
+        bytes (None for no limit).  Older messages spill to a temporary file
+        and stay readable by message index as usual.
+        '''
+        self._max_capture_memory = max_memory
+        self._spill_dir = spill_dir
+
+        for cmd in CAPTURE_CMDS:
+            mbox = self._messages.get(cmd)
+            if mbox != None:
+                mbox.max_memory = max_memory
+                mbox.spill_dir = spill_dir
+
     def getCanMsgCount(self):
         '''
         the number of CAN messages we've received this session
@@ -731,6 +1449,26 @@ class CanInterface:
         canmsgs = self._messages.get(CMD_CAN_RECV, [])
         return len(canmsgs)
 
+    def getArbidCounts(self, start=0, stop=None):
+        '''
+        returns { arbid : message count } for messages start through stop,
+        straight from the capture's arbid index (no messages are read)
+        '''
+        messages = self._messages.get(CMD_CAN_RECV)
+        if messages == None:
+            return {}
+        return messages.getArbidCounts(start, stop)
+
+    def getArbidMsgIndexes(self, arbid, start=0, stop=None):
+        '''
+        returns the message indexes of arbid's messages between start and 
+        stop (inclusive), straight from the capture's arbid index
+        '''
+        messages = self._messages.get(CMD_CAN_RECV)
+        if messages == None:
+            return []
+        return messages.getArbidIndexes(arbid, start, stop)
+
     def printSessionStatsByBookmark(self, start=None, stop=None):
         '''
         Prints session stats only for messages between two bookmarks
@@ -761,10 +1499,50 @@ class CanInterface:
 
         return self.getSessionStats(start=start_msg, stop=stop_msg)
 
+    def printSessionStatsByTime(self, start_time=None, stop_time=None):
+        '''
+        Prints session stats only for messages received between two times
+        '''
+        print self.getSessionStatsByTime(start_time, stop_time)
+
+    def getSessionStatsByTime(self, start_time=None, stop_time=None):
+        '''
+        returns session stats for messages received between two times
+        '''
+        start_msg, stop_msg = self.getMsgIndexRangeByTime(start_time, stop_time)
+        return self.getSessionStats(start=start_msg, stop=stop_msg)
+
+    def toArrays(self, start=0, stop=None, arbids=None):
+        '''
+        returns a cancat.arrays.CanArrays of messages start through stop:
+        NumPy arrays of message indexes (.idx), timestamps (.ts), arbids 
+        (.arbid), lengths (.dlc) and an N x 8 payload matrix (.data).
+        Needs numpy.
+        '''
+        if arrays == None:
+            raise Exception("toArrays() needs numpy (pip install numpy)")
+
+        messages = self._messages.get(CMD_CAN_RECV)
+        if messages == None:
+            messages = CanCapture()
+
+        arrs = arrays.captureArrays(messages, start, stop)
+        if arbids != None:
+            arrs = arrs.select(arrays.filterMask(arrs, list(arbids)))
+        return arrs
+
     def getArbitrationIds(self, start=0, stop=None, reverse=False):
         '''
         return a list of Arbitration IDs
         '''
+        if arrays != None:
+            arbid_list = []
+            for arbid, arrs in self.toArrays(start, stop).byArbid().items():
+                msgs = zip(arrs.ts.tolist(), arrs.dataStrings())
+                arbid_list.append((len(msgs), arbid, msgs))
+            arbid_list.sort(reverse=reverse)
+            return arbid_list
+
         arbids = {}
         msg_count = 0
         for idx,ts,arbid,data in self.genCanMsgs(start, stop):
@@ -780,52 +1558,96 @@ class CanInterface:
 
         return arbid_list
 
-    def getSessionStats(self, start=0, stop=None):
-        out = []
-        
-        arbid_list = self.getArbitrationIds(start=start, stop=stop, reverse=True)
-
-        for datalen, arbid, msgs in arbid_list:
-            last = 0
-            high = 0
-            low = 0xffffffff
-            for ts, data in msgs:
-                if last == 0:
-                    last = ts
-                    continue
+    def getArbidStats(self, start=0, stop=None):
+        '''
+        returns { arbid : ArbidStats } (see cancat/stats.py) for messages 
+        start through stop.  These are kept up to date as messages arrive, 
+        so this doesn't read through the capture.
+        '''
+        messages = self._messages.get(CMD_CAN_RECV)
+        if messages == None:
+            return {}
+        return messages.getArbidStats(start, stop)
 
-                # calculate the high and low
-                delta = ts - last
-                if delta > high:
-                    high = delta
-                if delta < low:
-                    low = delta
+    def getSessionStats(self, start=0, stop=None, exact=False):
+        '''
+        returns a string of timing stats for each Arbitration ID: message 
+        count and the time between messages (mean, percentiles, high/low)
 
-                # track repeated values (rounded to nearest .001 sec)
-                last = ts
+        percentiles come from sketches (within 1%), unless exact=True, which 
+        works them out from all the timestamps (needs numpy)
+        '''
+        if exact:
+            if arrays == None:
+                raise Exception("exact session stats need numpy (pip install numpy)")
+            return reprSessionStats(arrays.sessionStats(self.toArrays(start, stop)))
 
-            if datalen > 1:
-                mean = (msgs[-1][0] - msgs[0][0]) / (datalen-1)
-                median = low + (high-low) / 2
-            else:
-                low = 0
-                mean = 0
-                median = mean
-            out.append("id: 0x%x\tcount: %d\ttiming::  mean: %.3f\tmedian: %.3f\thigh: %.3f\tlow: %.3f" % \
-                    (arbid, datalen, mean, median, high, low))
-
-        msg_count = self.getCanMsgCount()
-        out.append("Total Uniq IDs: %d\nTotal Messages: %d" % (len(arbid_list), msg_count))
-        return '\n'.join(out)
+        return reprSessionStats(self.getArbidStats(start, stop))
+
+    def getByteChanges(self, start=0, stop=None, arbids=None):
+        '''
+        returns { arbid : ByteChanges } (see cancat/arrays.py) for messages 
+        start through stop: per arbid, the XOR of each payload with the one 
+        before, how often each bit flipped, how many values each byte held 
+        and when it changed.  Needs numpy.
+        '''
+        return arrays.byteChanges(self.toArrays(start, stop, arbids))
+
+    def printBitHeatmap(self, start=0, stop=None, arbids=None):
+        '''
+        Print a map of which payload bits of each Arbitration ID flip, and 
+        how often, between two message indexes
+        '''
+        print self.getBitHeatmap(start, stop, arbids)
+
+    def getBitHeatmap(self, start=0, stop=None, arbids=None):
+        return reprBitHeatmap(self.getByteChanges(start, stop, arbids))
+
+    def printByteChanges(self, start=0, stop=None, arbids=None):
+        '''
+        Print a table of how each payload byte of each Arbitration ID 
+        changes (values held, changes, live bits, first/last change)
+        between two message indexes
+        '''
+        print self.getByteChangeTable(start, stop, arbids)
+
+    def getByteChangeTable(self, start=0, stop=None, arbids=None):
+        return reprByteChangeTable(self.getByteChanges(start, stop, arbids))
 
     def loadFromFile(self, filename, force=False):
         '''
         Load a previous analysis session from a saved file
         see: saveSessionToFile()
+
+        also loads capture journals, and candump, Vector ASC and CSV logs
+        (see cancat/logformats.py)
         '''
-        me = pickle.load(file(filename))
+        if isJournal(filename):
+            # don't let saveSessionToFile() write a session over the journal
+            me = loadJournal(filename, self._newMailbox)
+            self.restoreSession(me, force=force)
+            self._filename = None
+            self._saved = None
+            return
+
+        if detectFormat(filename) != None:
+            # don't save a session over someone else's log either
+            me = loadCanLog(filename, self._newMailbox)
+            self.restoreSession(me, force=force)
+            self._filename = None
+            self._saved = None
+            return
+
+        if isSession(filename):
+            me, saved = readSession(filename, self._newMailbox)
+        else:
+            # a pickle from an older version: saving writes the new format
+            me = pickle.load(file(filename, 'rb'))
+            saved = None
+            self.log("imported pickled session %r, it will be saved as a session file" % filename)
         self.restoreSession(me, force=force)
         self._filename = filename
+        self._saved = saved
 
     def restoreSession(self, me, force=False):
         '''
@@ -836,16 +1658,42 @@ class CanInterface:
             print("Refusing to reload a session while active session!  use 'force=True' option")
             return
 
-        self._messages = me.get('messages')
+        self._restoreMessages(me.get('messages'))
         self.bookmarks = me.get('bookmarks')
         self.bookmark_info = me.get('bookmark_info')
         self.comments = me.get('comments')
 
-    def saveSessionToFile(self, filename=None):
+    def _restoreMessages(self, messages):
         '''
-        Saves the current analysis session to the filename given
-        If saved previously, the name will already be cached, so it is 
-        unnecessary to provide it again.
+        install a saved mailbox dict, converting mailboxes from sessions 
+        saved as lists of (timestamp, raw_message) tuples into columnar 
+        CanCapture stores (CAN messages) or deques (everything else)
+        '''
+        for cmd, mbox in messages.items():
+            if cmd in CAPTURE_CMDS:
+                if not isinstance(mbox, CanCapture):
+                    messages[cmd] = CanCapture(mbox)
+
+            elif not isinstance(mbox, collections.deque):
+                messages[cmd] = collections.deque(mbox)
+
+        self._messages = messages
+
+    def saveSessionToFile(self, filename=None, compress=None):
+        '''
+        Saves the current analysis session to the filename given
+        If saved previously, the name will already be cached, so it is 
+        unnecessary to provide it again.
+
+        Sessions are saved in the binary session format (cancat/session.py),
+        which loads without reading in the messages.  Saving again to the
+        same file only appends what's been added since the last save (or
+        load), so checkpointing a long capture stays cheap.
+
+        compress=True stores messages in separately compressed blocks 
+        (smaller, for archiving; reading messages only decompresses the 
+        blocks they're in), compress=False uncompressed, and by default 
+        it's however the session was last saved or loaded.
         '''
         if filename != None:
             self._filename = filename
@@ -854,12 +1702,25 @@ class CanInterface:
         else:
             filename = self._filename
 
-        savegame = self.saveSession()
-        me = pickle.dumps(savegame)
+        if compress == None:
+            compress = self._saved != None and self._saved.compress
 
-        outfile = file(filename, 'w')
-        outfile.write(me)
-        outfile.close()
+        self._saved = saveSession(filename, self.saveSession(), self._saved, compress)
+
+    def exportCapture(self, path, fmt='pcap', start=0, stop=None, arbids=None, iface='can0'):
+        '''
+        Write received CAN messages start through stop (optionally only 
+        those to arbids) to path for other tools: a pcap file for Wireshark
+        (fmt='pcap', SocketCAN link type) or a candump -l log for can-utils
+        (fmt='candump', as if captured on iface).  Timestamps are kept, IDs
+        over 0x7ff (or flagged extended when a log was loaded, see 
+        cancat/logformats.py) are written as extended.  Returns how many 
+        were written.
+
+        Messages stream straight from the capture, so memory use doesn't 
+        grow with the size of the export.
+        '''
+        return exportLog(path, self.genCanMsgs(start, stop, arbids=arbids), fmt, iface)
     
     def saveSession(self):
         '''
@@ -890,6 +1751,29 @@ class CanInterface:
         else:
             msg_index = len(mbox)
 
+        return self._placeCanBookmark(msg_index, name, comment)
+
+    def placeCanBookmarkAtTime(self, ts, name=None, comment=None):
+        '''
+        Save a named bookmark (with optional comment) at the first CAN 
+        message received at or after time ts, eg. 2 seconds after bookmark 3:
+            >>> c.placeCanBookmarkAtTime(c.getBookmarkTime(3) + 2, 'brake')
+        '''
+        return self._placeCanBookmark(self.getMsgIndexFromTime(ts), name, comment)
+
+    def getBookmarkTime(self, bkmk_index):
+        '''
+        returns the time of a bookmark: the timestamp of the first message 
+        after it (or of the last message, if there isn't one yet)
+        '''
+        mbox = self._messages.get(CMD_CAN_RECV)
+        if mbox == None or not len(mbox):
+            return None
+
+        msg_index = min(self.bookmarks[bkmk_index], len(mbox) - 1)
+        return mbox[msg_index][0]
+
+    def _placeCanBookmark(self, msg_index, name, comment):
         bkmk_index = len(self.bookmarks)
         self.bookmarks.append(msg_index)
         
@@ -897,6 +1781,7 @@ class CanInterface:
                 'comment' : comment }
 
         self.bookmark_info[bkmk_index] = info #should this be msg_index? benefit either way?
+        self._journalBookmark(bkmk_index)
         return bkmk_index
 
     def getMsgIndexFromBookmark(self, bkmk_index):
@@ -908,21 +1793,103 @@ class CanInterface:
 
     def setCanBookmarkName(self, bkmk_index, name):
         info = self.bookmark_info[bkmk_index]
-        info[name] = name
+        info['name'] = name
+        self._journalBookmark(bkmk_index)
 
     def setCanBookmarkComment(self, bkmk_index, comment):
         info = self.bookmark_info[bkmk_index]
-        info[name] = name
+        info['comment'] = comment
+        self._journalBookmark(bkmk_index)
 
     def setCanBookmarkNameByMsgIndex(self, msg_index, name):
         bkmk_index = self.bookmarks.index(msg_index)
-        info = self.bookmark_info[bkmk_index]
-        info[name] = name
+        self.setCanBookmarkName(bkmk_index, name)
 
     def setCanBookmarkCommentByMsgIndex(self, msg_index, comment):
         bkmk_index = self.bookmarks.index(msg_index)
-        info = self.bookmark_info[bkmk_index]
-        info[name] = name
+        self.setCanBookmarkComment(bkmk_index, comment)
+
+    def addComment(self, comment):
+        '''
+        Add a comment to the session (saved along with it)
+        '''
+        self.comments.append(comment)
+
+        journal = self._journal
+        if journal != None:
+            journal.logComment(comment)
+
+    # capture journal
+    def startJournal(self, filename, fsync_interval=1.0, overwrite=False):
+        '''
+        Start streaming received CAN messages, bookmarks and comments into an
+        append-only journal file (see cancat/journal.py), so a crash or a
+        yanked cable doesn't cost the whole capture.  Whatever has already 
+        been captured is written out first.
+
+        The journal is written in batches by its own thread and fsync'd every
+        fsync_interval seconds.  Load it like any other session:
+            loadFromFile(filename)  or  CanCat.py -f filename
+
+        An existing, non-empty filename is left alone (raises) unless 
+        overwrite=True
+        '''
+        if self._journal != None:
+            self.stopJournal()
+
+        self._queuelock.acquire()
+        try:
+            counts = [(cmd, len(self._messages[cmd])) for cmd in CAPTURE_CMDS if cmd in self._messages]
+            backlog = self._genJournalBacklog(counts, list(self.bookmarks), 
+                    dict(self.bookmark_info), list(self.comments))
+
+            # frames arriving from here on are queued behind the backlog
+            self._journal = CanJournal(filename, fsync_interval=fsync_interval, backlog=backlog, overwrite=overwrite)
+        finally:
+            self._queuelock.release()
+
+        return self._journal
+
+    def stopJournal(self):
+        '''
+        Flush and close the capture journal
+        '''
+        self._queuelock.acquire()
+        try:
+            journal = self._journal
+            self._journal = None
+        finally:
+            self._queuelock.release()
+
+        if journal != None:
+            journal.close()
+
+    def _genJournalBacklog(self, counts, bookmarks, bookmark_info, comments):
+        '''
+        yields journal records for everything already in the session
+        (only the first "count" messages of each mailbox)
+        '''
+        for cmd, count in counts:
+            mbox = self._messages.get(cmd)
+            for idx in xrange(count):
+                ts, msg = mbox[idx]
+                yield (REC_FRAME, ts, cmd, msg)
+
+        for bkmk_index, msg_index in enumerate(bookmarks):
+            info = bookmark_info.get(bkmk_index, {})
+            yield (REC_BOOKMARK, bkmk_index, msg_index, info.get('name'), info.get('comment'))
+
+        for comment in comments:
+            yield (REC_COMMENT, comment)
+
+    def _journalBookmark(self, bkmk_index):
+        journal = self._journal
+        if journal == None:
+            return
+
+        info = self.bookmark_info.get(bkmk_index, {})
+        journal.logBookmark(bkmk_index, self.bookmarks[bkmk_index], 
+                info.get('name'), info.get('comment'))
 
     def snapshotCanMessages(self, name=None, comment=None):
         '''
@@ -946,7 +1913,7 @@ class CanInterface:
         if stop_bkmk != None:
             stop_msg = self.getMsgIndexFromBookmark(stop_bkmk)
         else:
-            stop_bkmk = -1
+            stop_msg = None
 
         if start_baseline_bkmk != None:
             start_baseline_msg = self.getMsgIndexFromBookmark(start_baseline_bkmk)
@@ -968,23 +1935,219 @@ class CanInterface:
 
         for message indexes, you *will* want to look into the bookmarking subsystem!
         '''
+        if arrays != None:
+            return self._filterCanArrays(start_msg, stop_msg, start_baseline_msg, stop_baseline_msg, arbids, ignore).toMsgs()
+
         self.log("starting filtering messages...")
-        if stop_baseline_msg != None:
-            self.log("ignoring arbids from baseline...")
-            # get a list of baseline arbids
-            filter_ids = { arbid:1 for ts,arbid,data in self.genCanMsgs(start_baseline_msg, stop_baseline_msg) 
-                }.keys()
-        else:
-            filter_ids = None
+        filter_ids = self._getBaselineArbids(start_baseline_msg, stop_baseline_msg)
         self.log("filtering messages...")
-        filteredMsgs = [(idx, ts,arbid,msg) for idx,ts,arbid,msg in self.genCanMsgs(start_msg, stop_msg, arbids=arbids) \
-                if (type(arbids) == list and arbid in arbids) or arbid not in ignore and (filter_ids==None or arbid not in filter_ids)]
+        return list(self._genFilteredCanMsgs(start_msg, stop_msg, filter_ids, arbids, ignore))
+
+    def _getBaselineArbids(self, start_baseline_msg, stop_baseline_msg):
+        '''
+        the set of arbids seen in the baseline (None if there isn't one), 
+        straight from the arbid index
+        '''
+        if stop_baseline_msg == None:
+            return None
+        self.log("ignoring arbids from baseline...")
+        return set(self.getArbidCounts(start_baseline_msg or 0, stop_baseline_msg))
+
+    def _genFilteredCanMsgs(self, start_msg, stop_msg, filter_ids, arbids, ignore):
+        ignore = set(ignore)
+        for idx, ts, arbid, msg in self.genCanMsgs(start_msg, stop_msg, arbids=arbids):
+            if (type(arbids) == list and arbid in arbids) or arbid not in ignore and (filter_ids==None or arbid not in filter_ids):
+                yield idx, ts, arbid, msg
+
+    def _filterCanArrays(self, start_msg=0, stop_msg=None, start_baseline_msg=None, stop_baseline_msg=None, arbids=None, ignore=[]):
+        '''
+        filterCanMsgs(), vectorized: returns a CanArrays of the messages kept
+        '''
+        filter_ids = self._getBaselineArbids(start_baseline_msg, stop_baseline_msg)
+        arrs = self.toArrays(start_msg, stop_msg)
+        return arrs.select(arrays.filterMask(arrs, arbids, ignore, filter_ids))
+
+    def _genCanMsgDiffs(self, start_msg=0, stop_msg=None, start_baseline_msg=None, stop_baseline_msg=None, arbids=None, ignore=[]):
+        '''
+        filterCanMsgs(), a piece at a time: yields (idx, ts, arbid, msg, 
+        byte_cnt_diff) (see genByteDiffs())
+        '''
+        filter_ids = self._getBaselineArbids(start_baseline_msg, stop_baseline_msg)
+        if arrays == None:
+            for msg in genByteDiffs(self._genFilteredCanMsgs(start_msg, stop_msg, filter_ids, arbids, ignore)):
+                yield msg
+            return
 
-        return filteredMsgs
+        if stop_msg == None:
+            stop_msg = self.getCanMsgCount() - 1
+
+        last_msg = None
+        for chunk_start in xrange(start_msg, stop_msg + 1, REPR_CHUNK):
+            arrs = self.toArrays(chunk_start, min(chunk_start + REPR_CHUNK - 1, stop_msg))
+            arrs = arrs.select(arrays.filterMask(arrs, arbids, ignore, filter_ids))
+            if not len(arrs):
+                continue
+
+            msgs = arrs.toMsgs()
+            byte_diffs = arrays.byteDiffCounts(arrs).tolist()
+            if last_msg != None:
+                # compare across the chunk boundary too
+                byte_diffs[0] = genByteDiffs(msgs[:1], last_msg).next()[4]
+
+            for (idx, ts, arbid, msg), byte_cnt_diff in zip(msgs, byte_diffs):
+                yield idx, ts, arbid, msg, byte_cnt_diff
+            last_msg = msgs[-1][3]
+
+    def makeBaseline(self, start_msg=0, stop_msg=None):
+        '''
+        returns a Baseline (see cancat/baseline.py) of messages start_msg 
+        through stop_msg: every arbid seen, and every value each of their 
+        bytes held.  Build it once, then hand it to filterNovelMsgs() and 
+        friends as often as you like.
+        '''
+        if arrays != None:
+            base = Baseline()
+            base.updateByteChanges(self.getByteChanges(start_msg, stop_msg))
+            return base
+
+        return Baseline(self.genCanMsgs(start_msg, stop_msg))
+
+    def makeBaselineByBookmark(self, start_bkmk=None, stop_bkmk=None):
+        '''
+        returns a Baseline of the messages between two bookmarks
+        '''
+        start_msg, stop_msg = self._bookmarkRange(start_bkmk, stop_bkmk)
+        return self.makeBaseline(start_msg, stop_msg)
+
+    def _bookmarkRange(self, start_bkmk, stop_bkmk):
+        '''
+        message indexes for a pair of bookmarks (either may be None)
+        '''
+        start_msg = 0
+        if start_bkmk != None:
+            start_msg = self.getMsgIndexFromBookmark(start_bkmk)
+
+        stop_msg = None
+        if stop_bkmk != None:
+            stop_msg = self.getMsgIndexFromBookmark(stop_bkmk)
+
+        return start_msg, stop_msg
+
+    def filterNovelMsgs(self, baseline, start_msg=0, stop_msg=None, arbids=None, ignore=[], values=True):
+        '''
+        returns the received CAN messages between indexes "start_msg" and "stop_msg"
+        with something "baseline" (see makeBaseline()) never saw: an arbid, or if 
+        "values" is set, a byte value in some position, or a longer message
+        '''
+        return [(idx, ts, arbid, data) for idx, ts, arbid, data, novelty in 
+                self._genNovelMsgs(baseline, start_msg, stop_msg, arbids, ignore, values)]
+
+    def filterNovelMsgsByBookmark(self, baseline, start_bkmk=None, stop_bkmk=None, arbids=None, ignore=[], values=True):
+        start_msg, stop_msg = self._bookmarkRange(start_bkmk, stop_bkmk)
+        return self.filterNovelMsgs(baseline, start_msg, stop_msg, arbids, ignore, values)
+
+    def _genNovelMsgs(self, baseline, start_msg=0, stop_msg=None, arbids=None, ignore=[], values=True):
+        '''
+        yields (idx, ts, arbid, data, novelty) for messages the baseline 
+        hasn't seen the like of
+        '''
+        if arrays != None:
+            arrs = self.toArrays(start_msg, stop_msg, arbids)
+            arrs = arrs.select(arrays.filterMask(arrs, ignore=ignore) & arrays.novelMask(arrs, baseline, values))
+            for idx, ts, arbid, data in arrs.toMsgs():
+                yield idx, ts, arbid, data, baseline.novelty(arbid, data)
+            return
+
+        ignore = set(ignore)
+        msgs = ((idx, ts, arbid, data) for idx, ts, arbid, data in self.genCanMsgs(start_msg, stop_msg, arbids=arbids) 
+                if arbid not in ignore)
+        for novel in baseline.genNovel(msgs, values):
+            yield novel
+
+    def planQuery(self, query, start_msg=0, stop_msg=None):
+        '''
+        returns the QueryPlan for a query (see cancat/query.py): the message 
+        range and arbids it comes down to, for a look at what it'll do
+        '''
+        if not isinstance(query, Query):
+            query = Query(query)
+        return query.plan(self, start_msg, stop_msg)
+
+    def genCanMsgsByQuery(self, query, start_msg=0, stop_msg=None):
+        '''
+        yields the (idx, ts, arbid, data) messages from start_msg through 
+        stop_msg matching a query, eg:
+            "arbid in 0x700..0x7ff and data[0] & 0xf0 == 0x10 and t in bkmk(2)..bkmk(3)"
+        query is the text or a Query (parse it once with Query(text) if it's
+        used over and over).  see cancat/query.py for the language.
+        '''
+        plan = self.planQuery(query, start_msg, stop_msg)
+        if plan.start > plan.stop or plan.arbids == []:
+            return
+
+        span = plan.stop - plan.start + 1
+        if arrays == None or (plan.arbids != None and plan.count * INDEX_SCAN_RATIO < span):
+            # straight to the arbids' messages (from the arbid index)
+            match = plan.match
+            for idx, ts, arbid, data in self.genCanMsgs(plan.start, plan.stop, arbids=plan.arbids):
+                if match == None or match(idx, ts, arbid, data):
+                    yield idx, ts, arbid, data
+            return
+
+        for chunk_start in xrange(plan.start, plan.stop + 1, REPR_CHUNK):
+            arrs = self.toArrays(chunk_start, min(chunk_start + REPR_CHUNK - 1, plan.stop), plan.arbids)
+            if plan.matchArrays != None:
+                arrs = arrs.select(plan.matchArrays(arrs))
+            for msg in arrs.toMsgs():
+                yield msg
+
+    def queryCanMsgs(self, query, start_msg=0, stop_msg=None):
+        '''
+        returns a list of the messages genCanMsgsByQuery() yields
+        '''
+        return list(self.genCanMsgsByQuery(query, start_msg, stop_msg))
+
+    def printCanMsgsByQuery(self, query, start_msg=0, stop_msg=None, out=None, pager=False):
+        '''
+        Print the messages matching a query (see genCanMsgsByQuery()), like 
+        printCanMsgs() does
+        '''
+        writeLines(self.genReprCanMsgsByQuery(query, start_msg, stop_msg), out, pager)
+
+    def reprCanMsgsByQuery(self, query, start_msg=0, stop_msg=None):
+        return "\n".join(self.genReprCanMsgsByQuery(query, start_msg, stop_msg))
+
+    def genReprCanMsgsByQuery(self, query, start_msg=0, stop_msg=None):
+        yield "query: %s" % getattr(query, 'text', query)
+        msgs = genByteDiffs(self.genCanMsgsByQuery(query, start_msg, stop_msg))
+        for line in genReprMsgLines(msgs, self.bookmarks, self.reprBookmark):
+            yield line
+
+    def printNovelMsgsByBookmark(self, baseline, start_bkmk=None, stop_bkmk=None, arbids=None, ignore=[], values=True):
+        start_msg, stop_msg = self._bookmarkRange(start_bkmk, stop_bkmk)
+        print self.reprNovelMsgs(baseline, start_msg, stop_msg, arbids, ignore, values)
+
+    def printNovelMsgs(self, baseline, start_msg=0, stop_msg=None, arbids=None, ignore=[], values=True):
+        print self.reprNovelMsgs(baseline, start_msg, stop_msg, arbids, ignore, values)
+
+    def reprNovelMsgs(self, baseline, start_msg=0, stop_msg=None, arbids=None, ignore=[], values=True):
+        '''
+        String representation of the messages filterNovelMsgs() returns, 
+        each with what the baseline hadn't seen
+        '''
+        out = []
+        for idx, ts, arbid, data, novelty in self._genNovelMsgs(baseline, start_msg, stop_msg, arbids, ignore, values):
+            out.append(reprCanMsg(idx, ts, arbid, data, comment=reprNovelty(novelty)))
+        out.append("Total Novel Messages: %d  (baseline: %d messages, %d arbids)" % \
+                (len(out), baseline.count, len(baseline.arbids)))
+        return '\n'.join(out)
         
     def printCanMsgsByBookmark(self, start_bkmk=None, stop_bkmk=None, start_baseline_bkmk=None, stop_baseline_bkmk=None, 
-                    arbids=None, ignore=[]):
-        print self.reprCanMsgsByBookmark(start_bkmk, stop_bkmk, start_baseline_bkmk, stop_baseline_bkmk, arbids, ignore)
+                    arbids=None, ignore=[], out=None, pager=False):
+        start_msg, stop_msg = self._bookmarkRange(start_bkmk, stop_bkmk)
+        start_baseline_msg, stop_baseline_msg = self._bookmarkRange(start_baseline_bkmk, stop_baseline_bkmk)
+        writeLines(self.genReprCanMsgs(start_msg, stop_msg, start_baseline_msg=start_baseline_msg, 
+                stop_baseline_msg=stop_baseline_msg, arbids=arbids, ignore=ignore), out, pager)
 
     def reprCanMsgsByBookmark(self, start_bkmk=None, stop_bkmk=None, start_baseline_bkmk=None, stop_baseline_bkmk=None, arbids=None, ignore=[]):
         out = []
@@ -997,7 +2160,7 @@ class CanInterface:
         if stop_bkmk != None:
             stop_msg = self.getMsgIndexFromBookmark(stop_bkmk)
         else:
-            stop_bkmk = -1
+            stop_msg = None
 
         if start_baseline_bkmk != None:
             start_baseline_msg = self.getMsgIndexFromBookmark(start_baseline_bkmk)
@@ -1009,10 +2172,28 @@ class CanInterface:
         else:
             stop_baseline_msg = None
 
-        return self.reprCanMsgs(start_msg, stop_msg, start_baseline_msg, stop_baseline_msg, arbids, ignore)
+        return self.reprCanMsgs(start_msg, stop_msg, start_baseline_msg=start_baseline_msg, 
+                stop_baseline_msg=stop_baseline_msg, arbids=arbids, ignore=ignore)
+
+    def printCanMsgsByTime(self, start_time=None, stop_time=None, arbids=None, ignore=[], out=None, pager=False):
+        start_msg, stop_msg = self.getMsgIndexRangeByTime(start_time, stop_time)
+        writeLines(self.genReprCanMsgs(start_msg, stop_msg, arbids=arbids, ignore=ignore), out, pager)
+
+    def reprCanMsgsByTime(self, start_time=None, stop_time=None, arbids=None, ignore=[]):
+        '''
+        String representation of the CAN Messages received between two times
+        (see getBookmarkTime() and getMsgTime() for times to start from)
+        '''
+        start_msg, stop_msg = self.getMsgIndexRangeByTime(start_time, stop_time)
+        return self.reprCanMsgs(start_msg, stop_msg, arbids=arbids, ignore=ignore)
 
-    def printCanMsgs(self, start_msg=0, stop_msg=None, start_bkmk=None, stop_bkmk=None, start_baseline_msg=None, stop_baseline_msg=None, arbids=None, ignore=[]):
-        print self.reprCanMsgs(start_msg, stop_msg, start_bkmk, stop_bkmk, start_baseline_msg, stop_baseline_msg, arbids, ignore)
+    def printCanMsgs(self,start_msg=0, stop_msg=None, start_bkmk=None, stop_bkmk=None, start_baseline_msg=None, stop_baseline_msg=None, arbids=None, ignore=[], out=None, pager=False):
+        '''
+        Print a set of CAN Messages (see reprCanMsgs()) as they're worked 
+        out: to stdout, to "out" (a file or filename) or, if "pager" is set, 
+        through $PAGER
+        '''
+        writeLines(self.genReprCanMsgs(start_msg, stop_msg, start_bkmk, stop_bkmk, start_baseline_msg, stop_baseline_msg, arbids, ignore), out, pager)
 
     def reprCanMsgs(self, start_msg=0, stop_msg=None, start_bkmk=None, stop_bkmk=None, start_baseline_msg=None, stop_baseline_msg=None, arbids=None, ignore=[]):
         '''
@@ -1024,99 +2205,29 @@ class CanInterface:
 
         Many functions wrap this one.
         '''
-        out = []
+        return "\n".join(self.genReprCanMsgs(start_msg, stop_msg, start_bkmk, stop_bkmk, start_baseline_msg, stop_baseline_msg, arbids, ignore))
 
+    def genReprCanMsgs(self, start_msg=0, stop_msg=None, start_bkmk=None, stop_bkmk=None, start_baseline_msg=None, stop_baseline_msg=None, arbids=None, ignore=[]):
+        '''
+        reprCanMsgs(), a line at a time
+        '''
         if start_bkmk != None:
             start_msg = self.getMsgIndexFromBookmark(start_bkmk)
 
         if stop_bkmk != None:
             stop_msg = self.getMsgIndexFromBookmark(stop_bkmk)
 
-
-
         if start_msg in self.bookmarks:
             bkmk = self.bookmarks.index(start_msg)
-            out.append("starting from bookmark %d: '%s'" % 
-                    (bkmk,
-                    self.bookmark_info[bkmk].get('name'))
-                    )
+            yield "starting from bookmark %d: '%s'" % (bkmk, self.bookmark_info[bkmk].get('name'))
 
         if stop_msg in self.bookmarks:
             bkmk = self.bookmarks.index(stop_msg)
-            out.append("stoppng at bookmark %d: '%s'" % 
-                    (bkmk,
-                    self.bookmark_info[bkmk].get('name'))
-                    )
-
-        last_msg = None
-        next_bkmk = 0
-        next_bkmk_idx = 0
-
-        msg_count = 0
-        last_ts = None
-        tot_delta_ts = 0
-        counted_msgs = 0    # used for calculating averages, excluding outliers
-        
-        data_delta = None
-
-
-        data_repeat = 0
-        data_similar = 0
+            yield "stoppng at bookmark %d: '%s'" % (bkmk, self.bookmark_info[bkmk].get('name'))
 
-        for idx, ts, arbid, msg in self.filterCanMsgs(start_msg, stop_msg, start_baseline_msg, stop_baseline_msg, arbids=arbids, ignore=ignore):
-            diff = []
-
-            # insert bookmark names/comments in appropriate places
-            while next_bkmk_idx < len(self.bookmarks) and idx >= self.bookmarks[next_bkmk_idx]:
-                out.append(self.reprBookmark(next_bkmk_idx))
-                next_bkmk_idx += 1
-
-            msg_count += 1
-
-            # check data
-            byte_cnt_diff = 0
-            if last_msg != None:
-                if len(last_msg) == len(msg):
-                    for bidx in range(len(msg)):
-                        if last_msg[bidx] != msg[bidx]:
-                            byte_cnt_diff += 1
-
-                    if byte_cnt_diff == 0:
-                        diff.append("REPEAT")
-                        data_repeat += 1
-                    elif byte_cnt_diff <=4:
-                        diff.append("Similar")
-                        data_similar += 1
-                    # FIXME: make some better heuristic to identify "out of norm"
-
-            # look for ASCII data (4+ consecutive bytes)
-            if hasAscii(msg):
-                diff.append("ASCII: %s" % repr(msg))
-
-            # calculate timestamp delta and comment if out of whack
-            if last_ts == None:
-                last_ts = ts
-
-            delta_ts = ts - last_ts
-            if counted_msgs:
-                avg_delta_ts = tot_delta_ts / counted_msgs
-            else:
-                avg_delta_ts = delta_ts
-
-
-            if abs(delta_ts - avg_delta_ts) <= delta_ts:
-                tot_delta_ts += delta_ts
-                counted_msgs += 1
-            else:
-                diff.append("TS_delta: %.3f" % delta_ts)
-
-            out.append(reprCanMsg(idx, ts, arbid, msg, comment='\t'.join(diff)))
-            last_ts = ts
-            last_msg = msg
-
-        out.append("Total Messages: %d  (repeat: %d / similar: %d)" % (msg_count, data_repeat, data_similar))
-
-        return "\n".join(out)
+        msgs = self._genCanMsgDiffs(start_msg, stop_msg, start_baseline_msg, stop_baseline_msg, arbids=arbids, ignore=ignore)
+        for line in genReprMsgLines(msgs, self.bookmarks, self.reprBookmark):
+            yield line
 
     def printCanSessions(self, arbid_list=None):
         '''
@@ -1126,11 +2237,13 @@ class CanInterface:
         Or... provide your own list of ArbIDs in whatever order you like
         '''
         if arbid_list == None:
-            arbids = self.getArbitrationIds()
+            arbids = [(count, arbid) for arbid, count in self.getArbidCounts().items()]
+            arbids.sort()
         else:
-            arbids = [arbdata for arbdata in self.getArbitrationIds() if arbdata[1] in arbid_list]
+            counts = self.getArbidCounts()
+            arbids = [(counts[arbid], arbid) for arbid in arbid_list if arbid in counts]
 
-        for datalen,arbid,msgs in arbids:
+        for datalen,arbid in arbids:
             print self.reprCanMsgs(arbids=[arbid])
             cmd = raw_input("\n[N]ext, R)eplay, F)astReplay, I)nteractiveReplay, Q)uit: ").upper()
             while len(cmd) and cmd != 'N':
@@ -1155,13 +2268,124 @@ class CanInterface:
         '''
         print(self.reprBookmarks())
 
-    def printAsciiStrings(self, minbytes=4, strict=True):
+    def searchPayload(self, pattern, mask=None, arbids=None, start_msg=0, stop_msg=None, span=False):
         '''
-        Search through messages looking for ASCII strings
+        returns the (sorted) indexes of the messages a byte pattern turns up 
+        in (starts in, if span=True), eg:
+            >>> c.searchPayload('1FT')                      # VIN fragment
+            >>> c.searchPayload('\x27\x00', '\xff\x00')   # any byte after 0x27
+            >>> c.searchPayload(['WMI', 'VIN'], arbids=[0x7e8], span=True)
+
+        pattern can be a list of patterns (with a list of masks, or None), 
+        all looked for at once.  a mask byte picks which bits of that byte 
+        have to match.  with span=True, matches can carry on into the next 
+        messages of the same arbid.  see cancat/search.py
         '''
-        for idx, ts, arbid, msg in self.genCanMsgs():
-            if hasAscii(msg, minbytes=minbytes, strict=strict):
-                print reprCanMsg(idx, ts, arbid, msg, repr(msg))
+        idxs = set([match[0] for match in self.searchPayloadMatches(pattern, mask, arbids, start_msg, stop_msg, span)])
+        return sorted(idxs)
+
+    def searchPayloadMatches(self, pattern, mask=None, arbids=None, start_msg=0, stop_msg=None, span=False):
+        '''
+        searchPayload(), with the details: returns a sorted list of 
+        (idx, offset, pattern_num, last_idx) for every match: the message it
+        starts in, where in that message's data, which pattern (for a list 
+        of them) and the message it ends in (only different with span=True)
+        '''
+        regex = compilePatterns(pattern, mask)
+        messages = self._messages.get(CMD_CAN_RECV)
+        if messages == None:
+            return []
+
+        if arbids != None:
+            arbids = set(arbids)
+
+        matches = []
+        if not span:
+            for idx, arbid, offset, pattern_num, length in messages.genPayloadMatches(regex, start_msg, stop_msg):
+                if arbids == None or arbid in arbids:
+                    matches.append((idx, offset, pattern_num, idx))
+            return matches
+
+        if arbids == None:
+            arbids = self.getArbidCounts(start_msg, stop_msg)
+
+        for arbid in arbids:
+            matches.extend(genStreamMatches(regex, self.genCanMsgs(start_msg, stop_msg, arbids=[arbid])))
+        matches.sort()
+        return matches
+
+    def printPayloadMatches(self, pattern, mask=None, arbids=None, start_msg=0, stop_msg=None, span=False):
+        '''
+        Print the messages searchPayload() finds, with where each match is
+        '''
+        for idx, offset, pattern_num, last_idx in self.searchPayloadMatches(pattern, mask, arbids, start_msg, stop_msg, span):
+            ts, arbid, data = self._messages[CMD_CAN_RECV].getFrame(idx)
+            comment = "pattern %d at byte %d" % (pattern_num, offset)
+            if last_idx != idx:
+                comment += " (through message %d)" % last_idx
+            print reprCanMsg(idx, ts, arbid, data, comment)
+
+    def printAsciiStrings(self, minbytes=4, strict=True, arbids=None, span=False, isotp=False):
+        '''
+        Search through messages looking for ASCII strings: messages that are
+        all ASCII (strict) or hold a string at least minbytes long.
+        with span or isotp, prints the strings findAsciiStrings() finds 
+        instead: strung together across messages of an arbid (span) or 
+        from reassembled ISO-TP messages (isotp)
+        '''
+        if span or isotp:
+            for first_idx, offset, last_idx, text in self.findAsciiStrings(minbytes, arbids, span=span, isotp=isotp):
+                ts, arbid, data = self._messages[CMD_CAN_RECV].getFrame(first_idx)
+                print "%.8d-%.8d %8.3f ID: %.3x,  at byte %d: %r" % (first_idx, last_idx, ts, arbid, offset, text)
+            return
+
+        seen = set()
+        for first_idx, offset, last_idx, text in self.findAsciiStrings(minbytes, arbids):
+            if first_idx in seen:
+                continue
+            seen.add(first_idx)
+
+            ts, arbid, msg = self._messages[CMD_CAN_RECV].getFrame(first_idx)
+            if not strict or len(text) == len(msg):
+                print reprCanMsg(first_idx, ts, arbid, msg, repr(msg))
+
+    def findAsciiStrings(self, minbytes=4, arbids=None, start_msg=0, stop_msg=None, span=False, isotp=False):
+        '''
+        returns [(first_idx, offset, last_idx, string), ...] for the ASCII 
+        strings (runs of at least minbytes of the bytes hasAscii() looks 
+        for) in messages start_msg through stop_msg: the message each starts
+        in, where in its data, and the message it ends in.
+        
+        by default strings stay within one message, and the search runs over
+        the capture's payload storage in one go.  span=True strings together
+        consecutive messages of each arbid, so strings split across them are
+        found whole.  isotp=True looks in reassembled ISO-TP messages.
+        '''
+        messages = self._messages.get(CMD_CAN_RECV)
+        if messages == None:
+            return []
+
+        regex = asciiRegex(minbytes)
+        if arbids != None:
+            arbids = set(arbids)
+
+        if not (span or isotp):
+            return [(idx, offset, idx, text) for idx, arbid, offset, text in 
+                    messages.genPayloadRuns(regex, max(minbytes, 1), start_msg, stop_msg) 
+                    if arbids == None or arbid in arbids]
+
+        if arbids == None:
+            arbids = self.getArbidCounts(start_msg, stop_msg)
+
+        strings = []
+        for arbid in arbids:
+            msgs = self.genCanMsgs(start_msg, stop_msg, arbids=[arbid])
+            if isotp:
+                strings.extend(genIsoTpRuns(regex, msgs))
+            else:
+                strings.extend(genStreamRuns(regex, msgs))
+        strings.sort()
+        return strings
 
     def reprBookmarks(self):
         '''
@@ -1230,24 +2454,119 @@ class CanControl(cmd.Cmd):
         self.canbuf = CanBuffer(self.serialdev, self._baud)
 
 
+_ascii_only = re.compile('%s*\\Z' % ASCII_CLASS)
+
 def hasAscii(msg, minbytes=4, strict=True):
     '''
     if minbytes == -1, every character has to be clean ASCII
     otherwise, look for strings of at least minbytes in length
+    (strict: the whole message has to be ASCII)
     '''
-    ascii_match = 0
-    ascii_count = 0
-    for byte in msg:
-        if 0x30 <= ord(byte) < 0x7f:
-            ascii_count +=1
-            if ascii_count >= minbytes:
-                ascii_match = 1
+    if strict:
+        return int(len(msg) >= max(minbytes, 1) and _ascii_only.match(msg) != None)
+    return int(asciiRegex(minbytes).search(msg) != None)
+
+def genByteDiffs(msgs, last_msg=None):
+    '''
+    for each (idx, ts, arbid, data) message, yields (idx, ts, arbid, data, 
+    byte_cnt_diff): how many data bytes differ from the message before it 
+    (last_msg, for the first), or -1 if there isn't one or the lengths differ.
+    see arrays.byteDiffCounts() for the vectorized version
+    '''
+    for idx, ts, arbid, msg in msgs:
+        byte_cnt_diff = -1
+        if last_msg != None and len(last_msg) == len(msg):
+            byte_cnt_diff = 0
+            for bidx in range(len(msg)):
+                if last_msg[bidx] != msg[bidx]:
+                    byte_cnt_diff += 1
+        yield idx, ts, arbid, msg, byte_cnt_diff
+        last_msg = msg
+
+def reprSessionStats(arbid_stats):
+    '''
+    string representation of { arbid : ArbidStats }, busiest arbid first
+    '''
+    out = []
+    arbid_list = [(stats.count, arbid, stats) for arbid, stats in arbid_stats.items()]
+    arbid_list.sort(reverse=True)
+
+    msg_count = 0
+    for count, arbid, stats in arbid_list:
+        msg_count += count
+        if stats.gaps():
+            timing = (stats.mean(), stats.quantile(.5), stats.quantile(.95), stats.quantile(.99),
+                    stats.gap_max, stats.gap_min, stats.stddev())
         else:
-            if strict:
-                return 0
+            timing = (0, 0, 0, 0, 0, 0, 0)
+
+        out.append(("id: 0x%x\tcount: %d\ttiming::  mean: %.6f\tmedian: %.6f\tp95: %.6f\tp99: %.6f"
+                "\thigh: %.6f\tlow: %.6f\tstddev: %.6f") % ((arbid, count) + timing))
+
+    out.append("Total Uniq IDs: %d\nTotal Messages: %d" % (len(arbid_list), msg_count))
+    return '\n'.join(out)
 
-            ascii_count = 0
-    return ascii_match
+def reprBitHeatmap(byte_changes):
+    '''
+    string representation of { arbid : ByteChanges } as a heatmap: a row 
+    per arbid, eight characters per byte (most significant bit first) 
+    showing how often each bit flipped
+    '''
+    out = []
+    width = max([changes.width for changes in byte_changes.values()] + [0])
+    while width and not max([changes.present[width-1] for changes in byte_changes.values()]):
+        width -= 1
+
+    out.append(("%-10s %8s  %s" % ("arbid", "count",
+        ' '.join(["B%-7d" % byte for byte in range(width)]))).rstrip())
+
+    for arbid in sorted(byte_changes):
+        changes = byte_changes[arbid]
+        rates = changes.toggleRates()
+        row = []
+        for byte in range(width):
+            if byte >= changes.width or not changes.present[byte]:
+                row.append(' ' * 8)
+                continue
+
+            bits = []
+            for bit in range(7, -1, -1):
+                rate = rates[byte, bit]
+                if not changes.toggles[byte, bit]:
+                    bits.append(HEATMAP_CHARS[0])
+                else:
+                    bits.append(HEATMAP_CHARS[1 + min(int(rate * (len(HEATMAP_CHARS)-1)), len(HEATMAP_CHARS)-2)])
+            row.append(''.join(bits))
+
+        out.append(("0x%-8x %8d  %s" % (arbid, changes.count, ' '.join(row))).rstrip())
+
+    out.append("('%s' never flipped, '%s' through '%s' flipped in up to all of the messages)" % \
+            (HEATMAP_CHARS[0], HEATMAP_CHARS[1], HEATMAP_CHARS[-1]))
+    return '\n'.join(out)
+
+def reprByteChangeTable(byte_changes):
+    '''
+    string representation of { arbid : ByteChanges }: a line per arbid 
+    and byte, with the values held, the changes, which bits flipped (most 
+    significant first) and when it first/last changed
+    '''
+    out = []
+    for arbid in sorted(byte_changes):
+        changes = byte_changes[arbid]
+        for byte in range(changes.width):
+            if not changes.present[byte]:
+                continue
+
+            live = ''.join(['.1'[changes.toggles[byte, bit] != 0] for bit in range(7, -1, -1)])
+            times = changes.changeTimes(byte)
+            first = last = 0
+            if len(times):
+                first, last = times[0], times[-1]
+
+            out.append("id: 0x%x\tbyte: %d\tdistinct: %d\tchanges: %d\tlive bits: %s\tfirst change: %.6f\tlast change: %.6f" % \
+                    (arbid, byte, changes.distinct[byte], changes.changes[byte], live, first, last))
+
+    return '\n'.join(out)
 
 def reprCanMsg(idx, ts, arbid, data, comment=None):
     #TODO: make some repr magic that spits out known ARBID's and other subdata
@@ -1255,6 +2574,116 @@ def reprCanMsg(idx, ts, arbid, data, comment=None):
         comment = ''
     return "%.8d %8.3f ID: %.3x,  Len: %.2x, Data: %-18s\t%s" % (idx, ts, arbid, len(data), data.encode('hex'), comment)
 
+def genReprMsgLines(msgs, bookmarks, reprBookmark, reprMsg=reprCanMsg):
+    '''
+    yields the lines of a reprCanMsgs() style listing, one message at a time.
+    msgs are (idx, ts, arbid, msg, byte_cnt_diff) (see genByteDiffs()), and 
+    the bookmarks they pass (message indexes, shown with reprBookmark(bkmk))
+    go in between.  each message is shown with reprMsg(idx, ts, arbid, msg,
+    comment), the comment calling out REPEAT/Similar data, ASCII and odd 
+    timing.  the last line is the totals.
+    '''
+    next_bkmk_idx = 0
+
+    msg_count = 0
+    last_ts = None
+    tot_delta_ts = 0
+    counted_msgs = 0    # used for calculating averages, excluding outliers
+
+    data_repeat = 0
+    data_similar = 0
+
+    for idx, ts, arbid, msg, byte_cnt_diff in msgs:
+        diff = []
+
+        # insert bookmark names/comments in appropriate places
+        while next_bkmk_idx < len(bookmarks) and idx >= bookmarks[next_bkmk_idx]:
+            yield reprBookmark(next_bkmk_idx)
+            next_bkmk_idx += 1
+
+        msg_count += 1
+
+        # check data (byte_cnt_diff is -1 if there's nothing to compare to)
+        if byte_cnt_diff == 0:
+            diff.append("REPEAT")
+            data_repeat += 1
+        elif 0 < byte_cnt_diff <= 4:
+            diff.append("Similar")
+            data_similar += 1
+        # FIXME: make some better heuristic to identify "out of norm"
+
+        # look for ASCII data (4+ consecutive bytes)
+        if hasAscii(msg):
+            diff.append("ASCII: %s" % repr(msg))
+
+        # calculate timestamp delta and comment if out of whack
+        if last_ts == None:
+            last_ts = ts
+
+        delta_ts = ts - last_ts
+        if counted_msgs:
+            avg_delta_ts = tot_delta_ts / counted_msgs
+        else:
+            avg_delta_ts = delta_ts
+
+
+        if abs(delta_ts - avg_delta_ts) <= delta_ts:
+            tot_delta_ts += delta_ts
+            counted_msgs += 1
+        else:
+            diff.append("TS_delta: %.3f" % delta_ts)
+
+        yield reprMsg(idx, ts, arbid, msg, comment='\t'.join(diff))
+        last_ts = ts
+
+    yield "Total Messages: %d  (repeat: %d / similar: %d)" % (msg_count, data_repeat, data_similar)
+
+def writeLines(lines, out=None, pager=False):
+    '''
+    write out lines (say, from genReprCanMsgs()) as they're generated, so 
+    nothing has to be held in memory: to out (a file, or a filename), or 
+    stdout if out is None.  pager=True pipes them through $PAGER (or less), 
+    and quitting the pager early stops generating them.
+    '''
+    proc = None
+    close = False
+    if pager:
+        proc = subprocess.Popen(os.environ.get('PAGER', 'less'), shell=True, stdin=subprocess.PIPE)
+        out = proc.stdin
+        close = True
+    elif out == None:
+        out = sys.stdout
+    elif isinstance(out, basestring):
+        out = open(out, 'w')
+        close = True
+
+    try:
+        batch = []
+        for line in lines:
+            batch.append(line)
+            if len(batch) >= WRITE_BATCH:
+                out.write('\n'.join(batch) + '\n')
+                out.flush()
+                batch = []
+
+        if batch:
+            out.write('\n'.join(batch) + '\n')
+        out.flush()
+
+    except IOError, e:
+        # pager quit
+        if e.errno != errno.EPIPE:
+            raise
+
+    finally:
+        if close:
+            try:
+                out.close()
+            except IOError:
+                pass
+        if proc != None:
+            proc.wait()
+
 
 class FordInterface(CanInterface):
     def setCanBaudHSCAN(self):
@@ -1285,7 +2714,7 @@ class GMInterface(CanInterface):
         self.setCanBaud(CAN_33KBPS)
 
 class CanInTheMiddleInterface(CanInterface):
-    def __init__(self, port=serialdev, baud=baud, verbose=False, cmdhandlers=None, comment='', load_filename=None, orig_iface=None):
+    def __init__(self, port=serialdev, baud=baud, verbose=False, cmdhandlers=None, comment='', load_filename=None, orig_iface=None, coalesce_writes=False, max_capture_memory=None, spill_dir=None):
         '''
         CAN in the middle. Allows the user to determine what CAN messages are being
         sent by a device by isolating a device from the CAN network and using two
@@ -1310,32 +2739,25 @@ class CanInTheMiddleInterface(CanInterface):
         '''
         self.bookmarks_iso = []
         self.bookmark_info_iso = {}
-        CanInterface.__init__(self, port=port, baud=baud, verbose=verbose, cmdhandlers=cmdhandlers, comment=comment, load_filename=load_filename, orig_iface=orig_iface)
+        CanInterface.__init__(self, port=port, baud=baud, verbose=verbose, cmdhandlers=cmdhandlers, comment=comment, load_filename=load_filename, orig_iface=orig_iface, coalesce_writes=coalesce_writes, max_capture_memory=max_capture_memory, spill_dir=spill_dir)
         if load_filename is None:
             self.setCanMode(CMD_CAN_MODE_CITM)
         
 
-    def genCanMsgsIso(self, start=0, stop=None, arbids=None):
+    def genCanMsgsIso(self, start=0, stop=None, arbids=None, start_time=None, stop_time=None):
         '''
         CAN message generator.  takes in start/stop indexes as well as a list
         of desired arbids (list). Uses the isolation messages.
+        see genCanMsgs() for start_time/stop_time
         '''
-        messages = self._messages.get(CMD_ISO_RECV, [])
-        if stop == None:
-            stop = len(messages)
-        else:
-            stop = stop + 1
-
-        for idx in xrange(start, stop):
-            ts, msg = messages[idx]
-
-            arbid, data = self._splitCanMsg(msg)
+        messages = self._messages.get(CMD_ISO_RECV)
+        if messages == None:
+            return
 
-            if arbids != None and arbid not in arbids:
-                # allow filtering of arbids
-                continue
+        start, stop = self._limitByTime(messages, start, stop, start_time, stop_time)
 
-            yield((idx, ts, arbid, data))
+        for msg in messages.genCanMsgs(start, stop, arbids):
+            yield msg
 
     def getCanMsgCountIso(self):
         '''
@@ -1393,43 +2815,18 @@ class CanInTheMiddleInterface(CanInterface):
 
         return arbid_list
 
-    def getSessionStatsIso(self, start=0, stop=None):
-        out = []
-        
-        arbid_list = self.getArbitrationIdsIso(start=start, stop=stop, reverse=True)
-
-        for datalen, arbid, msgs in arbid_list:
-            last = 0
-            high = 0
-            low = 0xffffffff
-            for ts, data in msgs:
-                if last == 0:
-                    last = ts
-                    continue
-
-                # calculate the high and low
-                delta = ts - last
-                if delta > high:
-                    high = delta
-                if delta < low:
-                    low = delta
-
-                # track repeated values (rounded to nearest .001 sec)
-                last = ts
+    def getArbidStatsIso(self, start=0, stop=None):
+        '''
+        returns { arbid : ArbidStats } for the isolation side messages
+        start through stop.  see getArbidStats()
+        '''
+        messages = self._messages.get(CMD_ISO_RECV)
+        if messages == None:
+            return {}
+        return messages.getArbidStats(start, stop)
 
-            if datalen > 1:
-                mean = (msgs[-1][0] - msgs[0][0]) / (datalen-1)
-                median = low + (high-low) / 2
-            else:
-                low = 0
-                mean = 0
-                median = mean
-            out.append("id: 0x%x\tcount: %d\ttiming::  mean: %.3f\tmedian: %.3f\thigh: %.3f\tlow: %.3f" % \
-                    (arbid, datalen, mean, median, high, low))
-
-        msg_count = self.getCanMsgCountIso()
-        out.append("Total Uniq IDs: %d\nTotal Messages: %d" % (len(arbid_list), msg_count))
-        return '\n'.join(out)
+    def getSessionStatsIso(self, start=0, stop=None):
+        return reprSessionStats(self.getArbidStatsIso(start, stop))
 
     # bookmark subsystem
     def placeCanBookmark(self, name=None, comment=None):
@@ -1506,7 +2903,7 @@ class CanInTheMiddleInterface(CanInterface):
         if stop_bkmk != None:
             stop_msg = self.getMsgIndexFromBookmarkIso(stop_bkmk)
         else:
-            stop_bkmk = -1
+            stop_msg = None
 
         if start_baseline_bkmk != None:
             start_baseline_msg = self.getMsgIndexFromBookmarkIso(start_baseline_bkmk)
@@ -1528,27 +2925,31 @@ class CanInTheMiddleInterface(CanInterface):
 
         for message indexes, you *will* want to look into the bookmarking subsystem!
         '''
+        return list(self._genFilteredCanMsgsIso(start_msg, stop_msg, start_baseline_msg, stop_baseline_msg, arbids, ignore))
+
+    def _genFilteredCanMsgsIso(self, start_msg=0, stop_msg=None, start_baseline_msg=None, stop_baseline_msg=None, arbids=None, ignore=[]):
         self.log("starting filtering messages...")
-        if stop_baseline_msg != None:
+        filter_ids = None
+        messages = self._messages.get(CMD_ISO_RECV)
+        if stop_baseline_msg != None and messages != None:
             self.log("ignoring arbids from baseline...")
-            # get a list of baseline arbids
-            filter_ids = { arbid:1 for ts,arbid,data in self.genCanMsgs(start_baseline_msg, stop_baseline_msg) 
-                }.keys()
-        else:
-            filter_ids = None
-        self.log("filtering messages...")
-        filteredMsgs = [(idx, ts,arbid,msg) for idx,ts,arbid,msg in self.genCanMsgsIso(start_msg, stop_msg, arbids=arbids) \
-                if (type(arbids) == list and arbid in arbids) or arbid not in ignore and (filter_ids==None or arbid not in filter_ids)]
+            # baseline arbids straight from the arbid index
+            filter_ids = set(messages.getArbidCounts(start_baseline_msg or 0, stop_baseline_msg))
 
-        return filteredMsgs
+        self.log("filtering messages...")
+        ignore = set(ignore)
+        for idx, ts, arbid, msg in self.genCanMsgsIso(start_msg, stop_msg, arbids=arbids):
+            if (type(arbids) == list and arbid in arbids) or arbid not in ignore and (filter_ids==None or arbid not in filter_ids):
+                yield idx, ts, arbid, msg
         
     def printCanMsgsByBookmarkIso(self, start_bkmk=None, stop_bkmk=None, start_baseline_bkmk=None, stop_baseline_bkmk=None, 
-                    arbids=None, ignore=[]):
-        print self.reprCanMsgsByBookmarkIso(start_bkmk, stop_bkmk, start_baseline_bkmk, stop_baseline_bkmk, arbids, ignore)
+                    arbids=None, ignore=[], out=None, pager=False):
+        writeLines(self.genReprCanMsgsByBookmarkIso(start_bkmk, stop_bkmk, start_baseline_bkmk, stop_baseline_bkmk, arbids, ignore), out, pager)
 
     def reprCanMsgsByBookmarkIso(self, start_bkmk=None, stop_bkmk=None, start_baseline_bkmk=None, stop_baseline_bkmk=None, arbids=None, ignore=[]):
-        out = []
+        return "\n".join(self.genReprCanMsgsByBookmarkIso(start_bkmk, stop_bkmk, start_baseline_bkmk, stop_baseline_bkmk, arbids, ignore))
 
+    def genReprCanMsgsByBookmarkIso(self, start_bkmk=None, stop_bkmk=None, start_baseline_bkmk=None, stop_baseline_bkmk=None, arbids=None, ignore=[]):
         if start_bkmk != None:
             start_msg = self.getMsgIndexFromBookmarkIso(start_bkmk)
         else:
@@ -1557,7 +2958,7 @@ class CanInTheMiddleInterface(CanInterface):
         if stop_bkmk != None:
             stop_msg = self.getMsgIndexFromBookmarkIso(stop_bkmk)
         else:
-            stop_bkmk = -1
+            stop_msg = None
 
         if start_baseline_bkmk != None:
             start_baseline_msg = self.getMsgIndexFromBookmarkIso(start_baseline_bkmk)
@@ -1569,10 +2970,14 @@ class CanInTheMiddleInterface(CanInterface):
         else:
             stop_baseline_msg = None
 
-        return self.reprCanMsgsIso(start_msg, stop_msg, start_baseline_msg, stop_baseline_msg, arbids, ignore)
+        return self.genReprCanMsgsIso(start_msg, stop_msg, start_baseline_msg, stop_baseline_msg, arbids, ignore)
 
-    def printCanMsgsIso(self, start_msg=0, stop_msg=None, start_baseline_msg=None, stop_baseline_msg=None, arbids=None, ignore=[]):
-        print self.reprCanMsgsIso(start_msg, stop_msg, start_baseline_msg, stop_baseline_msg, arbids, ignore)
+    def printCanMsgsIso(self, start_msg=0, stop_msg=None, start_baseline_msg=None, stop_baseline_msg=None, arbids=None, ignore=[], out=None, pager=False):
+        '''
+        Print a set of isolation side CAN Messages as they're worked out 
+        (see printCanMsgs())
+        '''
+        writeLines(self.genReprCanMsgsIso(start_msg, stop_msg, start_baseline_msg, stop_baseline_msg, arbids, ignore), out, pager)
 
     def reprCanMsgsIso(self, start_msg=0, stop_msg=None, start_baseline_msg=None, stop_baseline_msg=None, arbids=None, ignore=[]):
         '''
@@ -1584,91 +2989,23 @@ class CanInTheMiddleInterface(CanInterface):
 
         Many functions wrap this one.
         '''
-        out = []
+        return "\n".join(self.genReprCanMsgsIso(start_msg, stop_msg, start_baseline_msg, stop_baseline_msg, arbids, ignore))
 
+    def genReprCanMsgsIso(self, start_msg=0, stop_msg=None, start_baseline_msg=None, stop_baseline_msg=None, arbids=None, ignore=[]):
+        '''
+        reprCanMsgsIso(), a line at a time
+        '''
         if start_msg in self.bookmarks_iso:
             bkmk = self.bookmarks_iso.index(start_msg)
-            out.append("starting from bookmark %d: '%s'" % 
-                    (bkmk,
-                    self.bookmark_info_iso[bkmk].get('name'))
-                    )
+            yield "starting from bookmark %d: '%s'" % (bkmk, self.bookmark_info_iso[bkmk].get('name'))
 
         if stop_msg in self.bookmarks_iso:
             bkmk = self.bookmarks_iso.index(stop_msg)
-            out.append("stoppng at bookmark %d: '%s'" % 
-                    (bkmk,
-                    self.bookmark_info_iso[bkmk].get('name'))
-                    )
+            yield "stoppng at bookmark %d: '%s'" % (bkmk, self.bookmark_info_iso[bkmk].get('name'))
 
-        last_msg = None
-        next_bkmk = 0
-        next_bkmk_idx = 0
-
-        msg_count = 0
-        last_ts = None
-        tot_delta_ts = 0
-        counted_msgs = 0    # used for calculating averages, excluding outliers
-        
-        data_delta = None
-
-
-        data_repeat = 0
-        data_similar = 0
-
-        for idx, ts, arbid, msg in self.filterCanMsgsIso(start_msg, stop_msg, start_baseline_msg, stop_baseline_msg, arbids=arbids, ignore=ignore):
-            diff = []
-
-            # insert bookmark names/comments in appropriate places
-            while next_bkmk_idx < len(self.bookmarks_iso) and idx >= self.bookmarks_iso[next_bkmk_idx]:
-                out.append(self.reprBookmarkIso(next_bkmk_idx))
-                next_bkmk_idx += 1
-
-            msg_count += 1
-
-            # check data
-            byte_cnt_diff = 0
-            if last_msg != None:
-                if len(last_msg) == len(msg):
-                    for bidx in range(len(msg)):
-                        if last_msg[bidx] != msg[bidx]:
-                            byte_cnt_diff += 1
-
-                    if byte_cnt_diff == 0:
-                        diff.append("REPEAT")
-                        data_repeat += 1
-                    elif byte_cnt_diff <=4:
-                        diff.append("Similar")
-                        data_similar += 1
-                    # FIXME: make some better heuristic to identify "out of norm"
-
-            # look for ASCII data (4+ consecutive bytes)
-            if hasAscii(msg):
-                diff.append("ASCII: %s" % repr(msg))
-
-            # calculate timestamp delta and comment if out of whack
-            if last_ts == None:
-                last_ts = ts
-
-            delta_ts = ts - last_ts
-            if counted_msgs:
-                avg_delta_ts = tot_delta_ts / counted_msgs
-            else:
-                avg_delta_ts = delta_ts
-
-
-            if abs(delta_ts - avg_delta_ts) <= delta_ts:
-                tot_delta_ts += delta_ts
-                counted_msgs += 1
-            else:
-                diff.append("TS_delta: %.3f" % delta_ts)
-
-            out.append(reprCanMsg(idx, ts, arbid, msg, comment='\t'.join(diff)))
-            last_ts = ts
-            last_msg = msg
-
-        out.append("Total Messages: %d  (repeat: %d / similar: %d)" % (msg_count, data_repeat, data_similar))
-
-        return "\n".join(out)
+        msgs = genByteDiffs(self._genFilteredCanMsgsIso(start_msg, stop_msg, start_baseline_msg, stop_baseline_msg, arbids=arbids, ignore=ignore))
+        for line in genReprMsgLines(msgs, self.bookmarks_iso, self.reprBookmarkIso):
+            yield line
 
     def printCanSessionsIso(self, arbid_list=None):
         '''
@@ -1719,6 +3056,8 @@ class CanInTheMiddleInterface(CanInterface):
         if comment == None:
             return "bkmkidx: %d\tmsgidx: %d\tbkmk: %s" % (bid, msgidx, info.get('name'))
 
+        return "bkmkidx: %d\tmsgidx: %d\tbkmk: %s \tcomment: %s" % (bid, msgidx, info.get('name'), info.get('comment'))
+
     def restoreSession(self, me, force=False):
         '''
         Load a previous analysis session from a python dictionary object
@@ -1728,7 +3067,7 @@ class CanInTheMiddleInterface(CanInterface):
             print("Refusing to reload a session while active session!  use 'force=True' option")
             return
 
-        self._messages = me.get('messages')
+        self._restoreMessages(me.get('messages'))
         self.bookmarks = me.get('bookmarks')
         self.bookmark_info = me.get('bookmark_info')
         self.comments = me.get('comments')
@@ -1757,12 +3096,12 @@ class CanInTheMiddleInterface(CanInterface):
 cs = []
 
 def cleanupInteractiveAtExit():
-    global cs
-    for c in cs:
-        try:
-            c.__del__()
-        except:
-            pass
+    global c
+    try:
+        # shuts down the serial connection and flushes any journal
+        c.__del__()
+    except:
+        pass
 
 devlocs = [
         '/dev/ttyACM0',
@@ -1779,7 +3118,7 @@ def getDeviceFile():
         if os.path.exists(devloc):
             return devloc
 
-def interactive(port=None, InterfaceClass=CanInterface, intro='', load_filename=None, can_baud=None):
+def interactive(port=None, InterfaceClass=CanInterface, intro='', load_filename=None, can_baud=None, journal=None):
     global c
     import atexit
 
@@ -1787,6 +3126,9 @@ def interactive(port=None, InterfaceClass=CanInterface, intro='', load_filename=
     atexit.register(cleanupInteractiveAtExit)
 
     if load_filename is None:
+        if journal != None:
+            c.startJournal(journal)
+
         if can_baud != None:
             c.setCanBaud(can_baud)
         else:
@@ -0,0 +1,329 @@
+'''
+NumPy views of a capture, for analysis that would otherwise loop over
+every message in Python.
+
+    >>> a = c.toArrays()
+    >>> a.ts, a.arbid, a.dlc, a.data      # data is an N x 8 uint8 matrix
+    >>> a.data[a.arbid == 0x7e8]
+
+Requires numpy.  cancat works without it, CanInterface just falls back to
+the pure Python versions of what's here.
+'''
+import numpy
+
+# payload matrix columns (wider if the capture holds longer messages)
+DATA_WIDTH = 8
+
+
+class CanArrays:
+    '''
+    A stretch of CAN messages as NumPy arrays, one entry per message:
+        idx     - message index (int64)
+        ts      - timestamp (float64)
+        arbid   - arbitration id (uint32)
+        dlc     - data length (uint8)
+        data    - N x DATA_WIDTH uint8 payload matrix, zero padded past dlc
+    '''
+    def __init__(self, idx, ts, arbid, dlc, data):
+        self.idx = idx
+        self.ts = ts
+        self.arbid = arbid
+        self.dlc = dlc
+        self.data = data
+
+    def __len__(self):
+        return len(self.idx)
+
+    def __repr__(self):
+        return "<CanArrays: %d messages, %d arbids>" % (len(self), len(numpy.unique(self.arbid)))
+
+    def select(self, which):
+        '''
+        returns a new CanArrays with just the messages picked out by a
+        boolean mask or an array of positions
+        '''
+        return CanArrays(self.idx[which], self.ts[which], self.arbid[which],
+                self.dlc[which], self.data[which])
+
+    def byArbid(self):
+        '''
+        returns { arbid : CanArrays } (each still in message order)
+        '''
+        order = numpy.argsort(self.arbid, kind='mergesort')
+        arbids = self.arbid[order]
+        cuts = numpy.flatnonzero(arbids[1:] != arbids[:-1]) + 1
+        groups = {}
+        for positions in numpy.split(order, cuts):
+            if len(positions):
+                groups[int(self.arbid[positions[0]])] = self.select(positions)
+        return groups
+
+    def arbidCounts(self):
+        '''
+        returns { arbid : message count }
+        '''
+        arbids, counts = numpy.unique(self.arbid, return_counts=True)
+        return dict(zip(arbids.tolist(), counts.tolist()))
+
+    def dataStrings(self):
+        '''
+        returns the message data as a list of strings, like genCanMsgs()
+        '''
+        width = self.data.shape[1]
+        raw = self.data.tostring()
+        return [raw[pos:pos + dlc] for pos, dlc in zip(xrange(0, len(raw), width), self.dlc.tolist())]
+
+    def toMsgs(self):
+        '''
+        returns [(idx, ts, arbid, data), ...] like genCanMsgs() yields
+        '''
+        return zip(self.idx.tolist(), self.ts.tolist(), self.arbid.tolist(), self.dataStrings())
+
+
+def captureArrays(capture, start=0, stop=None):
+    '''
+    returns a CanArrays for messages start through stop (inclusive) of a
+    CanCapture.  the columns are copied, so the capture can carry on
+    growing underneath them.
+    '''
+    parts = []
+    for block, first, last in capture.genBlockRanges(start, stop):
+        lengths = numpy.frombuffer(block.lengths[first:last], numpy.uint8)
+        offsets = numpy.frombuffer(block.offsets[first:last], block.offsets.typecode).astype(numpy.int64)
+
+        # just the part of the payload blob these messages use
+        lo = block.payload_base
+        if len(offsets):
+            lo = int(offsets[0])
+        hi = block.payload_base + len(block.payload)
+        if last < len(block):
+            hi = block.offsets[last]
+        payload = numpy.frombuffer(block.payload[lo - block.payload_base:hi - block.payload_base], numpy.uint8)
+        offsets -= lo
+
+        parts.append((numpy.arange(block.start + first, block.start + last, dtype=numpy.int64),
+                numpy.frombuffer(block.timestamps[first:last], numpy.float64),
+                numpy.frombuffer(block.arbids[first:last], numpy.uint32),
+                lengths, offsets, payload))
+
+    if not parts:
+        return CanArrays(numpy.zeros(0, numpy.int64), numpy.zeros(0), numpy.zeros(0, numpy.uint32),
+                numpy.zeros(0, numpy.uint8), numpy.zeros((0, DATA_WIDTH), numpy.uint8))
+
+    width = max([DATA_WIDTH] + [int(part[3].max()) for part in parts if len(part[3])])
+    datas = []
+    for idx, ts, arbid, lengths, offsets, payload in parts:
+        data = numpy.zeros((len(idx), width), numpy.uint8)
+        for col in xrange(width):
+            have = lengths > col
+            data[have, col] = payload[offsets[have] + col]
+        datas.append(data)
+
+    return CanArrays(numpy.concatenate([part[0] for part in parts]),
+            numpy.concatenate([part[1] for part in parts]),
+            numpy.concatenate([part[2] for part in parts]),
+            numpy.concatenate([part[3] for part in parts]),
+            numpy.concatenate(datas))
+
+def filterMask(arrs, arbids=None, ignore=(), baseline_ids=None):
+    '''
+    boolean mask of the messages CanInterface.filterCanMsgs() keeps:
+    wanted arbids (an explicit list of arbids trumps ignore and the
+    baseline), minus ignored arbids and arbids seen in the baseline
+    '''
+    if arbids != None:
+        wanted = numpy.in1d(arrs.arbid, list(arbids))
+    else:
+        wanted = numpy.ones(len(arrs), bool)
+
+    if type(arbids) == list:
+        return wanted
+
+    drop = list(ignore)
+    if baseline_ids != None:
+        drop.extend(baseline_ids)
+    if drop:
+        wanted &= ~numpy.in1d(arrs.arbid, drop)
+    return wanted
+
+def byteDiffCounts(arrs):
+    '''
+    for each message, how many data bytes differ from the message before
+    it (-1 for the first message, or if the lengths differ)
+    '''
+    counts = numpy.full(len(arrs), -1, numpy.int32)
+    if len(arrs) > 1:
+        diffs = (arrs.data[1:] != arrs.data[:-1]).sum(axis=1)
+        same_len = arrs.dlc[1:] == arrs.dlc[:-1]
+        counts[1:][same_len] = diffs[same_len]
+    return counts
+
+
+class GapTiming:
+    '''
+    exact inter-arrival gap stats for one arbid, with the same interface
+    as stats.ArbidStats (so reprSessionStats() can show either)
+    '''
+    def __init__(self, ts):
+        self.count = len(ts)
+        self.first_ts = self.last_ts = None
+        if self.count:
+            self.first_ts = float(ts[0])
+            self.last_ts = float(ts[-1])
+
+        self._gaps = numpy.diff(ts)
+        self.gap_min = self.gap_max = 0.0
+        if len(self._gaps):
+            self.gap_min = float(self._gaps.min())
+            self.gap_max = float(self._gaps.max())
+
+    def gaps(self):
+        return len(self._gaps)
+
+    def mean(self):
+        if not len(self._gaps):
+            return 0.0
+        return float(self._gaps.mean())
+
+    def stddev(self):
+        if len(self._gaps) < 2:
+            return 0.0
+        return float(self._gaps.std(ddof=1))
+
+    def quantile(self, q):
+        if not len(self._gaps):
+            return None
+        return float(numpy.percentile(self._gaps, q * 100, interpolation='lower'))
+
+def sessionStats(arrs):
+    '''
+    returns { arbid : GapTiming } with exact (not sketched) percentiles
+    '''
+    return dict([(arbid, GapTiming(group.ts)) for arbid, group in arrs.byArbid().items()])
+
+
+class ByteChanges:
+    '''
+    How one arbid's payload changes from message to message:
+        count       - messages
+        ts          - their timestamps
+        xor         - (count-1) x width: each payload XOR the one before it
+                      (zero where either message is too short for the byte)
+        toggles     - width x 8: how often each bit flipped ([byte, bit],
+                      bit 0 is the least significant)
+        changes     - per byte: how many messages changed it
+        seen        - width x 256 bool: the values each byte has held
+        distinct    - per byte: how many different values it has held
+        present     - per byte: how many messages are long enough to have it
+    '''
+    def __init__(self, arbid, ts, xor, seen, present):
+        self.arbid = arbid
+        self.count = len(ts)
+        self.ts = ts
+        self.xor = xor
+        self.seen = seen
+        self.present = present
+        self.width = xor.shape[1]
+
+        self.toggles = numpy.zeros((self.width, 8), numpy.int64)
+        for bit in xrange(8):
+            self.toggles[:, bit] = ((xor >> bit) & 1).sum(axis=0)
+        self.changes = (xor != 0).sum(axis=0)
+        self.distinct = seen.sum(axis=1)
+
+    def __repr__(self):
+        return "<ByteChanges 0x%x: %d messages, %d live bits>" % (self.arbid, self.count, len(self.liveBits()))
+
+    def changeTimes(self, byte, bit=None):
+        '''
+        returns the timestamps of the messages that changed a byte (or just
+        one bit of it)
+        '''
+        changed = self.xor[:, byte]
+        if bit != None:
+            changed = changed & (1 << bit)
+        return self.ts[1:][changed != 0]
+
+    def toggleRates(self):
+        '''
+        width x 8 float array: the fraction of messages flipping each bit
+        '''
+        if self.count < 2:
+            return numpy.zeros(self.toggles.shape)
+        return self.toggles / float(self.count - 1)
+
+    def liveBits(self):
+        '''
+        returns [(byte, bit), ...] for every bit that ever flipped
+        '''
+        return [(int(byte), int(bit)) for byte, bit in zip(*numpy.nonzero(self.toggles))]
+
+def byteChanges(arrs):
+    '''
+    returns { arbid : ByteChanges } for a CanArrays.  all arbids are worked
+    out together: the messages are grouped by arbid (in order) and each is
+    XORed with the one before it, so there's no Python loop per message.
+    '''
+    if not len(arrs):
+        return {}
+
+    order = numpy.argsort(arrs.arbid, kind='mergesort')
+    arbid = arrs.arbid[order]
+    data = arrs.data[order]
+    dlc = arrs.dlc[order]
+    width = data.shape[1]
+    cols = numpy.arange(width)
+
+    # XOR each message with the previous one, where both have the byte
+    # (the first message of each arbid has nothing to compare to)
+    xor = data[1:] ^ data[:-1]
+    xor[(numpy.minimum(dlc[1:], dlc[:-1])[:, None] <= cols)] = 0
+    xor[arbid[1:] != arbid[:-1]] = 0
+
+    starts = numpy.concatenate(([0], numpy.flatnonzero(arbid[1:] != arbid[:-1]) + 1))
+    stops = numpy.concatenate((starts[1:], [len(arbid)]))
+
+    # which values each byte of each arbid has held
+    group = numpy.zeros(len(arbid), numpy.int64)
+    group[starts[1:]] = 1
+    group = group.cumsum()
+    has_byte = dlc[:, None] > cols
+    rows, byte_cols = numpy.nonzero(has_byte)
+    seen = numpy.zeros((len(starts), width, 256), bool)
+    seen[group[rows], byte_cols, data[rows, byte_cols]] = True
+    present = numpy.add.reduceat(has_byte.astype(numpy.int64), starts, axis=0)
+
+    changes = {}
+    for gidx, (start, stop) in enumerate(zip(starts.tolist(), stops.tolist())):
+        this_arbid = int(arbid[start])
+        # xor row i compares message i+1 with message i
+        changes[this_arbid] = ByteChanges(this_arbid, arrs.ts[order[start:stop]],
+                xor[start:stop - 1], seen[gidx], present[gidx])
+    return changes
+
+def novelMask(arrs, baseline, values=True):
+    '''
+    boolean mask of the messages with something a baseline.Baseline never
+    saw: an arbid, or (if values) a byte position or a byte value
+    '''
+    known = numpy.array(sorted(baseline.values), numpy.uint32)
+    if not len(known) or not len(arrs):
+        return numpy.ones(len(arrs), bool)
+
+    pos = numpy.searchsorted(known, arrs.arbid).clip(0, len(known) - 1)
+    novel = known[pos] != arrs.arbid
+    if not values:
+        return novel
+
+    # seen[pos, byte, value]: bytes past an arbid's longest baseline
+    # message stay all False, so they show up as novel too
+    width = arrs.data.shape[1]
+    seen = numpy.zeros((len(known), width, 256), bool)
+    for row, arbid in enumerate(known.tolist()):
+        for byte, bitmap in enumerate(baseline.values[arbid][:width]):
+            seen[row, byte] = numpy.frombuffer(str(bitmap), numpy.uint8)
+
+    for byte in xrange(width):
+        have = (arrs.dlc > byte) & ~novel
+        novel[have] = ~seen[pos[have], byte, arrs.data[have, byte]]
+    return novel
@@ -0,0 +1,120 @@
+'''
+Baselines: what the bus looked like while nothing interesting was going on.
+
+A Baseline records, for a stretch of capture (say between two bookmarks),
+every arbid seen and, for every byte of every arbid, which of the 256
+values it held.  Once built it can be held up against any number of
+other stretches, flagging messages with something the baseline never had:
+    NOVEL_ARBID     - an arbid it never saw
+    NOVEL_BYTE      - a message longer than any it saw for that arbid
+    NOVEL_VALUE     - a byte value it never saw in that position
+
+    >>> base = c.makeBaselineByBookmark(0, 1)
+    >>> c.printNovelMsgsByBookmark(base, 1, 2)
+'''
+
+NOVEL_ARBID = 'arbid'
+NOVEL_BYTE = 'byte'
+NOVEL_VALUE = 'value'
+
+
+class Baseline:
+    '''
+    arbids  - set of arbids seen
+    values  - { arbid : [bitmap, ...] }, a bitmap per byte position: a
+              bytearray(256) with a 1 for each value seen there
+    count   - messages the baseline was built from
+    '''
+    def __init__(self, msgs=()):
+        self.arbids = set()
+        self.values = {}
+        self.count = 0
+        self.update(msgs)
+
+    def __repr__(self):
+        return "<Baseline: %d messages, %d arbids>" % (self.count, len(self.arbids))
+
+    def update(self, msgs):
+        '''
+        add (idx, ts, arbid, data) messages to the baseline
+        '''
+        values = self.values
+        count = 0
+        for idx, ts, arbid, data in msgs:
+            count += 1
+            seen = values.get(arbid)
+            if seen is None:
+                seen = values[arbid] = []
+                self.arbids.add(arbid)
+            while len(seen) < len(data):
+                seen.append(bytearray(256))
+            for byte, value in enumerate(bytearray(data)):
+                seen[byte][value] = 1
+        self.count += count
+
+    def updateByteChanges(self, byte_changes):
+        '''
+        add the values recorded in { arbid : arrays.ByteChanges } (the quick
+        way to build a baseline if numpy is around)
+        '''
+        for arbid, changes in byte_changes.items():
+            seen = self.values.get(arbid)
+            if seen is None:
+                seen = self.values[arbid] = []
+                self.arbids.add(arbid)
+
+            width = len([present for present in changes.present.tolist() if present])
+            while len(seen) < width:
+                seen.append(bytearray(256))
+            for byte in range(width):
+                bitmap = bytearray(changes.seen[byte].astype('uint8').tostring())
+                for value in range(256):
+                    seen[byte][value] |= bitmap[value]
+            self.count += changes.count
+
+    def novelty(self, arbid, data):
+        '''
+        returns None if the baseline has seen everything in this message,
+        otherwise (NOVEL_ARBID/NOVEL_BYTE/NOVEL_VALUE, byte, value) for the
+        first thing it hasn't
+        '''
+        seen = self.values.get(arbid)
+        if seen is None:
+            return (NOVEL_ARBID, None, None)
+
+        data = bytearray(data)
+        if len(data) > len(seen):
+            return (NOVEL_BYTE, len(seen), data[len(seen)])
+
+        for byte, value in enumerate(data):
+            if not seen[byte][value]:
+                return (NOVEL_VALUE, byte, value)
+        return None
+
+    def genNovel(self, msgs, values=True):
+        '''
+        yields (idx, ts, arbid, data, novelty) for each message with an arbid
+        (or, if values, a length or byte value) the baseline hasn't seen
+        '''
+        arbids = self.arbids
+        novelty = self.novelty
+        for idx, ts, arbid, data in msgs:
+            if arbid not in arbids:
+                yield idx, ts, arbid, data, (NOVEL_ARBID, None, None)
+            elif values:
+                novel = novelty(arbid, data)
+                if novel is not None:
+                    yield idx, ts, arbid, data, novel
+
+def reprNovelty(novelty):
+    '''
+    short description of a Baseline.novelty() result
+    '''
+    if novelty == None:
+        return ''
+    kind, byte, value = novelty
+    if kind == NOVEL_ARBID:
+        return "new arbid"
+    if kind == NOVEL_BYTE:
+        return "new length (byte %d)" % byte
+    return "byte %d: new value 0x%.2x" % (byte, value)
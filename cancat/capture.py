@@ -0,0 +1,1330 @@
+import zlib
+import heapq
+import struct
+import bisect
+import tempfile
+import threading
+import itertools
+from array import array
+
+from cancat.stats import ArbidStats, STATS_CHUNK, mergeStats, packStats, unpackStats, statsMemory
+
+# bytes of column storage per message, not counting the data itself:
+# timestamp (d) + arbid (I) + length (B) + offset (L)
+FRAME_OVERHEAD = 8 + 4 + 1 + 8
+
+# bytes of arbid index per message (an 'i' position).  only the live
+# block's part of the index is kept in memory, spilled blocks take theirs
+INDEX_OVERHEAD = 4
+
+# arbid filters matching more than 1/INDEX_SCAN_RATIO of the messages in
+# range just scan them all, instead of merging per-arbid index entries
+INDEX_SCAN_RATIO = 4
+
+# extendFrames() checks the memory budget every SPILL_CHECK messages
+SPILL_CHECK = 1024
+
+
+def packIndex(index):
+    '''
+    pack a { arbid : array('i') of message indexes } slice of the arbid
+    index into a string: '<I' arbid count, '<II' arbid, message count for
+    each, then the message indexes of each arbid in turn
+    '''
+    arbids = sorted(index)
+    parts = [struct.pack('<I', len(arbids))]
+    parts.append(struct.pack('<%dI' % (2 * len(arbids)),
+            *[item for arbid in arbids for item in (arbid, len(index[arbid]))]))
+    parts.extend([index[arbid].tostring() for arbid in arbids])
+    return ''.join(parts)
+
+def indexCounts(data, pos=0):
+    '''
+    returns { arbid : message count } for the packIndex() string at pos
+    in data, without reading the message indexes
+    '''
+    count, = struct.unpack_from('<I', data, pos)
+    items = struct.unpack_from('<%dI' % (2 * count), data, pos + 4)
+    return dict(zip(items[::2], items[1::2]))
+
+def unpackIndex(data, pos=0):
+    '''
+    returns the { arbid : array('i') } packIndex() packed into data at pos
+    '''
+    index = {}
+    count, = struct.unpack_from('<I', data, pos)
+    pos += 4
+    items = struct.unpack_from('<%dI' % (2 * count), data, pos)
+    pos += 8 * count
+    for arbid, msgs in zip(items[::2], items[1::2]):
+        index[arbid] = array('i', data[pos:pos + 4 * msgs])
+        pos += 4 * msgs
+    return index
+
+def _isOrdered(timestamps):
+    '''
+    is no timestamp earlier than the one before it?
+    '''
+    return all(itertools.imap(float.__le__, timestamps, itertools.islice(timestamps, 1, None)))
+
+def _scanTime(timestamps, ts, after):
+    '''
+    returns the position of the first timestamp at or after ts (strictly
+    after, if after=True), or len(timestamps), for timestamps out of order
+    '''
+    for pos, stamp in enumerate(timestamps):
+        if stamp > ts or (stamp == ts and not after):
+            return pos
+    return len(timestamps)
+
+def _positionRange(positions, first, last):
+    '''
+    returns (lo, hi): positions[lo:hi] are the ones from first up to last
+    '''
+    lo = bisect.bisect_left(positions, first)
+    return lo, bisect.bisect_left(positions, last, lo)
+
+
+class CaptureBlock:
+    '''
+    A contiguous run of messages stored column-wise:
+        timestamps  - float64
+        arbids      - uint32 (decoded once, when the message arrives)
+        lengths     - uint8
+        offsets     - where each message's data starts in the payload blob
+        payload     - one bytearray holding all message data
+
+    self.start is the message index of the first message in the block.
+    self.ordered is False once a timestamp earlier than the one before it
+    has been added (the block can't be searched by time with a bisect).
+    '''
+    def __init__(self, start=0):
+        self.start = start
+        self.ordered = True
+        self.timestamps = array('d')
+        self.arbids = array('I')
+        self.lengths = array('B')
+        self.offsets = array('L')
+        self.payload = bytearray()
+        # offset of payload[0] (grows as messages are popped off the front)
+        self.payload_base = 0
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def appendFrame(self, ts, arbid, data):
+        self.arbids.append(arbid)
+        self.lengths.append(len(data))
+        self.offsets.append(self.payload_base + len(self.payload))
+        self.payload.extend(data)
+        # the block's length is its timestamps', so the message only counts
+        # once everything else is there
+        self.timestamps.append(ts)
+
+    def getFrame(self, pos):
+        '''
+        returns (timestamp, arbid, data) for the message at position pos
+        within this block
+        '''
+        offset = self.offsets[pos] - self.payload_base
+        data = str(self.payload[offset:offset + self.lengths[pos]])
+        return self.timestamps[pos], self.arbids[pos], data
+
+    def genFrames(self, first, last, arbids=None):
+        '''
+        yields (idx, ts, arbid, data) for block positions first up to
+        (not including) last
+        '''
+        timestamps = self.timestamps
+        msgarbids = self.arbids
+        lengths = self.lengths
+        offsets = self.offsets
+        payload = self.payload
+        base = self.payload_base
+        start = self.start
+
+        for pos in xrange(first, last):
+            arbid = msgarbids[pos]
+            if arbids != None and arbid not in arbids:
+                # allow filtering of arbids
+                continue
+
+            offset = offsets[pos] - base
+            yield (start + pos, timestamps[pos], arbid, str(payload[offset:offset + lengths[pos]]))
+
+    def genPayloadMatches(self, regex, first, last):
+        '''
+        runs a compiled regex (see cancat/search.py) over the payload blob
+        of block positions first up to (not including) last, and yields
+        (idx, arbid, offset, pattern_num, length) for each match lying
+        within one message
+        '''
+        if first >= last:
+            return
+
+        offsets = self.offsets
+        lengths = self.lengths
+        base = self.payload_base
+        lo = offsets[first] - base
+        hi = offsets[last - 1] + lengths[last - 1] - base
+
+        for match in regex.finditer(self.payload, lo, hi):
+            pos = match.start() + base
+            length = len(match.group(match.lastindex))
+            # the message this starts in (the last one starting at or before)
+            msgpos = bisect.bisect_right(offsets, pos, first, last) - 1
+            offset = pos - offsets[msgpos]
+            if offset + length <= lengths[msgpos]:
+                yield (self.start + msgpos, self.arbids[msgpos], offset, match.lastindex - 1, length)
+
+    def genPayloadRuns(self, regex, minlen, first, last):
+        '''
+        runs a compiled regex for runs of bytes (see search.asciiRegex())
+        over the payload blob of block positions first up to (not
+        including) last.  runs are cut at message boundaries, and yields
+        (idx, arbid, offset, text) for each piece at least minlen long
+        '''
+        if first >= last:
+            return
+
+        offsets = self.offsets
+        lengths = self.lengths
+        payload = self.payload
+        base = self.payload_base
+        lo = offsets[first] - base
+        hi = offsets[last - 1] + lengths[last - 1] - base
+
+        for match in regex.finditer(payload, lo, hi):
+            pos = match.start() + base
+            end = match.end() + base
+            msgpos = bisect.bisect_right(offsets, pos, first, last) - 1
+            while msgpos < last and offsets[msgpos] < end:
+                msgstart = offsets[msgpos]
+                runstart = max(pos, msgstart)
+                runend = min(end, msgstart + lengths[msgpos])
+                if runend - runstart >= minlen:
+                    yield (self.start + msgpos, self.arbids[msgpos], runstart - msgstart,
+                            str(payload[runstart - base:runend - base]))
+                msgpos += 1
+
+    def memoryUsed(self):
+        return len(self.timestamps) * FRAME_OVERHEAD + len(self.payload)
+
+    def popleft(self):
+        '''
+        Destructive: removes the first message, returning (ts, arbid, data)
+        '''
+        frame = self.getFrame(0)
+        length = self.lengths[0]
+
+        del self.timestamps[0]
+        del self.arbids[0]
+        del self.lengths[0]
+        del self.offsets[0]
+        del self.payload[:length]
+        self.payload_base += length
+
+        return frame
+
+    def split(self, count):
+        '''
+        returns two new blocks: the first "count" messages and the rest.
+        this block is left untouched (so readers using it aren't disturbed)
+        '''
+        head = CaptureBlock(self.start)
+        tail = CaptureBlock(self.start + count)
+
+        if count < len(self):
+            cut = self.offsets[count] - self.payload_base
+        else:
+            cut = len(self.payload)
+
+        head.timestamps = self.timestamps[:count]
+        head.arbids = self.arbids[:count]
+        head.lengths = self.lengths[:count]
+        head.offsets = self.offsets[:count]
+        head.payload = self.payload[:cut]
+        head.payload_base = self.payload_base
+
+        tail.timestamps = self.timestamps[count:]
+        tail.arbids = self.arbids[count:]
+        tail.lengths = self.lengths[count:]
+        tail.offsets = self.offsets[count:]
+        tail.payload = self.payload[cut:]
+        tail.payload_base = self.payload_base + cut
+
+        if not self.ordered:
+            head.ordered = _isOrdered(head.timestamps)
+            tail.ordered = _isOrdered(tail.timestamps)
+
+        return head, tail
+
+    def columnStrings(self):
+        '''
+        the raw column data, in on-disk order
+        '''
+        return (self.timestamps.tostring(),
+                self.arbids.tostring(),
+                self.lengths.tostring(),
+                self.offsets.tostring(),
+                str(self.payload))
+
+    def loadColumnStrings(self, columns, payload_base):
+        timestamps, arbids, lengths, offsets, payload = columns
+        self.timestamps.fromstring(timestamps)
+        self.arbids.fromstring(arbids)
+        self.lengths.fromstring(lengths)
+        self.offsets.fromstring(offsets)
+        self.payload.extend(payload)
+        self.payload_base = payload_base
+
+
+class SpilledBlock:
+    '''
+    Where a CaptureBlock that's been written out to disk lives:
+    its message range, time range and the file position of each column.
+    first_ts/last_ts are its first and last message's timestamps, max_ts
+    the latest of them all (last_ts, if ordered, see CaptureBlock).
+
+    source is None for blocks in the capture's own spill file, or the 
+    mmap of a session file the block was loaded from (see CanCapture.attach())
+
+    packed_size is None if the columns are stored as they are, otherwise
+    they're zlib compressed together into packed_size bytes
+
+    The block's slice of the arbid index is stored alongside (see
+    setIndex()): only how many messages each arbid has in the block is
+    kept in memory.
+    '''
+    def __init__(self, start, count, first_ts, last_ts, payload_base, pos, sizes, source=None, packed_size=None, 
+            max_ts=None, ordered=True):
+        self.start = start
+        self.count = count
+        self.first_ts = first_ts
+        self.last_ts = last_ts
+        if max_ts == None:
+            max_ts = last_ts
+        self.max_ts = max_ts
+        self.ordered = ordered
+        self.payload_base = payload_base
+        self.pos = pos
+        self.sizes = sizes
+        self.source = source
+        self.packed_size = packed_size
+
+        self.index_pos = None
+        self.index_size = 0
+        self.index_packed = False
+        # sorted arbids in the block, and their message counts
+        self.index_arbids = array('I')
+        self.index_counts = array('I')
+
+    def setIndex(self, pos, size, counts, packed=False):
+        '''
+        the block's slice of the arbid index (see packIndex()) is stored in
+        size bytes at pos, zlib compressed if packed.  counts is
+        { arbid : message count } for the block
+        '''
+        self.index_pos = pos
+        self.index_size = size
+        self.index_packed = packed
+        arbids = sorted(counts)
+        self.index_arbids = array('I', arbids)
+        self.index_counts = array('I', [counts[arbid] for arbid in arbids])
+
+    def arbidCount(self, arbid):
+        arbids = self.index_arbids
+        pos = bisect.bisect_left(arbids, arbid)
+        if pos < len(arbids) and arbids[pos] == arbid:
+            return self.index_counts[pos]
+        return 0
+
+    def unpackIndex(self, data):
+        '''
+        returns { arbid : array of message indexes } from the index_size
+        bytes stored for the block's index
+        '''
+        if self.index_packed:
+            data = zlib.decompress(data)
+        return unpackIndex(data)
+
+    def memoryUsed(self):
+        return 4 * (len(self.index_arbids) + len(self.index_counts))
+
+    def size(self):
+        '''
+        bytes stored
+        '''
+        if self.packed_size != None:
+            return self.packed_size
+        return sum(self.sizes)
+
+    def unpack(self, data):
+        '''
+        split the size() bytes stored for the block into its columns
+        '''
+        if self.packed_size != None:
+            data = zlib.decompress(data)
+
+        columns = []
+        pos = 0
+        for size in self.sizes:
+            columns.append(data[pos:pos + size])
+            pos += size
+        return columns
+
+
+class SpilledStats:
+    '''
+    Where a finished stats chunk is kept, packed (see stats.packStats()):
+    size bytes at pos in source, which is a session file's mmap, the
+    packed string itself, or None for the capture's spill file
+    '''
+    def __init__(self, pos, size, source=None):
+        self.pos = pos
+        self.size = size
+        self.source = source
+
+
+class CanCapture:
+    '''
+    Columnar storage for received CAN messages (the CMD_CAN_RECV mailbox).
+
+    Messages are stored in CaptureBlocks (see above) instead of as one
+    (timestamp, raw_string) tuple each.  New messages go into the live
+    block at the end.
+
+    With max_memory set (bytes), the capture has a fixed memory budget:
+    whenever the live block (and its part of the arbid index) grows past
+    what's left of it, its older half is written out to a spill file
+    (spill_filename, or an anonymous temp file in spill_dir) and read back
+    on demand.  Message indexes never change, so genCanMsgs(), bookmarks
+    and getCanMsgCount() don't know the difference.  What's left is
+    max_memory less what else stays in memory (the open stats chunk, and
+    the arbid counts of spilled blocks), but never under a quarter of it.
+
+    An index of where each arbid's messages are (arbid -> sorted array of
+    message indexes) is kept up to date as messages arrive, so arbid
+    filtered iteration, counts and first/last lookups only cost as much as
+    the messages they find.  The live block's part of it is in memory (4
+    bytes per message), spilled blocks write theirs out with them and keep
+    a message count per arbid, reading it back if a lookup needs more.
+
+    Per-arbid timing stats (cancat/stats.py) are kept the same way, one set
+    per STATS_CHUNK messages.  getArbidStats() answers any range by merging
+    the chunks inside it and only reads the messages at the ragged ends.
+    Only the open chunk is kept as ArbidStats: finished ones are packed
+    (stats.packStats()) into the spill file, or kept packed in memory (a
+    twentieth of the size or so) if there's no budget.
+
+    Timestamps are stored as they came, even one earlier than the message
+    before it (the system clock got set back).  Time lookups 
+    (getIndexAtTime()) go by the latest timestamp so far, which never goes
+    backwards: a binary search for the block, and within it, unless the
+    block has a step back in it.  Those get scanned.
+
+    For backwards compatibility it quacks like the old mailbox lists:
+    append()/extend() take (timestamp, raw_message) tuples and capture[idx]
+    and iteration return them.
+    '''
+    def __init__(self, messages=None, max_memory=None, spill_filename=None, spill_dir=None):
+        self.max_memory = max_memory
+        self.spill_filename = spill_filename
+        self.spill_dir = spill_dir
+
+        self._live = CaptureBlock()
+        self._spilled = []
+        self._spilled_starts = []
+        # latest timestamp up to the end of each spilled block
+        self._spilled_max_ts = []
+        self._spill = None
+        self._spill_lock = threading.Lock()
+        self._cache = (None, None)
+        # mmaps of session files holding attached blocks
+        self._sources = []
+
+        # arbid -> array of positions (message index + self._popped) of
+        # the live block's messages.  spilled blocks have their own slices
+        self._arbid_index = {}
+        # every arbid there's been
+        self._arbids = set()
+        self._index_cache = (None, None)
+        self._popped = 0
+        # the last message's timestamp, to spot one going backwards
+        self._last_ts = None
+        # { arbid : ArbidStats } for each STATS_CHUNK positions, or a
+        # SpilledStats once it's finished
+        self._stats_chunks = []
+        self._stats_chunk = None
+        # memory the open stats chunk is expected to use, and what's kept
+        # of the spilled blocks: the live block gets max_memory less these
+        self._stats_reserved = 0
+        self._spilled_memory = 0
+
+        if messages != None:
+            self.extend(messages)
+
+    def __len__(self):
+        live = self._live
+        return live.start + len(live)
+
+    def __getitem__(self, idx):
+        '''
+        returns (timestamp, raw_message) like the old list-based mailbox
+        '''
+        ts, arbid, data = self.getFrame(idx)
+        return ts, struct.pack(">I", arbid) + data
+
+    def append(self, message):
+        '''
+        add a (timestamp, raw_message) tuple, where raw_message is 4 bytes
+        of arbid followed by the data, as received from the CanCat transceiver
+        '''
+        ts, msg = message
+        arbid = struct.unpack(">I", msg[:4])[0]
+        self.appendFrame(ts, arbid, msg[4:])
+
+    def appendFrame(self, ts, arbid, data):
+        '''
+        add an already split message
+        '''
+        live = self._live
+        if self._last_ts != None and ts < self._last_ts:
+            live.ordered = False
+        self._last_ts = ts
+
+        # the index and stats first: once the message is in the live block
+        # it counts (len(self)), and a reader (eg. a save) can expect them
+        pos = live.start + len(live) + self._popped
+        positions = self._arbid_index.get(arbid)
+        if positions == None:
+            positions = array('i')
+            self._arbid_index[arbid] = positions
+            self._arbids.add(arbid)
+        positions.append(pos)
+
+        if not pos % STATS_CHUNK:
+            self._newStatsChunk()
+        stats = self._stats_chunk.get(arbid)
+        # "is", not "==": comparing an instance to None is slow, and this
+        # runs for every message
+        if stats is None:
+            stats = ArbidStats()
+            self._stats_chunk[arbid] = stats
+        stats.add(ts)
+
+        live.appendFrame(ts, arbid, data)
+        if self.max_memory != None and self._overBudget(live):
+            self._spillOldest()
+
+    def extendFrames(self, frames):
+        '''
+        add already split (timestamp, arbid, data) messages from an iterable
+        (eg. a log being imported), returning how many there were.  the same
+        as appendFrame() for each, just quicker
+        '''
+        count = 0
+        last_ts = self._last_ts
+        index = self._arbid_index
+        chunk = self._stats_chunk
+        max_memory = self.max_memory
+
+        live = self._live
+        timestamps, arbids, lengths, offsets, payload = \
+                live.timestamps, live.arbids, live.lengths, live.offsets, live.payload
+        pos = len(self) + self._popped
+        for ts, arbid, data in frames:
+            if last_ts is not None and ts < last_ts:
+                live.ordered = False
+            last_ts = ts
+
+            # in appendFrame()'s order: the message counts once its
+            # timestamp is in
+            positions = index.get(arbid)
+            if positions is None:
+                positions = array('i')
+                index[arbid] = positions
+                self._arbids.add(arbid)
+            positions.append(pos)
+
+            if not pos % STATS_CHUNK:
+                self._newStatsChunk()
+                chunk = self._stats_chunk
+            stats = chunk.get(arbid)
+            if stats is None:
+                stats = ArbidStats()
+                chunk[arbid] = stats
+            stats.add(ts)
+
+            arbids.append(arbid)
+            lengths.append(len(data))
+            offsets.append(live.payload_base + len(payload))
+            payload.extend(data)
+            timestamps.append(ts)
+
+            pos += 1
+            count += 1
+            if max_memory is not None and not count % SPILL_CHECK and self._overBudget(live):
+                self._last_ts = last_ts
+                self._spillOldest()
+                index = self._arbid_index
+                live = self._live
+                timestamps, arbids, lengths, offsets, payload = \
+                        live.timestamps, live.arbids, live.lengths, live.offsets, live.payload
+
+        self._last_ts = last_ts
+        if max_memory is not None and self._overBudget(live):
+            self._spillOldest()
+        return count
+
+    def extend(self, messages):
+        '''
+        add a list of (timestamp, raw_message) tuples (eg. an old mailbox)
+        '''
+        for message in messages:
+            self.append(message)
+
+    def getFrame(self, idx):
+        '''
+        returns (timestamp, arbid, data) for one message
+        '''
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("message index out of range: %r" % idx)
+
+        block = self._getBlock(idx)
+        return block.getFrame(idx - block.start)
+
+    def popleft(self):
+        '''
+        Warning: Destructive:
+            removes the first message and returns (timestamp, raw_message).
+            All message indexes shift down by one.
+        '''
+        if self._spilled:
+            raise Exception("Can't remove messages from a capture that has spilled to disk")
+
+        ts, arbid, data = self._live.popleft()
+
+        # it was the oldest message, so it's first in its index entry
+        positions = self._arbid_index[arbid]
+        del positions[0]
+        if not len(positions):
+            del self._arbid_index[arbid]
+            self._arbids.discard(arbid)
+        self._popped += 1
+
+        return ts, struct.pack(">I", arbid) + data
+
+    def genCanMsgs(self, start=0, stop=None, arbids=None):
+        '''
+        CAN message generator.  yields (idx, ts, arbid, data) for messages
+        start through stop (inclusive, like CanInterface.genCanMsgs)
+        '''
+        count = len(self)
+        if stop == None:
+            stop = count
+        else:
+            stop = min(stop + 1, count)
+
+        if arbids != None:
+            wanted = set(arbids)
+            matches = sum([self._arbidCount(arbid, start, stop) for arbid in wanted])
+            if matches * INDEX_SCAN_RATIO < stop - start:
+                for msg in self._genIndexed(wanted, start, stop):
+                    yield msg
+                return
+
+        for block, first, last in self._genBlockRanges(start, stop):
+            for msg in block.genFrames(first, last, arbids):
+                yield msg
+
+    def genPayloadMatches(self, regex, start=0, stop=None):
+        '''
+        yields (idx, arbid, offset, pattern_num, length) for matches of a
+        compiled regex (see cancat/search.py) within the data of messages
+        start through stop.  the regex runs over each block's payload blob,
+        not message by message.
+        '''
+        for block, first, last in self.genBlockRanges(start, stop):
+            for match in block.genPayloadMatches(regex, first, last):
+                yield match
+
+    def genPayloadRuns(self, regex, minlen, start=0, stop=None):
+        '''
+        yields (idx, arbid, offset, text) for the runs a compiled regex finds
+        in the data of messages start through stop, cut at message 
+        boundaries and at least minlen long (see CaptureBlock.genPayloadRuns())
+        '''
+        for block, first, last in self.genBlockRanges(start, stop):
+            for run in block.genPayloadRuns(regex, minlen, first, last):
+                yield run
+
+    def genBlockRanges(self, start=0, stop=None):
+        '''
+        yields (block, first, last) for the CaptureBlocks holding messages
+        start through stop (inclusive): block positions first up to (not 
+        including) last.  For code working on the columns directly.
+        '''
+        start, stop = self._indexRange(start, stop)
+        return self._genBlockRanges(start, stop)
+
+    def _genBlockRanges(self, start, stop):
+        idx = start
+        while idx < stop:
+            block = self._getBlock(idx)
+            last = min(stop, block.start + len(block))
+            yield block, idx - block.start, last - block.start
+            idx = last
+
+    def _genIndexed(self, arbids, start, stop):
+        '''
+        yields (idx, ts, arbid, data) for arbids' messages start up to (not
+        including) stop, in message order, from the arbid index
+        '''
+        block = None
+        for bidx, index, first, last in self._genIndexParts(start, stop):
+            if bidx != None and not [arbid for arbid in arbids if self._spilled[bidx].arbidCount(arbid)]:
+                continue
+
+            index, offset = self._partIndex(bidx, index)
+            ranges = []
+            for arbid in arbids:
+                positions = index.get(arbid)
+                if positions != None:
+                    lo, hi = _positionRange(positions, first + offset, last + offset)
+                    if hi > lo:
+                        ranges.append(positions[lo:hi])
+            if len(ranges) == 1:
+                indexes = ranges[0]
+            else:
+                indexes = heapq.merge(*ranges)
+
+            for idx in indexes:
+                idx -= offset
+                if block is None or not block.start <= idx < block.start + len(block):
+                    block = self._getBlock(idx)
+
+                ts, arbid, data = block.getFrame(idx - block.start)
+                yield (idx, ts, arbid, data)
+
+    # arbid index
+    def _genIndexParts(self, start, stop):
+        '''
+        yields (bidx, index, first, last), splitting messages start up to
+        (not including) stop by where their arbid index entries are: 
+        spilled block bidx's slice (index None, see _partIndex()), or the
+        in-memory index (bidx None) for the live block's messages
+        '''
+        # the index before the live block: spilling replaces the live block
+        # and then the index, so this index covers the live block we get
+        index = self._arbid_index
+        live_start = self._live.start
+
+        if start < live_start:
+            spilled = self._spilled
+            bidx = max(bisect.bisect_right(self._spilled_starts, start) - 1, 0)
+            while bidx < len(spilled) and spilled[bidx].start < min(stop, live_start):
+                block = spilled[bidx]
+                yield bidx, None, max(start, block.start), min(stop, block.start + block.count)
+                bidx += 1
+
+        if stop > live_start:
+            yield None, index, max(start, live_start), stop
+
+    def _partIndex(self, bidx, index):
+        '''
+        returns (index, offset) for a part of the arbid index from 
+        _genIndexParts(): arbid -> sorted array of positions, which are 
+        message indexes + offset
+        '''
+        if bidx == None:
+            return index, self._popped
+        return self._blockIndex(bidx), 0
+
+    def _blockIndex(self, bidx):
+        '''
+        returns spilled block bidx's slice of the arbid index, reading it
+        back in (the last one read is kept)
+        '''
+        cached_idx, cached = self._index_cache
+        if cached_idx == bidx:
+            return cached
+
+        spilled = self._spilled[bidx]
+        index = spilled.unpackIndex(self._readStored(spilled.source, spilled.index_pos, spilled.index_size))
+        self._index_cache = (bidx, index)
+        return index
+
+    def _genArbidRanges(self, arbid, start, stop, reverse=False):
+        '''
+        yields (positions, lo, hi, offset) for each part of the arbid index
+        with arbid's messages start up to (not including) stop (last part 
+        first if reverse): positions[lo:hi] less offset are their message
+        indexes.  spilled blocks' slices are only read back if arbid is in them
+        '''
+        parts = self._genIndexParts(start, stop)
+        if reverse:
+            parts = reversed(list(parts))
+
+        for bidx, index, first, last in parts:
+            if bidx != None and not self._spilled[bidx].arbidCount(arbid):
+                continue
+
+            index, offset = self._partIndex(bidx, index)
+            positions = index.get(arbid)
+            if positions != None:
+                lo, hi = _positionRange(positions, first + offset, last + offset)
+                if hi > lo:
+                    yield positions, lo, hi, offset
+
+    def _arbidCount(self, arbid, start, stop):
+        '''
+        how many of arbid's messages there are from start up to (not 
+        including) stop.  spilled blocks wholly inside don't get read back
+        '''
+        count = 0
+        for bidx, index, first, last in self._genIndexParts(start, stop):
+            if bidx != None:
+                block = self._spilled[bidx]
+                if first == block.start and last == block.start + block.count:
+                    count += block.arbidCount(arbid)
+                    continue
+                if not block.arbidCount(arbid):
+                    continue
+
+            index, offset = self._partIndex(bidx, index)
+            positions = index.get(arbid)
+            if positions != None:
+                lo, hi = _positionRange(positions, first + offset, last + offset)
+                count += hi - lo
+        return count
+
+    def _indexRange(self, start, stop):
+        # inclusive stop, like genCanMsgs()
+        count = len(self)
+        if stop == None:
+            return start, count
+        return start, min(stop + 1, count)
+
+    # time index
+    def getIndexAtTime(self, ts, after=False):
+        '''
+        returns the index of the first message with a timestamp at or after
+        ts (or strictly after ts, if after=True).  len(self) if there isn't one.
+        '''
+        if after:
+            search = bisect.bisect_right
+        else:
+            search = bisect.bisect_left
+
+        # the block is the first one with a timestamp that late (every
+        # earlier block's latest is before ts), then it's searched
+        bidx = search(self._spilled_max_ts, ts)
+        if bidx < len(self._spilled):
+            block = self._loadSpilled(bidx)
+        else:
+            block = self._live
+
+        if block.ordered:
+            return block.start + search(block.timestamps, ts)
+        return block.start + _scanTime(block.timestamps, ts, after)
+
+    def getIndexRangeByTime(self, start_time=None, stop_time=None):
+        '''
+        returns (start, stop) message indexes (stop inclusive, like 
+        genCanMsgs) covering messages stamped start_time through stop_time.
+        stop < start if there aren't any.
+        '''
+        start = 0
+        if start_time != None:
+            start = self.getIndexAtTime(start_time)
+
+        stop = len(self) - 1
+        if stop_time != None:
+            stop = self.getIndexAtTime(stop_time, after=True) - 1
+
+        return start, stop
+
+    def getArbids(self):
+        '''
+        returns a sorted list of every arbid in the capture
+        '''
+        return sorted(self._arbids)
+
+    def getArbidIndexes(self, arbid, start=0, stop=None):
+        '''
+        returns the indexes of arbid's messages between start and stop (inclusive)
+        '''
+        indexes = []
+        for positions, lo, hi, offset in self._genArbidRanges(arbid, *self._indexRange(start, stop)):
+            indexes.extend([pos - offset for pos in positions[lo:hi]])
+        return indexes
+
+    def getArbidCount(self, arbid, start=0, stop=None):
+        return self._arbidCount(arbid, *self._indexRange(start, stop))
+
+    def getArbidCounts(self, start=0, stop=None):
+        '''
+        returns { arbid : message count } for messages start through stop
+        '''
+        start, stop = self._indexRange(start, stop)
+        counts = {}
+        for bidx, index, first, last in self._genIndexParts(start, stop):
+            if bidx != None:
+                block = self._spilled[bidx]
+                if first == block.start and last == block.start + block.count:
+                    for arbid, count in zip(block.index_arbids, block.index_counts):
+                        counts[arbid] = counts.get(arbid, 0) + count
+                    continue
+
+            index, offset = self._partIndex(bidx, index)
+            for arbid, positions in index.items():
+                lo, hi = _positionRange(positions, first + offset, last + offset)
+                if hi > lo:
+                    counts[arbid] = counts.get(arbid, 0) + hi - lo
+        return counts
+
+    def getArbidFirst(self, arbid, start=0, stop=None):
+        '''
+        returns the index of arbid's first message between start and stop, or None
+        '''
+        for positions, lo, hi, offset in self._genArbidRanges(arbid, *self._indexRange(start, stop)):
+            return positions[lo] - offset
+
+    def getArbidLast(self, arbid, start=0, stop=None):
+        '''
+        returns the index of arbid's last message between start and stop, or None
+        '''
+        start, stop = self._indexRange(start, stop)
+        for positions, lo, hi, offset in self._genArbidRanges(arbid, start, stop, reverse=True):
+            return positions[hi - 1] - offset
+
+    # stats
+    def getArbidStats(self, start=0, stop=None):
+        '''
+        returns { arbid : ArbidStats } for messages start through stop
+        (inclusive)
+        '''
+        start, stop = self._indexRange(start, stop)
+        popped = self._popped
+
+        # chunks entirely inside the range
+        first = (start + popped + STATS_CHUNK - 1) / STATS_CHUNK
+        last = (stop + popped) / STATS_CHUNK
+        if first >= last:
+            return self._scanStats(start, stop)
+
+        stats = self._scanStats(start, first * STATS_CHUNK - popped)
+        for num in xrange(first, last):
+            mergeStats(stats, self._statsChunk(num))
+        return mergeStats(stats, self._scanStats(last * STATS_CHUNK - popped, stop))
+
+    def _statsChunk(self, num):
+        '''
+        returns stats chunk num as { arbid : ArbidStats }, unpacking it if
+        it's been packed away
+        '''
+        chunk = self._stats_chunks[num]
+        if isinstance(chunk, SpilledStats):
+            return unpackStats(self._readStored(chunk.source, chunk.pos, chunk.size))
+        return chunk
+
+    def _chunkStats(self, num, stop):
+        '''
+        returns { arbid : ArbidStats } for stats chunk num's messages up to
+        (not including) stop.  the open chunk is copied, not handed out, 
+        as messages are still being added to it: if the copy has gone past
+        stop, or caught an add half done, the messages get scanned instead
+        '''
+        start = num * STATS_CHUNK
+        if num >= len(self._stats_chunks):
+            return self._scanStats(start, stop)
+
+        chunk = self._stats_chunks[num]
+        if isinstance(chunk, SpilledStats):
+            stats = unpackStats(self._readStored(chunk.source, chunk.pos, chunk.size))
+        else:
+            stats = dict([(arbid, arbstats.copy()) for arbid, arbstats in chunk.items()])
+
+        count = 0
+        for arbstats in stats.itervalues():
+            # add() counts a message first and sketches its gap last
+            if arbstats.last_ts == None or arbstats.sketch.count() != arbstats.count - 1:
+                return self._scanStats(start, stop)
+            count += arbstats.count
+        if count != stop - start:
+            return self._scanStats(start, stop)
+        return stats
+
+    def _newStatsChunk(self):
+        '''
+        start the next stats chunk, packing the finished one away
+        '''
+        chunks = self._stats_chunks
+        if chunks and isinstance(chunks[-1], dict):
+            # the next one will likely take as much memory as this one
+            self._stats_reserved = statsMemory(chunks[-1])
+            self._packStatsChunk(len(chunks) - 1)
+
+        self._stats_chunk = {}
+        chunks.append(self._stats_chunk)
+
+    def _packStatsChunk(self, num):
+        '''
+        pack finished stats chunk num away: into the spill file if the 
+        capture has a memory budget, otherwise it's kept in memory packed
+        '''
+        packed = packStats(self._stats_chunks[num])
+        if self.max_memory == None:
+            self._stats_chunks[num] = SpilledStats(0, len(packed), packed)
+            return
+
+        self._spill_lock.acquire()
+        try:
+            if self._spill == None:
+                self._spill = self._openSpill()
+            self._spill.seek(0, 2)
+            pos = self._spill.tell()
+            self._spill.write(packed)
+            self._spill.flush()
+        finally:
+            self._spill_lock.release()
+        self._stats_chunks[num] = SpilledStats(pos, len(packed))
+
+    def _scanStats(self, start, stop):
+        '''
+        builds { arbid : ArbidStats } for messages start up to (not 
+        including) stop, straight from the timestamp/arbid columns
+        '''
+        stats = {}
+        for block, first, last in self._genBlockRanges(start, stop):
+            timestamps = block.timestamps
+            arbids = block.arbids
+            for pos in xrange(first, last):
+                arbid = arbids[pos]
+                arbstats = stats.get(arbid)
+                if arbstats is None:
+                    arbstats = ArbidStats()
+                    stats[arbid] = arbstats
+                arbstats.add(timestamps[pos])
+        return stats
+
+    def isSpilled(self):
+        return len(self._spilled) > 0
+
+    def memoryUsed(self):
+        '''
+        bytes used by the in-memory part of the capture
+        '''
+        used = self._live.memoryUsed()
+        used += sum([positions.itemsize * len(positions) for positions in self._arbid_index.values()])
+        used += self._spilled_memory
+        chunk = self._stats_chunk
+        if chunk != None:
+            used += statsMemory(chunk)
+        used += sum([chunk.size for chunk in self._stats_chunks
+                if isinstance(chunk, SpilledStats) and isinstance(chunk.source, str)])
+        cached = self._cache[1]
+        if cached != None:
+            used += cached.memoryUsed()
+        cached = self._index_cache[1]
+        if cached != None:
+            used += sum([positions.itemsize * len(positions) for positions in cached.values()])
+        return used
+
+    def close(self):
+        '''
+        close the spill file (an anonymous one goes away with it)
+        '''
+        if self._spill != None:
+            self._spill.close()
+            self._spill = None
+
+    def genSessionBlocks(self, start=0, stop=None):
+        '''
+        yields (start, count, first_ts, last_ts, max_ts, ordered, 
+        payload_base, columns, index, stats) for messages start up to (not
+        including) stop (or the end) in blocks lined up with the stats 
+        chunks, for writing to a session file (see cancat/session.py):
+            max_ts, ordered - see SpilledBlock
+            columns - the raw column strings (see CaptureBlock.columnStrings())
+            index   - { arbid : array of the block's message indexes }
+            stats   - stats for the chunk the block is in, from the start
+                      of the chunk (even if start is part way in) to the
+                      end of the block
+        '''
+        if stop == None:
+            stop = len(self)
+        popped = self._popped
+        while start < stop:
+            chunk = start / STATS_CHUNK
+            chunk_start = chunk * STATS_CHUNK
+            chunk_stop = min(chunk_start + STATS_CHUNK, stop)
+
+            columns = [[], [], [], [], []]
+            payload_base = None
+            for block, first, last in self._genBlockRanges(start, chunk_stop):
+                offsets = block.offsets
+                lo = offsets[first] - block.payload_base
+                hi = offsets[last - 1] + block.lengths[last - 1] - block.payload_base
+                timestamps = block.timestamps[first:last]
+                if block.ordered:
+                    part_ordered = True
+                    part_max_ts = timestamps[-1]
+                else:
+                    part_ordered = _isOrdered(timestamps)
+                    part_max_ts = max(timestamps)
+
+                if payload_base == None:
+                    payload_base = offsets[first]
+                    first_ts = timestamps[0]
+                    max_ts = part_max_ts
+                    ordered = part_ordered
+                else:
+                    ordered = ordered and part_ordered and timestamps[0] >= last_ts
+                    max_ts = max(max_ts, part_max_ts)
+                last_ts = timestamps[-1]
+
+                columns[0].append(timestamps.tostring())
+                columns[1].append(block.arbids[first:last].tostring())
+                columns[2].append(block.lengths[first:last].tostring())
+                columns[3].append(offsets[first:last].tostring())
+                columns[4].append(str(block.payload[lo:hi]))
+            columns = [''.join(column) for column in columns]
+
+            index = {}
+            for bidx, part, first, last in self._genIndexParts(start, chunk_stop):
+                part, offset = self._partIndex(bidx, part)
+                for arbid, positions in part.items():
+                    lo, hi = _positionRange(positions, first + offset, last + offset)
+                    if lo < hi:
+                        indexes = positions[lo:hi]
+                        if offset:
+                            indexes = array('i', [pos - offset for pos in indexes])
+                        if arbid in index:
+                            index[arbid].extend(indexes)
+                        else:
+                            index[arbid] = indexes
+
+            if popped:
+                # the chunks don't line up with message indexes any more
+                stats = self._scanStats(chunk_start, chunk_stop)
+            else:
+                stats = self._chunkStats(chunk, chunk_stop)
+
+            yield (start, chunk_stop - start, first_ts, last_ts, max_ts, ordered, payload_base,
+                    columns, index, stats)
+            start = chunk_stop
+
+    def attach(self, source, blocks, stats_chunks):
+        '''
+        take on messages stored in a session file (see cancat/session.py)
+        without reading them: source is the file's mmap, blocks the 
+        SpilledBlocks where the messages are (in order, from message 0, 
+        with their slices of the arbid index, see SpilledBlock.setIndex())
+        and stats_chunks their stats chunks.  blocks are read back on 
+        demand like spilled ones, so only the pages touched get read.  the
+        capture has to be empty.
+        '''
+        if len(self):
+            raise Exception("Can't attach session blocks to a capture that has messages")
+
+        self._sources.append(source)
+        max_ts = None
+        for spilled in blocks:
+            max_ts = max(max_ts, spilled.max_ts)
+            self._spilled.append(spilled)
+            self._spilled_starts.append(spilled.start)
+            self._spilled_max_ts.append(max_ts)
+            self._spilled_memory += spilled.memoryUsed()
+            self._arbids.update(spilled.index_arbids)
+
+        if blocks:
+            last = blocks[-1]
+            self._live = CaptureBlock(last.start + last.count)
+            self._live.payload_base = last.payload_base + last.sizes[4]
+
+        self._arbid_index = {}
+        self._popped = 0
+        self._stats_chunks = stats_chunks
+        self._stats_chunk = None
+        if len(self) % STATS_CHUNK:
+            # new messages carry on the last chunk
+            self._stats_chunk = self._statsChunk(len(stats_chunks) - 1)
+            stats_chunks[-1] = self._stats_chunk
+
+    # block management
+    def _getBlock(self, idx):
+        '''
+        returns the CaptureBlock holding message idx, reading it back in
+        from the spill file if need be
+        '''
+        live = self._live
+        if idx >= live.start:
+            return live
+
+        bidx = bisect.bisect_right(self._spilled_starts, idx) - 1
+        return self._loadSpilled(bidx)
+
+    def _loadSpilled(self, bidx):
+        cached_idx, cached = self._cache
+        if cached_idx == bidx:
+            return cached
+
+        spilled = self._spilled[bidx]
+        data = self._readStored(spilled.source, spilled.pos, spilled.size())
+        block = CaptureBlock(spilled.start)
+        block.loadColumnStrings(spilled.unpack(data), spilled.payload_base)
+        block.ordered = spilled.ordered
+        self._cache = (bidx, block)
+        return block
+
+    def _readStored(self, source, pos, size):
+        '''
+        returns size bytes at pos in source (a session file's mmap), or in
+        the spill file if source is None
+        '''
+        if source != None:
+            # mmap'd, only the pages sliced get read
+            return source[pos:pos + size]
+
+        self._spill_lock.acquire()
+        try:
+            self._spill.seek(pos)
+            return self._spill.read(size)
+        finally:
+            self._spill_lock.release()
+
+    def _openSpill(self):
+        if self.spill_filename != None:
+            return open(self.spill_filename, 'w+b')
+        return tempfile.TemporaryFile(prefix='cancat_spill_', dir=self.spill_dir)
+
+    def _overBudget(self, live):
+        '''
+        is the live block (and its part of the arbid index) using more than
+        what's left of max_memory?  it always gets at least a quarter of 
+        it, or it would spill on every message
+        '''
+        max_memory = self.max_memory
+        used = live.memoryUsed() + INDEX_OVERHEAD * len(live)
+        return used > max(max_memory - self._stats_reserved - self._spilled_memory, max_memory / 4)
+
+    def _spillOldest(self):
+        '''
+        write the older half of the live block out to the spill file, with
+        its slice of the arbid index.  the live block and the index are
+        replaced (not modified), so anyone iterating the old ones can 
+        carry on
+        '''
+        live = self._live
+        head, tail = live.split(len(live) / 2)
+        if not len(head):
+            return
+
+        popped = self._popped
+        cut = tail.start + popped
+        head_index = {}
+        tail_index = {}
+        for arbid, positions in self._arbid_index.items():
+            lo = bisect.bisect_left(positions, cut)
+            if lo:
+                indexes = positions[:lo]
+                if popped:
+                    indexes = array('i', [pos - popped for pos in indexes])
+                head_index[arbid] = indexes
+            if lo < len(positions):
+                tail_index[arbid] = positions[lo:]
+
+        self._spill_lock.acquire()
+        try:
+            if self._spill == None:
+                self._spill = self._openSpill()
+
+            self._spill.seek(0, 2)
+            columns = head.columnStrings()
+            if head.ordered:
+                max_ts = head.timestamps[-1]
+            else:
+                max_ts = max(head.timestamps)
+            spilled = SpilledBlock(head.start, len(head), head.timestamps[0], head.timestamps[-1],
+                    head.payload_base, self._spill.tell(), [len(column) for column in columns],
+                    max_ts=max_ts, ordered=head.ordered)
+            for column in columns:
+                self._spill.write(column)
+
+            index = packIndex(head_index)
+            spilled.setIndex(self._spill.tell(), len(index),
+                    dict([(arbid, len(indexes)) for arbid, indexes in head_index.items()]))
+            self._spill.write(index)
+            self._spill.flush()
+        finally:
+            self._spill_lock.release()
+
+        if self._spilled_max_ts:
+            max_ts = max(max_ts, self._spilled_max_ts[-1])
+        self._spilled.append(spilled)
+        self._spilled_starts.append(spilled.start)
+        self._spilled_max_ts.append(max_ts)
+        self._spilled_memory += spilled.memoryUsed()
+        # the live block first, then the index (see _genIndexParts())
+        self._live = tail
+        self._arbid_index = tail_index
+
+    # pickling
+    def __getstate__(self):
+        '''
+        pickles everything, including anything spilled to disk.  offsets 
+        carry on from one block to the next, so the columns of all the 
+        blocks just get strung together
+        '''
+        blocks = [self._loadSpilled(bidx) for bidx in range(len(self._spilled))]
+        blocks.append(self._live)
+
+        columns = zip(*[block.columnStrings() for block in blocks])
+        timestamps, arbids, lengths, offsets, payload = [''.join(column) for column in columns]
+        state = { 'timestamps' : timestamps,
+                'arbids' : arbids,
+                'lengths' : lengths,
+                'offsets' : offsets,
+                'payload' : payload,
+                'payload_base' : blocks[0].payload_base,
+                }
+
+        # the stats chunks line up with message indexes until something is
+        # popped off the front
+        if not self._popped:
+            state['stats'] = [self._statsChunk(num) for num in xrange(len(self._stats_chunks))]
+        return state
+
+    def __setstate__(self, state):
+        self.__init__()
+        self._live.loadColumnStrings((state['timestamps'], state['arbids'], state['lengths'],
+                state['offsets'], state['payload']), state['payload_base'])
+
+        if len(self._live):
+            self._live.ordered = _isOrdered(self._live.timestamps)
+            self._last_ts = self._live.timestamps[-1]
+
+        # the arbid index isn't saved, rebuild it
+        index = self._arbid_index
+        for pos, arbid in enumerate(self._live.arbids):
+            positions = index.get(arbid)
+            if positions == None:
+                positions = array('i')
+                index[arbid] = positions
+            positions.append(pos)
+        self._arbids.update(index)
+
+        stats = state.get('stats')
+        if stats == None:
+            count = len(self._live)
+            stats = [self._scanStats(start, min(start + STATS_CHUNK, count))
+                    for start in xrange(0, count, STATS_CHUNK)]
+        self._stats_chunks = stats
+        if stats:
+            self._stats_chunk = stats[-1]
+            for num in xrange(len(stats) - 1):
+                self._packStatsChunk(num)
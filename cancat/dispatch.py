@@ -0,0 +1,174 @@
+'''
+Publish/subscribe delivery of received messages.
+
+Every message the receiver thread files into a mailbox is also handed to
+each Subscription for that cmd (see CanInterface.subscribe()).  Each
+subscriber gets its own bounded queue, so a slow consumer (printing to
+a terminal, say) can only ever lose its *own* messages: storage and the
+receiver thread carry on at full speed.
+
+What happens when a subscriber's queue is full is up to its overflow
+policy:
+    OVERFLOW_DROP_OLDEST    - make room by dropping the oldest queued message
+    OVERFLOW_DROP_NEWEST    - drop the message being delivered
+    OVERFLOW_DISCONNECT     - drop the message and close the subscription
+'''
+import sys
+import threading
+import collections
+
+OVERFLOW_DROP_OLDEST = 0
+OVERFLOW_DROP_NEWEST = 1
+OVERFLOW_DISCONNECT = 2
+
+SUB_QUEUE_LEN = 10000
+
+
+class Subscription:
+    '''
+    One consumer's view of a mailbox.
+
+    Messages are (idx, ts, arbid, data) tuples for received CAN messages
+    (CMD_CAN_RECV/CMD_ISO_RECV) and (idx, ts, message) for anything else.
+    arbids (a list/set) limits which CAN messages are queued at all.
+
+    Either read them yourself:
+        >>> sub = c.subscribe(arbids=[0x7e8])
+        >>> for idx, ts, arbid, data in sub: ...
+    or give a callback, which is called from the subscription's own thread.
+    '''
+    def __init__(self, cmd, arbids=None, maxlen=SUB_QUEUE_LEN, overflow=OVERFLOW_DROP_OLDEST, callback=None):
+        if overflow not in (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_DISCONNECT):
+            raise Exception("Invalid overflow policy: %r" % overflow)
+
+        if arbids != None:
+            arbids = set(arbids)
+
+        self.cmd = cmd
+        self.arbids = arbids
+        self.maxlen = maxlen
+        self.overflow = overflow
+        self.callback = callback
+        self.active = True
+
+        self.received = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+        self._queue = collections.deque()
+        self._cond = threading.Condition(threading.Lock())
+        self._thread = None
+
+        if callback != None:
+            self._thread = threading.Thread(target=self._callbackthread)
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def __repr__(self):
+        return "<Subscription cmd 0x%x: %d received, %d dropped, %d queued%s>" % \
+                (self.cmd, self.received, self.dropped, len(self._queue),
+                        ('', ' (closed)')[not self.active])
+
+    def __iter__(self):
+        '''
+        yields messages until the subscription is closed
+        '''
+        while True:
+            msg = self.get()
+            if msg == None:
+                return
+            yield msg
+
+    def publish(self, msg, arbid=None):
+        '''
+        queue a message (receiver thread).  never blocks.
+        returns False once the subscription has been closed
+        '''
+        if not self.active:
+            return False
+
+        if self.arbids != None and arbid not in self.arbids:
+            return True
+
+        self._cond.acquire()
+        try:
+            queue = self._queue
+            if len(queue) >= self.maxlen:
+                self.dropped += 1
+                if self.overflow == OVERFLOW_DROP_OLDEST:
+                    queue.popleft()
+                elif self.overflow == OVERFLOW_DROP_NEWEST:
+                    return True
+                else:
+                    self.active = False
+                    self._cond.notifyAll()
+                    return False
+
+            queue.append(msg)
+            self.received += 1
+            if len(queue) > self.max_depth:
+                self.max_depth = len(queue)
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+        return True
+
+    def get(self, timeout=None):
+        '''
+        returns the next message, waiting up to timeout seconds (forever if
+        None).  returns None on timeout, or once closed and drained
+        '''
+        self._cond.acquire()
+        try:
+            if not len(self._queue) and self.active:
+                if timeout == None:
+                    while not len(self._queue) and self.active:
+                        self._cond.wait()
+                else:
+                    self._cond.wait(timeout)
+
+            if len(self._queue):
+                return self._queue.popleft()
+            return None
+        finally:
+            self._cond.release()
+
+    def getAll(self):
+        '''
+        returns (and removes) everything queued, without waiting
+        '''
+        self._cond.acquire()
+        try:
+            msgs = list(self._queue)
+            self._queue.clear()
+            return msgs
+        finally:
+            self._cond.release()
+
+    def close(self):
+        '''
+        stop queueing messages and drop anything still queued.
+        (use CanInterface.unsubscribe() to also stop delivery)
+        '''
+        self._cond.acquire()
+        try:
+            self.active = False
+            self._queue.clear()
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+        if self._thread != None and self._thread != threading.currentThread():
+            self._thread.join()
+
+    def _callbackthread(self):
+        while True:
+            msg = self.get()
+            if msg == None:
+                return
+
+            try:
+                self.callback(msg)
+            except:
+                sys.excepthook(*sys.exc_info())
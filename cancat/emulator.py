@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+'''
+Software CanCat transceiver.
+
+Opens a pseudo-terminal and speaks the same serial protocol as the
+M2_CAN_haz_bus firmware, so the host side can be exercised (and load
+tested) without any hardware attached:
+
+    >>> emu = CanCatEmulator(rate=5000)
+    >>> emu.start()
+    >>> c = CanInterface(port=emu.port)
+'''
+import os
+import sys
+import pty
+import tty
+import time
+import struct
+import threading
+
+from cancat import iso_tp
+from cancat import *
+
+
+def positiveResponder(arbid, data):
+    '''
+    Example ISO-TP responder: answers every request with a positive
+    response echoing the request (service + 0x40)
+    '''
+    return chr((ord(data[0]) + 0x40) & 0xff) + data[1:]
+
+
+class CanCatEmulator:
+    def __init__(self, rate=0, arbids=None, session=None, loop=False, isotp_responder=None, verbose=False):
+        '''
+        rate            - CMD_CAN_RECV frames per second to generate (0 = none)
+        arbids          - arbids used for generated frames
+        session         - saved session (filename or dict from saveSession())
+                          to replay instead of generated frames.  Replayed with
+                          the original timing unless rate is given
+        loop            - keep replaying the session when it runs out
+        isotp_responder - callable(arbid, data) returning the response data
+                          an emulated ECU sends back for ISO-TP requests
+                          (or None for no response).  see positiveResponder()
+        '''
+        if arbids == None:
+            arbids = range(0x100, 0x110)
+
+        self.rate = rate
+        self.arbids = arbids
+        self.session = session
+        self.loop = loop
+        self.isotp_responder = isotp_responder
+        self.verbose = verbose
+
+        self.port = None
+        self.mode = CMD_CAN_MODE_SNIFF_CAN0
+        self.initialized = False
+        self.can_baud = None
+        self.frames_sent = 0
+
+        self._master = None
+        self._slave = None
+        self._go = False
+        self._out_lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        '''
+        open the pseudo-terminal and start emulating.
+        returns the device name to hand to CanInterface(port=...)
+        '''
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._go = True
+
+        for target in (self._rxthread, self._trafficthread):
+            thread = threading.Thread(target=target)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+        return self.port
+
+    def stop(self):
+        self._go = False
+        for fd in (self._master, self._slave):
+            if fd != None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self._master = self._slave = None
+
+    def log(self, message):
+        if self.verbose:
+            print "%.2f emulator: %s" % (time.time(), message)
+
+    # output to the host
+    def _packet(self, cmd, data):
+        return '@' + chr(len(data) + 1) + chr(cmd) + data
+
+    def _write(self, data):
+        self._out_lock.acquire()
+        try:
+            while data:
+                count = os.write(self._master, data)
+                data = data[count:]
+        finally:
+            self._out_lock.release()
+
+    def send(self, cmd, data):
+        '''
+        send one packet up to the host, like the firmware's send()
+        '''
+        self._write(self._packet(cmd, data))
+
+    def sendLog(self, message):
+        self.send(CMD_LOG, message)
+
+    def _canPackets(self, arbid, data):
+        '''
+        the packet(s) the host sees when a frame shows up on the bus
+        '''
+        msg = struct.pack('>I', arbid) + data
+        pkts = self._packet(CMD_CAN_RECV, msg)
+        if self.mode == CMD_CAN_MODE_CITM:
+            pkts += self._packet(CMD_ISO_RECV, msg)
+        return pkts
+
+    def sendCanFrames(self, frames):
+        '''
+        put (arbid, data) frames "on the bus", in a single write
+        '''
+        self._write(''.join([self._canPackets(arbid, data) for arbid, data in frames]))
+        self.frames_sent += len(frames)
+
+    # input from the host
+    def _rxthread(self):
+        inbuf = ''
+        while self._go:
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                break
+
+            inbuf += data
+            while len(inbuf) >= 3:
+                pktlen = struct.unpack('>H', inbuf[:2])[0]
+                if pktlen < 3:
+                    # garbage, drop a byte and try again
+                    inbuf = inbuf[1:]
+                    continue
+
+                if len(inbuf) < pktlen:
+                    break
+
+                pkt = inbuf[:pktlen]
+                inbuf = inbuf[pktlen:]
+                try:
+                    self._handle(ord(pkt[2]), pkt[3:])
+                except:
+                    if self.verbose:
+                        sys.excepthook(*sys.exc_info())
+
+    def _handle(self, cmd, data):
+        self.log("cmd 0x%x: %r" % (cmd, data))
+
+        if not self.initialized and cmd not in (CMD_CAN_BAUD, CMD_CAN_MODE):
+            self.sendLog("CAN Not Initialized")
+
+        if cmd == CMD_CHANGE_BAUD:
+            self.send(CMD_CHANGE_BAUD_RESULT, '\x00')
+
+        elif cmd == CMD_PING:
+            self.send(CMD_PING_RESPONSE, data)
+
+        elif cmd == CMD_CAN_MODE:
+            self.mode = ord(data[0])
+            self.send(CMD_CAN_MODE_RESULT, '\x01')
+
+        elif cmd == CMD_CAN_BAUD:
+            if self.mode in (CMD_CAN_MODE_SNIFF_CAN0, CMD_CAN_MODE_SNIFF_CAN1, CMD_CAN_MODE_CITM):
+                self.can_baud = ord(data[0])
+                self.initialized = True
+                result = '\x01'
+            else:
+                self.sendLog("Invalid mode")
+                self.initialized = False
+                result = '\x00'
+            self.send(CMD_CAN_BAUD_RESULT, result)
+
+        elif cmd == CMD_CAN_SEND:
+            arbid = struct.unpack('>I', data[:4])[0]
+            # sent frames get echoed back up, like everything else on the bus
+            self.sendCanFrames([(arbid, data[5:])])
+            self.send(CMD_CAN_SEND_RESULT, chr(CAN_RESP_OK))
+
+        elif cmd == CMD_SET_FILT_MASK:
+            self.sendLog("Not Implemented")
+
+        elif cmd == CMD_CAN_SEND_ISOTP:
+            self._isotpSend(data)
+            self.send(CMD_CAN_SEND_ISOTP_RESULT, chr(CAN_RESP_OK))
+
+        elif cmd == CMD_CAN_RECV_ISOTP:
+            self.send(CMD_CAN_RECV_ISOTP_RESULT, chr(CAN_RESP_OK))
+
+        elif cmd == CMD_CAN_SENDRECV_ISOTP:
+            self._isotpSend(data)
+            self.send(CMD_CAN_SENDRECV_ISOTP_RESULT, chr(CAN_RESP_OK))
+
+        else:
+            self._write("@\x15\x03BAD COMMAND: %d" % cmd)
+
+    def _isotpFrames(self, arbid, data, fc_arbid):
+        '''
+        ISO-TP encode data (padded like the firmware does), with the flow
+        control frame the receiving side answers a first frame with
+        '''
+        frames = [(arbid, (frame + '\x00' * 8)[:8]) for frame in iso_tp.msg_encode(data)]
+        if len(frames) > 1:
+            frames.insert(1, (fc_arbid, '\x30' + '\x00' * 7))
+        return frames
+
+    def _isotpSend(self, data):
+        tx_arbid, rx_arbid, extflag = struct.unpack('>IIB', data[:9])
+        request = data[9:]
+        frames = self._isotpFrames(tx_arbid, request, rx_arbid)
+
+        if self.isotp_responder != None:
+            response = self.isotp_responder(tx_arbid, request)
+            if response:
+                frames.extend(self._isotpFrames(rx_arbid, response, tx_arbid))
+
+        self.sendCanFrames(frames)
+
+    # generated bus traffic
+    def _sessionFrames(self):
+        '''
+        yields (time_offset, arbid, data) for the frames in self.session
+        '''
+        me = self.session
+        if isinstance(me, basestring):
+            me = loadCanBuffer(me)
+
+        capture = me.get('messages').get(CMD_CAN_RECV)
+        if not isinstance(capture, CanCapture):
+            capture = CanCapture(capture)
+
+        base = 0
+        while True:
+            first = last = None
+            for idx, ts, arbid, data in capture.genCanMsgs():
+                if first == None:
+                    first = ts
+                last = ts
+                yield base + ts - first, arbid, data
+
+            if not self.loop or first == None:
+                return
+            base += last - first + .001
+
+    def _generatedFrames(self):
+        '''
+        yields (time_offset, arbid, data) for synthetic traffic at self.rate
+        '''
+        count = 0
+        while True:
+            arbid = self.arbids[count % len(self.arbids)]
+            yield float(count) / self.rate, arbid, struct.pack('>Q', count)
+            count += 1
+
+    def _trafficthread(self):
+        while self._go and not self.initialized:
+            time.sleep(.01)
+
+        if self.session != None:
+            frames = self._sessionFrames()
+        elif self.rate:
+            frames = self._generatedFrames()
+        else:
+            return
+
+        count = 0
+        start = time.time()
+        pending = None
+        while self._go:
+            now = time.time() - start
+            batch = []
+            try:
+                while len(batch) < 1000:
+                    if pending == None:
+                        pending = frames.next()
+                        count += 1
+                        if self.session != None and self.rate:
+                            # replay the session at a fixed rate
+                            pending = (float(count) / self.rate,) + pending[1:]
+
+                    if pending[0] > now:
+                        break
+                    batch.append(pending[1:])
+                    pending = None
+
+            except StopIteration:
+                if batch:
+                    self.sendCanFrames(batch)
+                return
+
+            if batch:
+                self.sendCanFrames(batch)
+            else:
+                time.sleep(min(pending[0] - now, .001))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Emulate a CanCat transceiver on a pseudo-terminal')
+    parser.add_argument('-r', '--rate', type=float, default=0, help='CAN frames per second to generate')
+    parser.add_argument('-f', '--filename', help='replay a saved session instead of generated frames')
+    parser.add_argument('-l', '--loop', action='store_true', help='loop the saved session')
+    parser.add_argument('-u', '--uds', action='store_true', help='answer ISO-TP requests with positive responses')
+    parser.add_argument('-v', '--verbose', action='store_true')
+
+    ifo = parser.parse_args()
+
+    responder = None
+    if ifo.uds:
+        responder = positiveResponder
+
+    emu = CanCatEmulator(rate=ifo.rate, session=ifo.filename, loop=ifo.loop, isotp_responder=responder, verbose=ifo.verbose)
+    print "CanCat emulator listening on %s  (CanCat.py -p %s)" % (emu.start(), emu.port)
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        emu.stop()
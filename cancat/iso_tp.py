@@ -180,3 +180,59 @@ def msgs_decode(msglist, verbose=False):
 
     return messages
 
+
+def gen_msgs(msglist):
+    '''
+    reassembles the ISO-TP messages in a stream of (idx, ts, arbid, msg)
+    CAN messages (all the same arbid, in order), without stopping at
+    gaps or junk.  yields (first_idx, last_idx, data, pieces), where
+    pieces are (data_offset, idx, msg_offset): data[data_offset:] onwards
+    came from message idx, starting msg_offset bytes into it.
+    '''
+    output = None
+    for idx, ts, arbid, msg in msglist:
+        if not len(msg):
+            output = None
+            continue
+
+        ctrl = ord(msg[0])
+        ftype = (ctrl >> 4)
+        if ftype == 0:
+            output = None
+            data_len = ctrl & 0xf
+            if data_len and data_len < len(msg):
+                yield idx, idx, msg[1:data_len+1], [(0, idx, 1)]
+
+        elif ftype == 1:
+            if len(msg) < 3:
+                output = None
+                continue
+            length = struct.unpack(">H", msg[0:2])[0] & 0xfff
+            first_idx = idx
+            output = [msg[2:]]
+            pieces = [(0, idx, 2)]
+            got = len(msg) - 2
+            nextidx = 1
+
+        elif ftype == 2:
+            if output == None or (ctrl & 0xf) != nextidx:
+                # lost track: wait for the next first frame
+                output = None
+                continue
+
+            pieces.append((got, idx, 1))
+            output.append(msg[1:])
+            got += len(msg) - 1
+            nextidx = (nextidx + 1) & 0xf
+
+        elif ftype == 3:
+            # flow control, from the other side
+            continue
+
+        else:
+            output = None
+            continue
+
+        if output != None and got >= length:
+            yield first_idx, idx, ''.join(output)[:length], pieces
+            output = None
@@ -17,8 +17,8 @@ class J1939:
     def readJ1939DB(self):
         f=open("J1939db.json", "r")
         self.j1939DB = json.load(f)
-# printJ1939Msgs --> reprJ1939Msgs --> filterJ1939Msgs --> genJ1939Msgs --> reprJ1939Msg
-    def printJ1939Msgs(self, start_msg=0, stop_msg=None, start_bkmk=None, stop_bkmk=None, start_baseline_msg=None, stop_baseline_msg=None, arbids=None, priorities=None, pgns=None, sourceAddresses=None, spns=None, ignore=[]):
+# printJ1939Msgs --> genReprJ1939Msgs --> filterJ1939Msgs --> genJ1939Msgs --> reprJ1939Msg
+    def printJ1939Msgs(self, start_msg=0, stop_msg=None, start_bkmk=None, stop_bkmk=None, start_baseline_msg=None, stop_baseline_msg=None, arbids=None, priorities=None, pgns=None, sourceAddresses=None, spns=None, ignore=[], out=None, pager=False):
         '''
         This function decodes CAN messages into J1939 format. Examples of usage:
         1) Importing and creating a J1939 object
@@ -34,8 +34,11 @@ class J1939:
         j.printJ1939Msgs(priorities={0,7})
         6) Filter by spns:
         j.printJ1939Msgs(spns={520,190})
+        7) Page through them, or write them to a file, as they're decoded:
+        j.printJ1939Msgs(pager=True)
+        j.printJ1939Msgs(out='j1939.txt')
         '''
-        print self.reprJ1939Msgs(start_msg, stop_msg, start_bkmk, stop_bkmk, start_baseline_msg, stop_baseline_msg, arbids, priorities, pgns, sourceAddresses, spns, ignore)
+        cancat.writeLines(self.genReprJ1939Msgs(start_msg, stop_msg, start_bkmk, stop_bkmk, start_baseline_msg, stop_baseline_msg, arbids, priorities, pgns, sourceAddresses, spns, ignore), out, pager)
 
     def reprJ1939Msgs(self, start_msg=0, stop_msg=None, start_bkmk=None, stop_bkmk=None, start_baseline_msg=None, stop_baseline_msg=None, arbids=None,priorities=None, pgns=None, sourceAddresses=None, spns=None, ignore=[]):
         '''
@@ -47,99 +50,30 @@ class J1939:
 
         Many functions wrap this one.
         '''
-        out = []
+        return "\n".join(self.genReprJ1939Msgs(start_msg, stop_msg, start_bkmk, stop_bkmk, start_baseline_msg, stop_baseline_msg, arbids, priorities, pgns, sourceAddresses, spns, ignore))
 
+    def genReprJ1939Msgs(self, start_msg=0, stop_msg=None, start_bkmk=None, stop_bkmk=None, start_baseline_msg=None, stop_baseline_msg=None, arbids=None,priorities=None, pgns=None, sourceAddresses=None, spns=None, ignore=[]):
+        '''
+        reprJ1939Msgs(), a line at a time
+        '''
         if start_bkmk != None:
             start_msg = self.c.getMsgIndexFromBookmark(start_bkmk)
 
         if stop_bkmk != None:
             stop_msg = self.c.getMsgIndexFromBookmark(stop_bkmk)
 
-
-
         if start_msg in self.c.bookmarks:
             bkmk = self.c.bookmarks.index(start_msg)
-            self.c.out.append("starting from bookmark %d: '%s'" %
-                    (bkmk,
-                    self.c.bookmark_info[bkmk].get('name'))
-                    )
+            yield "starting from bookmark %d: '%s'" % (bkmk, self.c.bookmark_info[bkmk].get('name'))
 
         if stop_msg in self.c.bookmarks:
             bkmk = self.c.bookmarks.index(stop_msg)
-            self.c.out.append("stoppng at bookmark %d: '%s'" %
-                    (bkmk,
-                    self.c.bookmark_info[bkmk].get('name'))
-                    )
-
-        last_msg = None
-        next_bkmk = 0
-        next_bkmk_idx = 0
-
-        msg_count = 0
-        last_ts = None
-        tot_delta_ts = 0
-        counted_msgs = 0    # used for calculating averages, excluding outliers
-
-        data_delta = None
-
-
-        data_repeat = 0
-        data_similar = 0
-
-        for idx, ts, arbid, pgns, msg in self.filterJ1939Msgs(start_msg, stop_msg, start_baseline_msg, stop_baseline_msg, arbids=arbids, priorities=priorities, pgns=pgns,sourceAddresses=sourceAddresses, spns=spns, ignore=ignore):
-            diff = []
-
-            # insert bookmark names/comments in appropriate places
-            while next_bkmk_idx < len(self.c.bookmarks) and idx >= self.c.bookmarks[next_bkmk_idx]:
-                out.append(self.c.reprBookmark(next_bkmk_idx))
-                next_bkmk_idx += 1
-
-            msg_count += 1
-
-            # check data
-            byte_cnt_diff = 0
-            if last_msg != None:
-                if len(last_msg) == len(msg):
-                    for bidx in range(len(msg)):
-                        if last_msg[bidx] != msg[bidx]:
-                            byte_cnt_diff += 1
+            yield "stoppng at bookmark %d: '%s'" % (bkmk, self.c.bookmark_info[bkmk].get('name'))
 
-                    if byte_cnt_diff == 0:
-                        diff.append("REPEAT")
-                        data_repeat += 1
-                    elif byte_cnt_diff <=4:
-                        diff.append("Similar")
-                        data_similar += 1
-                    # FIXME: make some better heuristic to identify "out of norm"
-
-            # look for ASCII data (4+ consecutive bytes)
-            if hasAscii(msg):
-                diff.append("ASCII: %s" % repr(msg))
-
-            # calculate timestamp delta and comment if out of whack
-            if last_ts == None:
-                last_ts = ts
-
-            delta_ts = ts - last_ts
-            if counted_msgs:
-                avg_delta_ts = tot_delta_ts / counted_msgs
-            else:
-                avg_delta_ts = delta_ts
-
-
-            if abs(delta_ts - avg_delta_ts) <= delta_ts:
-                tot_delta_ts += delta_ts
-                counted_msgs += 1
-            else:
-                diff.append("TS_delta: %.3f" % delta_ts)
-
-            out.append(self.reprJ1939Msg(idx, ts, arbid, msg, comment='\t'.join(diff)))
-            last_ts = ts
-            last_msg = msg
-
-        out.append("Total Messages: %d  (repeat: %d / similar: %d)" % (msg_count, data_repeat, data_similar))
-
-        return "\n".join(out)
+        msgs = ((idx, ts, arbid, msg) for idx, ts, arbid, pgn, msg in 
+                self._genFilteredJ1939Msgs(start_msg, stop_msg, start_baseline_msg, stop_baseline_msg, arbids=arbids, priorities=priorities, pgns=pgns, sourceAddresses=sourceAddresses, spns=spns, ignore=ignore))
+        for line in cancat.genReprMsgLines(cancat.genByteDiffs(msgs), self.c.bookmarks, self.c.reprBookmark, self.reprJ1939Msg):
+            yield line
 
     def reprJ1939Msg(self, idx, ts, arbid, data, comment=None):
         #TODO: make decoding spns optional
@@ -163,18 +97,21 @@ class J1939:
 
         for message indexes, you *will* want to look into the bookmarking subsystem!
         '''
+        return list(self._genFilteredJ1939Msgs(start_msg, stop_msg, start_baseline_msg, stop_baseline_msg, arbids, priorities, pgns, sourceAddresses, spns, ignore))
+
+    def _genFilteredJ1939Msgs(self, start_msg=0, stop_msg=None, start_baseline_msg=None, stop_baseline_msg=None, arbids=None, priorities=None, pgns=None, sourceAddresses=None, spns=None, ignore=[]):
         self.c.log("starting filtering messages...")
         if stop_baseline_msg != None:
             self.c.log("ignoring arbids from baseline...")
-            # get a list of baseline arbids
-            filter_ids = { arbid:1 for ts,arbid,data in self.genJ1939Msgs(start_baseline_msg, stop_baseline_msg)
-                }.keys()
+            # baseline arbids straight from the arbid index
+            filter_ids = set(self.c.getArbidCounts(start_baseline_msg or 0, stop_baseline_msg))
         else:
             filter_ids = None
         self.c.log("filtering messages...")
-        filteredMsgs = [(idx, ts,arbid, pgn, msg) for idx, ts,arbid, pgn, msg in self.genJ1939Msgs(start_msg, stop_msg, arbids=arbids, priorities=priorities, pgns=pgns,sourceAddresses=sourceAddresses, spns=spns)
-                if (type(arbids) == list and arbid in arbids) or arbid not in ignore and (filter_ids==None or arbid not in filter_ids)]
-        return filteredMsgs
+        ignore = set(ignore)
+        for idx, ts, arbid, pgn, msg in self.genJ1939Msgs(start_msg, stop_msg, arbids=arbids, priorities=priorities, pgns=pgns,sourceAddresses=sourceAddresses, spns=spns):
+            if (type(arbids) == list and arbid in arbids) or arbid not in ignore and (filter_ids==None or arbid not in filter_ids):
+                yield idx, ts, arbid, pgn, msg
 
     def getSPNs(self,pgn):
         '''
@@ -190,16 +127,10 @@ class J1939:
             CAN message generator.  takes in start/stop indexes as well as a list
             of desired arbids (list)
             '''
-            messages = self.c._messages.get(0x30, [])# CMD_CAN_RECV = 0x30
-            if stop == None:
-                stop = len(messages)
-            else:
-                stop = stop + 1 # This makes the stop index inclusive if specified
-
-            for idx in xrange(start, stop):
-                ts, msg = messages[idx]
-
-                arbid, data = self._splitCanMsg(msg)
+            # every filter depends only on the arbid, so decide once per arbid
+            # (from the capture's arbid index) which ones make it through
+            pgnsByArbid = {}
+            for arbid in self.c.getArbidCounts(start, stop):
                 priority, pgn, pgnName, sourceAddress = self.splitID(arbid)
                 currentSPNs=self.getSPNs(pgn)
 
@@ -224,7 +155,10 @@ class J1939:
                 if currentSPNs != None and spns != None and not any(x in spns for x in currentSPNs):
                     continue
 
-                yield((idx, ts, arbid, pgn, data))
+                pgnsByArbid[arbid] = pgn
+
+            for idx, ts, arbid, data in self.c.genCanMsgs(start, stop, arbids=pgnsByArbid.keys()):
+                yield((idx, ts, arbid, pgnsByArbid[arbid], data))
 
     def _splitCanMsg(self, msg):
             '''
@@ -0,0 +1,278 @@
+'''
+Append-only capture journal.
+
+While sniffing, a CanInterface can stream every received frame, bookmark
+and comment into a journal file (see CanInterface.startJournal()).  If
+the process dies or the USB cable gets yanked, everything up to the last
+flush is still on disk, and loadFromFile() can read it back.
+
+File layout:
+    header:     JOURNAL_MAGIC
+    batches:    '<4sII' BATCH_MAGIC, body length, crc32(body)  + body
+
+Each body is a run of records, one byte of record type followed by:
+    REC_FRAME:      '<dBB' timestamp, cmd, msg length  + raw msg
+    REC_BOOKMARK:   '<II' bookmark index, msg index  + name + comment
+    REC_COMMENT:    comment
+
+where strings are a '<H' length (0xffff for None) followed by the bytes.
+
+A batch that was only partly written (or doesn't match its crc) ends the
+journal, so a torn write costs at most the last flush interval.
+'''
+import os
+import sys
+import time
+import zlib
+import struct
+import threading
+import collections
+
+from cancat.capture import CanCapture
+
+JOURNAL_MAGIC = 'CCJRNL\x00\x01'
+BATCH_MAGIC = 'CCJB'
+BATCH_HDR = '<4sII'
+BATCH_HDR_LEN = struct.calcsize(BATCH_HDR)
+
+REC_FRAME = 1
+REC_BOOKMARK = 2
+REC_COMMENT = 3
+
+FRAME_HDR = '<BdBB'
+FRAME_HDR_LEN = struct.calcsize(FRAME_HDR)
+
+# records per batch when writing out a backlog
+BACKLOG_BATCH = 4096
+
+
+def _packString(string):
+    if string == None:
+        return struct.pack('<H', 0xffff)
+    string = str(string)
+    return struct.pack('<H', len(string)) + string
+
+def _unpackString(body, offset):
+    length, = struct.unpack_from('<H', body, offset)
+    offset += 2
+    if length == 0xffff:
+        return None, offset
+    return body[offset:offset+length], offset + length
+
+
+class CanJournal:
+    '''
+    Writes journal records handed to it by the receiver thread.
+
+    logFrame()/logBookmark()/logComment() only queue a tuple; a writer
+    thread packs whatever is queued every flush_interval seconds, writes
+    it as one batch and fsyncs every fsync_interval seconds.
+
+    backlog is an optional iterable of records (same tuples as above) the
+    writer thread writes out before anything queued, eg. what was captured
+    before the journal was started.
+
+    refuses to write over an existing, non-empty file unless overwrite=True
+    '''
+    def __init__(self, filename, flush_interval=.1, fsync_interval=1.0, backlog=None, overwrite=False):
+        if not overwrite and os.path.exists(filename) and os.path.getsize(filename):
+            raise Exception("%s already exists (pass overwrite=True to replace it)" % filename)
+
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+
+        self.batches = 0
+        self.records = 0
+        self.bytes = 0
+
+        self._queue = collections.deque()
+        self._backlog = backlog
+        self._go = True
+        self._file = open(filename, 'wb')
+        self._file.write(JOURNAL_MAGIC)
+
+        self._thread = threading.Thread(target=self._writer)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def logFrame(self, cmd, timestamp, message):
+        self._queue.append((REC_FRAME, timestamp, cmd, message))
+
+    def logBookmark(self, bkmk_index, msg_index, name, comment):
+        self._queue.append((REC_BOOKMARK, bkmk_index, msg_index, name, comment))
+
+    def logComment(self, comment):
+        self._queue.append((REC_COMMENT, comment))
+
+    def close(self):
+        '''
+        flush everything queued so far and close the journal
+        '''
+        self._go = False
+        self._thread.join()
+
+    def _pack(self, record):
+        rtype = record[0]
+        if rtype == REC_FRAME:
+            rtype, timestamp, cmd, message = record
+            return struct.pack(FRAME_HDR, rtype, timestamp, cmd, len(message)) + message
+
+        elif rtype == REC_BOOKMARK:
+            rtype, bkmk_index, msg_index, name, comment = record
+            return struct.pack('<BII', rtype, bkmk_index, msg_index) + _packString(name) + _packString(comment)
+
+        elif rtype == REC_COMMENT:
+            return chr(rtype) + _packString(record[1])
+
+    def _writeBatch(self, records):
+        body = ''.join([self._pack(record) for record in records])
+        hdr = struct.pack(BATCH_HDR, BATCH_MAGIC, len(body), zlib.crc32(body) & 0xffffffff)
+        self._file.write(hdr + body)
+
+        self.batches += 1
+        self.records += len(records)
+        self.bytes += len(hdr) + len(body)
+
+    def _writeBacklog(self):
+        records = []
+        for record in self._backlog:
+            records.append(record)
+            if len(records) >= BACKLOG_BATCH:
+                self._writeBatch(records)
+                records = []
+
+        if records:
+            self._writeBatch(records)
+        self._backlog = None
+
+    def flush(self, sync=False):
+        '''
+        write out everything queued as one batch (writer thread only)
+        '''
+        queue = self._queue
+        count = len(queue)
+        if count:
+            self._writeBatch([queue.popleft() for x in xrange(count)])
+
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+
+    def _writer(self):
+        if self._backlog != None:
+            self._writeBacklog()
+
+        last_sync = time.time()
+        while self._go:
+            time.sleep(self.flush_interval)
+            try:
+                now = time.time()
+                sync = (now - last_sync) >= self.fsync_interval
+                self.flush(sync)
+                if sync:
+                    last_sync = now
+            except:
+                sys.excepthook(*sys.exc_info())
+
+        self.flush(True)
+        self._file.close()
+
+
+def isJournal(filename):
+    infile = open(filename, 'rb')
+    try:
+        return infile.read(len(JOURNAL_MAGIC)) == JOURNAL_MAGIC
+    finally:
+        infile.close()
+
+def genJournalRecords(filename):
+    '''
+    yields the records in a journal as tuples, like the ones handed to
+    CanJournal: (REC_FRAME, timestamp, cmd, message),
+    (REC_BOOKMARK, bkmk_index, msg_index, name, comment), (REC_COMMENT, comment)
+
+    stops quietly at the first incomplete or damaged batch
+    '''
+    infile = open(filename, 'rb')
+    try:
+        if infile.read(len(JOURNAL_MAGIC)) != JOURNAL_MAGIC:
+            raise Exception("%s is not a CanCat journal" % filename)
+
+        while True:
+            hdr = infile.read(BATCH_HDR_LEN)
+            if len(hdr) < BATCH_HDR_LEN:
+                return
+
+            magic, length, crc = struct.unpack(BATCH_HDR, hdr)
+            if magic != BATCH_MAGIC:
+                return
+
+            body = infile.read(length)
+            if len(body) < length or (zlib.crc32(body) & 0xffffffff) != crc:
+                return
+
+            offset = 0
+            while offset < length:
+                rtype = ord(body[offset])
+                if rtype == REC_FRAME:
+                    rtype, timestamp, cmd, msglen = struct.unpack_from(FRAME_HDR, body, offset)
+                    offset += FRAME_HDR_LEN
+                    yield (rtype, timestamp, cmd, body[offset:offset+msglen])
+                    offset += msglen
+
+                elif rtype == REC_BOOKMARK:
+                    rtype, bkmk_index, msg_index = struct.unpack_from('<BII', body, offset)
+                    name, offset = _unpackString(body, offset + 9)
+                    comment, offset = _unpackString(body, offset)
+                    yield (rtype, bkmk_index, msg_index, name, comment)
+
+                elif rtype == REC_COMMENT:
+                    comment, offset = _unpackString(body, offset + 1)
+                    yield (rtype, comment)
+
+                else:
+                    # unknown record type, can't go any further
+                    return
+    finally:
+        infile.close()
+
+def loadJournal(filename, newMailbox=None):
+    '''
+    rebuild a session dictionary (like CanInterface.saveSession() returns)
+    from a journal.  newMailbox(cmd) creates each mailbox (a CanCapture
+    by default).
+    '''
+    if newMailbox == None:
+        newMailbox = lambda cmd: CanCapture()
+
+    messages = {}
+    bookmarks = []
+    bookmark_info = {}
+    comments = []
+
+    for record in genJournalRecords(filename):
+        rtype = record[0]
+        if rtype == REC_FRAME:
+            rtype, timestamp, cmd, message = record
+            mbox = messages.get(cmd)
+            if mbox == None:
+                mbox = newMailbox(cmd)
+                messages[cmd] = mbox
+            mbox.append((timestamp, message))
+
+        elif rtype == REC_BOOKMARK:
+            rtype, bkmk_index, msg_index, name, comment = record
+            if bkmk_index == len(bookmarks):
+                bookmarks.append(msg_index)
+            bookmark_info[bkmk_index] = { 'name' : name,
+                    'comment' : comment }
+
+        elif rtype == REC_COMMENT:
+            comments.append(record[1])
+
+    return { 'messages' : messages,
+            'bookmarks' : bookmarks,
+            'bookmark_info' : bookmark_info,
+            'comments' : comments,
+            }
@@ -0,0 +1,351 @@
+'''
+CAN log files, to and from other tools.
+
+Captures from SocketCAN's "candump -l", Vector ASC files and CSV exports
+load straight into a CanCapture (see loadLog()), a line at a time: the
+gen*Frames() parsers yield (timestamp, arbid, data) as they read, so
+memory use is the capture's own (which can spill to disk, see
+CanCapture's max_memory) and nothing else.
+
+    candump     (1436509052.249713) vcan0 123#DEADBEEF
+                timestamps as logged (seconds since the epoch).  remote
+                frames load with no data, CAN FD frames (123##1...) with
+                their data, error frames are skipped
+    asc         Vector ASC: "   0.002000 1  18FEF100x  Rx   d 8 01 02 ..."
+                timestamps relative to the start of the log, IDs hex
+                unless the header says "base dec".  error frames, CAN FD
+                and other events are skipped
+    csv         a header row naming the timestamp, ID and data columns
+                (see CSV_TIME/CSV_ID/CSV_DATA), data either one column
+                of hex or one column per byte (D1..D8 and the like), and
+                optionally an extended flag column (CSV_EXT).
+                without a header row: timestamp, ID, hex data
+
+IDs are stored as their 11 or 29 bit value, and IDs over 0x7ff are taken
+to be extended.  An extended ID that isn't (candump's 8 digit 00000123,
+ASC's 123x, or flagged in a CSV) keeps SocketCAN's CAN_EFF_FLAG, so
+0x80000123 is a different arbid than 0x123, and exports as extended again
+(see arbidFlags()).  Lines that don't parse (a cut off data byte, a bad
+ID...) are skipped, not the rest of the log.
+
+exportLog() goes the other way, writing (idx, timestamp, arbid, data)
+messages as a candump -l log or a pcap file (LINKTYPE_CAN_SOCKETCAN, for
+Wireshark) a batch of EXPORT_BATCH messages at a time.
+'''
+import re
+import csv
+import struct
+from binascii import hexlify, unhexlify
+
+# how many bytes to look at to work out what kind of log a file is
+DETECT_BYTES = 4096
+
+# CSV header names (lower case) for the timestamp, ID, data and length columns
+CSV_TIME = ('time', 'timestamp', 'time stamp', 'ts')
+CSV_ID = ('id', 'arbid', 'arbitration id', 'can id', 'canid', 'identifier')
+CSV_DATA = ('data', 'payload', 'bytes', 'data bytes')
+CSV_LEN = ('len', 'dlc', 'length')
+CSV_EXT = ('extended', 'ext', 'ide', 'xtd')
+# per-byte data columns: D1..D8, B0..B7, Data0...
+_csv_byte = re.compile(r'^(d|b|byte|data)\s*(\d+)$')
+
+# SocketCAN can_id flags, and the ID bits of an extended can_id
+CAN_EFF_FLAG = 0x80000000
+CAN_ERR_FLAG = 0x20000000
+CAN_EFF_MASK = 0x1fffffff
+# canfd_frame flags: it's a CAN FD frame
+CANFD_FDF = 0x04
+
+# messages per write when exporting
+EXPORT_BATCH = 4096
+
+# pcap file header (microsecond timestamps) and record header
+LINKTYPE_CAN_SOCKETCAN = 227
+PCAP_HDR = struct.Struct('<IHHiIII')
+PCAP_REC = struct.Struct('<IIII')
+# SocketCAN can_frame/canfd_frame header: can_id (big endian for this
+# linktype), length, flags, 2 reserved bytes
+CAN_FRAME_HDR = struct.Struct('>IBB2x')
+
+_candump_line = re.compile(r'^\(\d+(\.\d+)?\)\s+\S+\s+[0-9A-Fa-f]+#')
+_asc_frame = re.compile(r'^\s*\d+\.\d+\s+\d+\s+[0-9A-Fa-f]+x?\s+(Rx|Tx)\s+[dDrR]\b')
+_not_text = re.compile('[^\t\r\n\x20-\x7e]')
+_asc_header = ('date ', 'base ', 'internal events', 'Begin Triggerblock', 'no internal events')
+
+
+def detectFormat(filename):
+    '''
+    returns 'candump', 'asc' or 'csv' for a log file, or None if it
+    doesn't look like one (eg. a saved session)
+    '''
+    infile = open(filename, 'rb')
+    try:
+        head = infile.read(DETECT_BYTES)
+    finally:
+        infile.close()
+
+    # sessions, journals and pickles aren't plain text
+    if _not_text.search(head) or not head.strip():
+        return None
+
+    lines = [line.strip() for line in head.splitlines() if line.strip()]
+    if _candump_line.match(lines[0]):
+        return 'candump'
+    for line in lines:
+        if line.startswith(_asc_header) or _asc_frame.match(line):
+            return 'asc'
+    if ',' in lines[0] or filename.lower().endswith('.csv'):
+        return 'csv'
+    return None
+
+def extendedArbid(arbid, extended):
+    '''
+    the arbid to store for an ID that's extended or not: IDs over 0x7ff 
+    can only be extended, so only one that could pass for a standard ID
+    needs CAN_EFF_FLAG to say so
+    '''
+    if extended and arbid <= 0x7ff:
+        return arbid | CAN_EFF_FLAG
+    return arbid
+
+def arbidFlags(arbid):
+    '''
+    returns (ID, extended) for a stored arbid: CAN_EFF_FLAG if it has it,
+    otherwise IDs over 0x7ff are extended
+    '''
+    if arbid & CAN_EFF_FLAG:
+        return arbid & CAN_EFF_MASK, True
+    return arbid, arbid > 0x7ff
+
+def genCandumpFrames(infile):
+    '''
+    yields (timestamp, arbid, data) for the frames in a candump -l log
+    '''
+    for line in infile:
+        parts = line.split()
+        if len(parts) < 3 or not parts[0].startswith('('):
+            continue
+
+        arbid, sep, data = parts[2].partition('#')
+        if not sep:
+            continue
+        # candump writes extended IDs as 8 digits, standard ones as 3
+        extended = len(arbid) > 3
+
+        if data[:1] == '#':
+            # CAN FD: a nibble of flags, then the data
+            data = data[2:]
+        elif data[:1] in ('R', 'r'):
+            data = ''
+        try:
+            ts = float(parts[0][1:-1])
+            arbid = int(arbid, 16)
+            data = unhexlify(data)
+        except (ValueError, TypeError):
+            continue
+
+        if arbid & CAN_ERR_FLAG:
+            continue
+        yield ts, extendedArbid(arbid & CAN_EFF_MASK, extended), data
+
+def genAscFrames(infile):
+    '''
+    yields (timestamp, arbid, data) for the CAN frames in a Vector ASC log
+    '''
+    base = 16
+    for line in infile:
+        parts = line.split()
+        if len(parts) >= 2 and parts[0] == 'base':
+            base = (parts[1] == 'dec') and 10 or 16
+            continue
+        if len(parts) < 5:
+            continue
+
+        # timestamp, channel, ID, Rx/Tx, d/r, dlc, data...
+        ftype = parts[4]
+        if ftype not in ('d', 'D', 'r', 'R') or not parts[1].isdigit():
+            continue
+        try:
+            ts = float(parts[0])
+            arbid = parts[2]
+            extended = arbid[-1] in ('x', 'X')
+            if extended:
+                arbid = arbid[:-1]
+            arbid = extendedArbid(int(arbid, base), extended)
+        except ValueError:
+            continue
+
+        if ftype in ('r', 'R'):
+            yield ts, arbid, ''
+            continue
+
+        if len(parts) < 6:
+            continue
+        try:
+            dlc = int(parts[5], 16)
+            data = unhexlify(''.join(parts[6:6 + dlc]))
+        except (ValueError, TypeError):
+            continue
+        yield ts, arbid, data
+
+def _csvColumns(header):
+    '''
+    returns (time, id, data, length, ext, bytes) column numbers from a CSV
+    header row (data, length, ext None if missing, bytes a list of 
+    per-byte columns), or None if it isn't a header
+    '''
+    names = [name.strip().lower() for name in header]
+    columns = {}
+    byte_columns = []
+    for num, name in enumerate(names):
+        for key, choices in (('time', CSV_TIME), ('id', CSV_ID), ('data', CSV_DATA), ('len', CSV_LEN),
+                ('ext', CSV_EXT)):
+            if name in choices and key not in columns:
+                columns[key] = num
+        match = _csv_byte.match(name)
+        if match and name not in CSV_DATA:
+            byte_columns.append((int(match.group(2)), num))
+
+    if 'time' not in columns or 'id' not in columns:
+        return None
+    byte_columns.sort()
+    return (columns['time'], columns['id'], columns.get('data'), columns.get('len'),
+            columns.get('ext'), [num for byte, num in byte_columns])
+
+def genCsvFrames(infile, time_scale=1.0):
+    '''
+    yields (timestamp, arbid, data) for the frames in a CSV log.
+    timestamps are multiplied by time_scale (eg. 1e-6 for logs in
+    microseconds, like SavvyCAN's)
+    '''
+    reader = csv.reader(infile)
+    time_col, id_col, data_col, len_col, ext_col, byte_cols = 0, 1, 2, None, None, []
+    header = True
+    for row in reader:
+        if not row:
+            continue
+
+        if header:
+            # a header row, if there is one, comes before the frames
+            header = False
+            columns = _csvColumns(row)
+            if columns != None:
+                time_col, id_col, data_col, len_col, ext_col, byte_cols = columns
+                if data_col == None and not byte_cols:
+                    raise Exception("can't find the data in CSV columns %r" % row)
+                continue
+
+        try:
+            ts = float(row[time_col]) * time_scale
+            arbid = int(row[id_col], 16)
+
+            if data_col != None:
+                data = ''.join(row[data_col].split())
+                if data[:2] in ('0x', '0X'):
+                    data = data[2:]
+                data = unhexlify(data)
+            else:
+                data = ''.join([chr(int(row[num], 16)) for num in byte_cols
+                        if num < len(row) and row[num].strip()])
+
+            if len_col != None and len_col < len(row) and row[len_col].strip():
+                data = data[:int(row[len_col])]
+
+            if ext_col != None and ext_col < len(row):
+                extended = row[ext_col].strip().lower() in ('true', '1', 'x', 'yes')
+                arbid = extendedArbid(arbid, extended)
+        except (ValueError, TypeError, IndexError):
+            continue
+        yield ts, arbid, data
+
+LOG_PARSERS = { 'candump' : genCandumpFrames,
+        'asc' : genAscFrames,
+        'csv' : genCsvFrames,
+        }
+
+def loadLog(filename, capture, fmt=None):
+    '''
+    read the frames in a log file into capture (a CanCapture), returning
+    how many there were.  fmt is 'candump', 'asc' or 'csv', or worked out
+    from the file if None
+    '''
+    if fmt == None:
+        fmt = detectFormat(filename)
+        if fmt == None:
+            raise Exception("can't tell what kind of log %s is" % filename)
+
+    parser = LOG_PARSERS.get(fmt)
+    if parser == None:
+        raise Exception("unknown log format %r (try one of %s)" % (fmt, ', '.join(sorted(LOG_PARSERS))))
+
+    infile = open(filename, 'rb')
+    try:
+        return capture.extendFrames(parser(infile))
+    finally:
+        infile.close()
+
+def _candumpLines(msgs, iface):
+    for idx, ts, arbid, data in msgs:
+        arbid, extended = arbidFlags(arbid)
+        if extended:
+            arbid = '%08X' % arbid
+        else:
+            arbid = '%03X' % arbid
+
+        if len(data) > 8:
+            yield '(%.6f) %s %s##0%s\n' % (ts, iface, arbid, hexlify(data).upper())
+        else:
+            yield '(%.6f) %s %s#%s\n' % (ts, iface, arbid, hexlify(data).upper())
+
+def _pcapRecords(msgs):
+    pack_rec = PCAP_REC.pack
+    pack_frame = CAN_FRAME_HDR.pack
+    for idx, ts, arbid, data in msgs:
+        arbid, extended = arbidFlags(arbid)
+        if extended:
+            arbid |= CAN_EFF_FLAG
+
+        if len(data) > 8:
+            frame = pack_frame(arbid, len(data), CANFD_FDF) + data + '\x00' * (64 - len(data))
+        else:
+            frame = pack_frame(arbid, len(data), 0) + data + '\x00' * (8 - len(data))
+
+        sec = int(ts)
+        usec = int(round((ts - sec) * 1000000))
+        if usec >= 1000000:
+            sec += 1
+            usec -= 1000000
+        yield pack_rec(sec, usec, len(frame), len(frame)) + frame
+
+def exportLog(filename, msgs, fmt='pcap', iface='can0'):
+    '''
+    write (idx, timestamp, arbid, data) messages to filename as a pcap 
+    file (fmt='pcap') or a candump -l log (fmt='candump', as if captured
+    on iface), returning how many there were.  Extended IDs (see 
+    arbidFlags()) are written as extended, messages over 8 bytes as CAN FD
+    '''
+    if fmt == 'pcap':
+        records = _pcapRecords(msgs)
+    elif fmt == 'candump':
+        records = _candumpLines(msgs, iface)
+    else:
+        raise Exception("can't export to %r (try 'pcap' or 'candump')" % fmt)
+
+    count = 0
+    outfile = open(filename, 'wb')
+    try:
+        if fmt == 'pcap':
+            outfile.write(PCAP_HDR.pack(0xa1b2c3d4, 2, 4, 0, 0, 65535, LINKTYPE_CAN_SOCKETCAN))
+
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= EXPORT_BATCH:
+                outfile.write(''.join(batch))
+                count += len(batch)
+                batch = []
+        outfile.write(''.join(batch))
+        count += len(batch)
+    finally:
+        outfile.close()
+    return count
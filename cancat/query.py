@@ -0,0 +1,646 @@
+'''
+A little query language for picking CAN messages out of a capture:
+
+    >>> c.printCanMsgsByQuery("arbid in 0x700..0x7ff and data[0] & 0xf0 == 0x10 and t in bkmk(2)..bkmk(3)")
+
+Fields (of each message):
+    arbid           arbitration id
+    idx             message index
+    t, ts           timestamp
+    len, dlc        data length
+    data[i]         data byte i
+    data[i:j]       data bytes i through j-1, as a big endian number
+
+a comparison with a data byte a message is too short for is false.
+
+Values are numbers (decimal, 0x hex, or decimal fractions for times),
+arithmetic/bitwise on them (| ^ & << >> + - * / %, as in Python), and:
+    bkmk(n)         bookmark n: its message index, or its time when
+                    compared with t
+    arbids(a..b)    the set of arbids seen in messages a through b (message
+                    indexes, or bkmk()s).  "arbid not in arbids(bkmk(0)..bkmk(1))"
+                    is filterCanMsgs()'s baseline.
+
+Conditions are comparisons (== != < <= > >=), "x in <set>" and "x not in
+<set>", where a set is a range (lo..hi, both inclusive), a {braced, list}
+of values and ranges, or arbids(), combined with and/or/not and brackets.
+
+A Query is parsed once, and turned into both a Python function and a NumPy
+expression over whole CanArrays.  Each time it's run, conditions on their
+own at the top level (joined by "and") narrow down what has to be looked
+at: arbid-only conditions are worked out once per arbid seen and passed on
+as an arbid list (so the arbid index is used), and idx/t bounds become a
+message index range (t through the time index).
+'''
+import re
+
+class QueryError(Exception):
+    pass
+
+
+_token_re = re.compile(r'''\s*(?:
+        (?P<num>0[xX][0-9a-fA-F]+|\d+\.\d+(?!\.)|\d+)|
+        (?P<name>[A-Za-z_][A-Za-z_0-9]*)|
+        (?P<op>\.\.|==|!=|<=|>=|<<|>>|[<>&|^+\-*/%()\[\]{},:])
+        )''', re.VERBOSE)
+
+FIELDS = {
+        'arbid': 'arbid',
+        'idx': 'idx',
+        't': 'ts',
+        'ts': 'ts',
+        'len': 'len',
+        'dlc': 'len',
+        }
+
+# binary operators, loosest binding first (as in Python)
+BINOP_LEVELS = (('|',), ('^',), ('&',), ('<<', '>>'), ('+', '-'), ('*', '/', '%'))
+COMPARISONS = ('==', '!=', '<', '<=', '>', '>=')
+# tokens that can follow a value in a condition
+_value_ops = COMPARISONS + ('in', 'not') + sum(BINOP_LEVELS, ())
+
+# what a comparison says about the field on its left when flipped around
+_flipped = {'==': '==', '!=': '!=', '<': '>', '<=': '>=', '>': '<', '>=': '<='}
+
+
+def _tokenize(text):
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = _token_re.match(text, pos)
+        if match == None or match.end() == pos:
+            raise QueryError("can't make sense of %r (at %d)" % (text[pos:pos+10], pos))
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind), match.start(kind)))
+        pos = match.end()
+    tokens.append(('end', None, len(text)))
+    return tokens
+
+
+class _Parser:
+    '''
+    recursive descent parser.  nodes are tuples:
+        ('or', a, b) ('and', a, b) ('not', a)
+        ('cmp', op, left, right)
+        ('in', value, items, negated)   items: [('range', lo, hi) / value, ...]
+                                        or ('arbids', lo, hi)
+        ('num', n) ('field', name) ('data', start, stop) ('bkmk', n)
+        ('binop', op, left, right)
+    '''
+    def __init__(self, text):
+        self.text = text
+        self.tokens = _tokenize(text)
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos]
+
+    def next(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def accept(self, value):
+        kind, tok, offset = self.peek()
+        if kind in ('op', 'name') and tok == value:
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, value):
+        if not self.accept(value):
+            self.error("expected %r" % value)
+
+    def error(self, message):
+        kind, tok, offset = self.peek()
+        if tok == None:
+            raise QueryError("%s at the end of %r" % (message, self.text))
+        raise QueryError("%s at %r (offset %d)" % (message, tok, offset))
+
+    def parse(self):
+        node = self.parseOr()
+        if self.peek()[0] != 'end':
+            self.error("unexpected")
+        return node
+
+    def parseOr(self):
+        node = self.parseAnd()
+        while self.accept('or'):
+            node = ('or', node, self.parseAnd())
+        return node
+
+    def parseAnd(self):
+        node = self.parseNot()
+        while self.accept('and'):
+            node = ('and', node, self.parseNot())
+        return node
+
+    def parseNot(self):
+        if self.accept('not'):
+            return ('not', self.parseNot())
+        return self.parseCondition()
+
+    def parseCondition(self):
+        # brackets around conditions, or just around a value?  try the
+        # former, and back up if it doesn't work out
+        if self.peek()[1] == '(':
+            start = self.pos
+            self.next()
+            cond_error = None
+            try:
+                node = self.parseOr()
+                self.expect(')')
+                if self.peek()[1] not in _value_ops:
+                    return node
+            except QueryError, e:
+                cond_error = e
+
+            self.pos = start
+            try:
+                return self.parseComparison()
+            except QueryError:
+                if cond_error != None:
+                    raise cond_error
+                raise
+
+        return self.parseComparison()
+
+    def parseComparison(self):
+        left = self.parseValue()
+        kind, tok, offset = self.peek()
+
+        if tok in COMPARISONS:
+            self.next()
+            return ('cmp', tok, left, self.parseValue())
+
+        negated = False
+        if self.accept('not'):
+            negated = True
+            self.expect('in')
+        elif not self.accept('in'):
+            self.error("expected a comparison or 'in'")
+
+        return ('in', left, self.parseSet(), negated)
+
+    def parseSet(self):
+        if self.accept('{'):
+            items = []
+            if not self.accept('}'):
+                while True:
+                    items.append(self.parseItem())
+                    if self.accept('}'):
+                        break
+                    self.expect(',')
+            return items
+
+        if self.accept('arbids'):
+            self.expect('(')
+            lo = self.parseValue()
+            self.expect('..')
+            hi = self.parseValue()
+            self.expect(')')
+            return ('arbids', lo, hi)
+
+        item = self.parseItem()
+        if item[0] != 'range':
+            self.error("expected a range (lo..hi)")
+        return [item]
+
+    def parseItem(self):
+        value = self.parseValue()
+        if self.accept('..'):
+            return ('range', value, self.parseValue())
+        return value
+
+    def parseValue(self, level=0):
+        if level == len(BINOP_LEVELS):
+            return self.parseAtom()
+
+        node = self.parseValue(level + 1)
+        while self.peek()[0] == 'op' and self.peek()[1] in BINOP_LEVELS[level]:
+            op = self.next()[1]
+            node = ('binop', op, node, self.parseValue(level + 1))
+        return node
+
+    def parseAtom(self):
+        kind, tok, offset = self.next()
+        if kind == 'num':
+            if tok[:2] in ('0x', '0X'):
+                return ('num', int(tok, 16))
+            if '.' in tok:
+                return ('num', float(tok))
+            return ('num', int(tok))
+
+        if kind == 'op' and tok == '(':
+            node = self.parseValue()
+            self.expect(')')
+            return node
+
+        if kind == 'op' and tok == '-':
+            return ('binop', '-', ('num', 0), self.parseAtom())
+
+        if kind == 'name':
+            if tok in FIELDS:
+                return ('field', FIELDS[tok])
+
+            if tok == 'data':
+                self.expect('[')
+                start = self.parseIndex()
+                stop = start + 1
+                if self.accept(':'):
+                    stop = self.parseIndex()
+                    if stop <= start:
+                        self.pos -= 1
+                        self.error("empty data slice")
+                self.expect(']')
+                return ('data', start, stop)
+
+            if tok == 'bkmk':
+                self.expect('(')
+                bkmk = self.parseIndex()
+                self.expect(')')
+                return ('bkmk', bkmk)
+
+        self.pos -= 1
+        self.error("expected a value")
+
+    def parseIndex(self):
+        kind, tok, offset = self.next()
+        if kind != 'num' or not tok.isdigit():
+            self.pos -= 1
+            self.error("expected a whole number")
+        return int(tok)
+
+
+def _fields(node):
+    '''
+    the set of fields a node looks at ('data' for any data byte)
+    '''
+    kind = node[0]
+    if kind == 'field':
+        return set([node[1]])
+    if kind == 'data':
+        return set(['data'])
+    if kind in ('num', 'bkmk'):
+        return set()
+    if kind in ('or', 'and'):
+        return _fields(node[1]) | _fields(node[2])
+    if kind == 'not':
+        return _fields(node[1])
+    if kind in ('cmp', 'binop'):
+        return _fields(node[2]) | _fields(node[3])
+    if kind == 'in':
+        fields = _fields(node[1])
+        if node[2] and node[2][0] == 'arbids':
+            return fields
+        for item in node[2]:
+            if item[0] == 'range':
+                fields |= _fields(item[1]) | _fields(item[2])
+            else:
+                fields |= _fields(item)
+        return fields
+    raise QueryError("bad query node %r" % (node,))
+
+def _conjuncts(node):
+    '''
+    the conditions "and"ed together at the top of a query
+    '''
+    if node[0] == 'and':
+        return _conjuncts(node[1]) + _conjuncts(node[2])
+    return [node]
+
+
+class _CodeGen:
+    '''
+    turns a query tree into the source of a Python expression over one
+    message (idx, ts, arbid, data) or a NumPy expression over a CanArrays
+    (A).  constants that can only be worked out when the query runs
+    (bookmarks, arbids()) become K[n], and self.consts says what each is.
+    '''
+    def __init__(self, vectorized):
+        self.vectorized = vectorized
+        self.consts = []
+
+    def const(self, kind, *args):
+        entry = (kind,) + args
+        if entry not in self.consts:
+            self.consts.append(entry)
+        return "K[%d]" % self.consts.index(entry)
+
+    def cond(self, node):
+        kind = node[0]
+        if kind in ('or', 'and'):
+            if self.vectorized:
+                joiner = {'or': '|', 'and': '&'}[kind]
+            else:
+                joiner = kind
+            return "(%s %s %s)" % (self.cond(node[1]), joiner, self.cond(node[2]))
+
+        if kind == 'not':
+            if self.vectorized:
+                return "(~%s)" % self.cond(node[1])
+            return "(not %s)" % self.cond(node[1])
+
+        guards = self.guards(node)
+        if kind == 'cmp':
+            op, left, right = node[1:]
+            time_ctx = self.timeContext(left, right)
+            code = "(%s %s %s)" % (self.value(left, time_ctx), op, self.value(right, time_ctx))
+
+        else:   # 'in'
+            value, items, negated = node[1:]
+            time_ctx = self.timeContext(value)
+            val = self.value(value, time_ctx)
+            if items and items[0] == 'arbids':
+                arbids = self.const('arbids', items[1], items[2])
+                if self.vectorized:
+                    code = "_in1d(%s, %s)" % (val, arbids)
+                else:
+                    code = "(%s in %s)" % (val, arbids)
+            else:
+                tests = []
+                for item in items:
+                    if item[0] == 'range':
+                        lo = self.value(item[1], time_ctx)
+                        hi = self.value(item[2], time_ctx)
+                        if self.vectorized:
+                            tests.append("((%s >= %s) & (%s <= %s))" % (val, lo, val, hi))
+                        else:
+                            tests.append("(%s <= %s <= %s)" % (lo, val, hi))
+                    else:
+                        tests.append("(%s == %s)" % (val, self.value(item, time_ctx)))
+
+                if not tests:
+                    tests = [("_false(A)", "False")[not self.vectorized]]
+                code = "(%s)" % (" or ", " | ")[self.vectorized].join(tests)
+
+            if negated:
+                code = ("(not %s)", "(~%s)")[self.vectorized] % code
+
+        if guards:
+            if self.vectorized:
+                code = "(%s & %s)" % (" & ".join(["(A.dlc >= %d)" % need for need in guards]), code)
+            else:
+                code = "(%s and %s)" % (" and ".join(["(len(data) >= %d)" % need for need in guards]), code)
+        return code
+
+    def guards(self, node):
+        '''
+        the data lengths a condition needs (just the longest)
+        '''
+        needs = []
+        def walk(node):
+            if node[0] == 'data':
+                needs.append(node[2])
+            elif isinstance(node, tuple):
+                for part in node[1:]:
+                    if isinstance(part, tuple):
+                        walk(part)
+                    elif isinstance(part, list):
+                        for item in part:
+                            walk(item)
+        walk(node)
+        if not needs:
+            return []
+        return [max(needs)]
+
+    def timeContext(self, *nodes):
+        for node in nodes:
+            if node == ('field', 'ts'):
+                return True
+        return False
+
+    def value(self, node, time_ctx=False):
+        kind = node[0]
+        if kind == 'num':
+            return repr(node[1])
+
+        if kind == 'field':
+            name = node[1]
+            if self.vectorized:
+                return {'arbid': "_arbid(A)", 'idx': "A.idx", 'ts': "A.ts", 'len': "_dlc(A)"}[name]
+            return {'arbid': "arbid", 'idx': "idx", 'ts': "ts", 'len': "len(data)"}[name]
+
+        if kind == 'data':
+            start, stop = node[1:]
+            if self.vectorized:
+                return "_bytes(A, %d, %d)" % (start, stop)
+            if stop == start + 1:
+                return "ord(data[%d])" % start
+            return "_beint(data[%d:%d])" % (start, stop)
+
+        if kind == 'bkmk':
+            if time_ctx:
+                return self.const('bkmktime', node[1])
+            return self.const('bkmk', node[1])
+
+        if kind == 'binop':
+            op, left, right = node[1:]
+            return "(%s %s %s)" % (self.value(left, time_ctx), op, self.value(right, time_ctx))
+
+        raise QueryError("bad query value %r" % (node,))
+
+
+def _beint(data):
+    return int(data.encode('hex'), 16)
+
+def _vectorHelpers():
+    import numpy
+
+    def _arbid(A):
+        return A.arbid.astype(numpy.int64)
+
+    def _dlc(A):
+        return A.dlc.astype(numpy.int64)
+
+    def _bytes(A, start, stop):
+        value = numpy.zeros(len(A), numpy.int64)
+        for col in range(start, stop):
+            value <<= 8
+            if col < A.data.shape[1]:
+                value |= A.data[:, col]
+        return value
+
+    def _in1d(values, arbids):
+        return numpy.in1d(values, list(arbids))
+
+    def _false(A):
+        return numpy.zeros(len(A), bool)
+
+    return {'_arbid': _arbid, '_dlc': _dlc, '_bytes': _bytes, '_in1d': _in1d, '_false': _false}
+
+
+class QueryPlan:
+    '''
+    what a query comes down to for one run:
+        start, stop     - the message index range (inclusive) to look through
+        arbids          - the arbids worth looking at (None for all)
+        count           - how many messages that is, if arbids is set
+        match           - match(idx, ts, arbid, data), or None if everything
+                          in range matches
+        matchArrays     - matchArrays(CanArrays) returns a mask (None without
+                          numpy, or if everything in range matches)
+    '''
+    def __init__(self, start, stop, arbids, count, match, matchArrays):
+        self.start = start
+        self.stop = stop
+        self.arbids = arbids
+        self.count = count
+        self.match = match
+        self.matchArrays = matchArrays
+
+    def __repr__(self):
+        arbids = 'all'
+        if self.arbids != None:
+            arbids = '%d (%d messages)' % (len(self.arbids), self.count)
+        return "<QueryPlan: messages %d-%d, arbids: %s%s>" % (self.start, self.stop, arbids,
+                ('', ', filtered')[self.match != None])
+
+
+class Query:
+    '''
+    A compiled query (see the top of cancat/query.py).  Build it once and
+    run it as often as you like: CanInterface.genCanMsgsByQuery() and
+    friends take either a Query or the text of one.
+    '''
+    def __init__(self, text):
+        self.text = text
+        self.tree = _Parser(text).parse()
+
+        # top level conditions on arbid alone are sorted out per arbid
+        self._arbid_conds = []
+        self._idx_bounds = []
+        self._time_bounds = []
+        residual = []
+        for cond in _conjuncts(self.tree):
+            fields = _fields(cond)
+            if fields == set(['arbid']):
+                self._arbid_conds.append(cond)
+                continue
+
+            if fields == set(['idx']):
+                self._idx_bounds.extend(self._bounds(cond, 'idx'))
+            elif fields == set(['ts']):
+                self._time_bounds.extend(self._bounds(cond, 'ts'))
+            residual.append(cond)
+
+        self._arbid_match, self._arbid_consts = self._compile(self._arbid_conds, False)
+        self._match, self._consts = self._compile(residual, False)
+        self._match_arrays, self._array_consts = self._compile(residual, True)
+
+    def __repr__(self):
+        return "<Query %r>" % self.text
+
+    def _bounds(self, cond, field):
+        '''
+        (op, value node) bounds on a field from a simple condition, or []
+        '''
+        if cond[0] == 'cmp':
+            op, left, right = cond[1:]
+            if left == ('field', field) and field not in _fields(right):
+                return [(op, right)]
+            if right == ('field', field) and field not in _fields(left):
+                return [(_flipped[op], left)]
+
+        elif cond[0] == 'in' and not cond[3] and cond[1] == ('field', field):
+            items = cond[2]
+            if len(items) == 1 and items[0][0] == 'range':
+                return [('>=', items[0][1]), ('<=', items[0][2])]
+        return []
+
+    def _compile(self, conds, vectorized):
+        '''
+        returns (a function making the matcher for a list of constants, the
+        constants it needs), or (None, []) if there's nothing to check
+        '''
+        if not conds:
+            return None, []
+
+        tree = conds[0]
+        for cond in conds[1:]:
+            tree = ('and', tree, cond)
+
+        gen = _CodeGen(vectorized)
+        code = gen.cond(tree)
+        if vectorized:
+            source = "lambda K: lambda A: %s" % code
+            namespace = {}
+            try:
+                namespace = _vectorHelpers()
+            except ImportError:
+                return None, []
+        else:
+            source = "lambda K: lambda idx, ts, arbid, data: %s" % code
+            namespace = {'_beint': _beint}
+        return eval(compile(source, '<query %r>' % self.text, 'eval'), namespace), gen.consts
+
+    def _resolve(self, c, consts):
+        '''
+        work out the run-time constants (bookmarks, arbids()) for a capture
+        '''
+        values = []
+        for const in consts:
+            kind = const[0]
+            if kind == 'bkmk':
+                values.append(c.getMsgIndexFromBookmark(const[1]))
+            elif kind == 'bkmktime':
+                ts = c.getBookmarkTime(const[1])
+                if ts == None:
+                    raise QueryError("bookmark %d has no time (the capture is empty)" % const[1])
+                values.append(ts)
+            elif kind == 'arbids':
+                lo = self._constValue(c, const[1])
+                hi = self._constValue(c, const[2])
+                values.append(set(c.getArbidCounts(lo, hi)))
+        return values
+
+    def _constValue(self, c, node, time_ctx=False):
+        '''
+        the value of a node made only of numbers and bookmarks
+        '''
+        if _fields(node):
+            raise QueryError("can't use message fields in %r" % (node,))
+        gen = _CodeGen(False)
+        code = gen.value(node, time_ctx)
+        return eval(code, {}, {'K': self._resolve(c, gen.consts)})
+
+    def plan(self, c, start=0, stop=None):
+        '''
+        returns the QueryPlan for running this query over messages start
+        through stop of a CanInterface
+        '''
+        if stop == None:
+            stop = c.getCanMsgCount() - 1
+
+        for op, node in self._idx_bounds:
+            value = self._constValue(c, node)
+            if op in ('>=', '>', '=='):
+                start = max(start, int(value) + (op == '>'))
+            if op in ('<=', '<', '=='):
+                stop = min(stop, int(value) - (op == '<' and value == int(value)))
+
+        for op, node in self._time_bounds:
+            value = self._constValue(c, node, True)
+            if op in ('>=', '>', '=='):
+                start = max(start, c.getMsgIndexFromTime(value, after=(op == '>')))
+            if op in ('<=', '<', '=='):
+                stop = min(stop, c.getMsgIndexFromTime(value, after=(op != '<')) - 1)
+
+        arbids = None
+        count = None
+        if self._arbid_match != None and start <= stop:
+            match = self._arbid_match(self._resolve(c, self._arbid_consts))
+            counts = c.getArbidCounts(start, stop)
+            arbids = [arbid for arbid in sorted(counts) if match(None, None, arbid, '')]
+            count = sum([counts[arbid] for arbid in arbids])
+
+        match = None
+        if self._match != None:
+            match = self._match(self._resolve(c, self._consts))
+
+        match_arrays = None
+        if self._match_arrays != None:
+            match_arrays = self._match_arrays(self._resolve(c, self._array_consts))
+
+        return QueryPlan(start, stop, arbids, count, match, match_arrays)
@@ -0,0 +1,145 @@
+'''
+Searching message data for known byte patterns: a VIN fragment, odometer
+bytes, a seed...
+
+Patterns (one, or a list to look for all at once) are byte strings, each
+with an optional mask of the same length: a data byte matches when
+(byte & mask) == (pattern byte & mask), so a mask of '\\xff\\x00\\xff' has a
+wildcard in the middle.  They're all compiled into one regex, which runs
+over the capture's payload storage a block at a time (see
+CanCapture.genPayloadMatches()), finding overlapping matches too.  Where
+several patterns match at the same spot, the first one listed wins.
+
+With span=True, a match can also run on from one message into the next
+messages of the same arbid (a string sent over several frames, say):
+each arbid's data is strung together and searched as one.
+
+ASCII strings are found the same way: asciiRegex() matches runs of the
+bytes hasAscii() counts as ASCII, and runs over the payload blobs (see
+CanCapture.genPayloadRuns()), the data of each arbid strung together, or
+reassembled ISO-TP messages.
+'''
+import re
+import bisect
+
+from cancat import iso_tp
+
+# the bytes hasAscii() counts as ASCII: '0' through '~'
+ASCII_CLASS = '[\x30-\x7e]'
+
+_ascii_regexes = {}
+
+
+def patternRegex(pattern, mask=None):
+    '''
+    returns the regex source matching one (masked) byte pattern
+    '''
+    if not len(pattern):
+        raise Exception("can't search for an empty pattern")
+    if mask != None and len(mask) != len(pattern):
+        raise Exception("pattern and mask have to be the same length (%d != %d)" % (len(pattern), len(mask)))
+
+    parts = []
+    for pos, byte in enumerate(bytearray(pattern)):
+        bits = 0xff
+        if mask != None:
+            bits = bytearray(mask)[pos]
+
+        if bits == 0xff:
+            parts.append(re.escape(chr(byte)))
+        elif bits == 0:
+            parts.append('.')
+        else:
+            values = [chr(value) for value in range(256) if value & bits == byte & bits]
+            parts.append('[%s]' % ''.join([re.escape(value) for value in values]))
+    return ''.join(parts)
+
+def compilePatterns(patterns, masks=None):
+    '''
+    compiles one pattern (and mask), or lists of them, into one regex for
+    CanCapture.genPayloadMatches(): group n+1 matches pattern n
+    '''
+    if isinstance(patterns, (str, bytearray)):
+        patterns = [patterns]
+        masks = [masks]
+    elif masks == None:
+        masks = [None] * len(patterns)
+
+    if len(masks) != len(patterns):
+        raise Exception("need a mask (or None) for each pattern")
+
+    # a lookahead, so overlapping matches turn up as well
+    alternatives = ['(%s)' % patternRegex(pattern, mask) for pattern, mask in zip(patterns, masks)]
+    return re.compile('(?=%s)' % '|'.join(alternatives), re.DOTALL)
+
+def genStreamMatches(regex, msgs):
+    '''
+    strings together the data of (idx, ts, arbid, data) messages (all the
+    same arbid) and yields (idx, offset, pattern_num, last_idx) for each
+    match, last_idx being the message it ends in
+    '''
+    idxs = []
+    starts = []
+    parts = []
+    pos = 0
+    for idx, ts, arbid, data in msgs:
+        idxs.append(idx)
+        starts.append(pos)
+        parts.append(data)
+        pos += len(data)
+
+    stream = ''.join(parts)
+    for match in regex.finditer(stream):
+        pos = match.start()
+        length = len(match.group(match.lastindex))
+        first = bisect.bisect_right(starts, pos) - 1
+        last = bisect.bisect_right(starts, pos + length - 1) - 1
+        yield idxs[first], pos - starts[first], match.lastindex - 1, idxs[last]
+
+def asciiRegex(minbytes=4):
+    '''
+    compiled regex matching runs of at least minbytes ASCII bytes
+    '''
+    minbytes = max(minbytes, 1)
+    regex = _ascii_regexes.get(minbytes)
+    if regex == None:
+        regex = re.compile('%s{%d,}' % (ASCII_CLASS, minbytes))
+        _ascii_regexes[minbytes] = regex
+    return regex
+
+def genStreamRuns(regex, msgs):
+    '''
+    strings together the data of (idx, ts, arbid, data) messages (all the
+    same arbid) and yields (first_idx, offset, last_idx, text) for each
+    match of regex (eg. asciiRegex()): the message it starts in, where in
+    that message's data, and the message it ends in
+    '''
+    idxs = []
+    starts = []
+    parts = []
+    pos = 0
+    for idx, ts, arbid, data in msgs:
+        idxs.append(idx)
+        starts.append(pos)
+        parts.append(data)
+        pos += len(data)
+
+    stream = ''.join(parts)
+    for match in regex.finditer(stream):
+        first = bisect.bisect_right(starts, match.start()) - 1
+        last = bisect.bisect_right(starts, match.end() - 1) - 1
+        yield idxs[first], match.start() - starts[first], idxs[last], match.group()
+
+def genIsoTpRuns(regex, msgs):
+    '''
+    reassembles the ISO-TP messages in (idx, ts, arbid, data) messages (all
+    the same arbid) and yields (first_idx, offset, last_idx, text) for each
+    match of regex within one, like genStreamRuns()
+    '''
+    for first_idx, last_idx, data, pieces in iso_tp.gen_msgs(msgs):
+        starts = [piece[0] for piece in pieces]
+        for match in regex.finditer(data):
+            first = bisect.bisect_right(starts, match.start()) - 1
+            last = bisect.bisect_right(starts, match.end() - 1) - 1
+            data_offset, idx, msg_offset = pieces[first]
+            yield idx, match.start() - data_offset + msg_offset, pieces[last][1], match.group()
@@ -0,0 +1,521 @@
+'''
+Session files.
+
+saveSessionToFile() writes sessions in this binary format (not a pickle).
+Received CAN messages are stored column-wise, the way a CanCapture keeps
+them in memory, so loading a session just mmaps the file and hands the
+blocks of messages to the capture (see CanCapture.attach()).  Nothing is
+read until it's used: opening a session costs a count of each arbid's
+messages per block, and a message costs the pages it's on.
+
+File layout:
+    header:     '<8sIQI' SESSION_MAGIC, version, toc position, toc length
+    then, for each save:
+    sections:   frame blocks, other mailboxes, session info
+    toc:        table of contents (JSON): where each section is, the
+                byte order and offset size the columns were written with,
+                and where the previous save's toc is
+
+The first save writes everything.  Saving again to the same file only 
+appends what's new since (see saveSession()): frames as more blocks, the
+session info that changed, and a toc linking back to the one before; the
+header is rewritten last to point at it.
+
+Frame blocks hold up to STATS_CHUNK messages of one capture, lined up
+with its stats chunks:
+    timestamps, arbids, lengths, offsets, payload
+                - the CaptureBlock columns (native byte order)
+    index       - the block's slice of the arbid index (see
+                  capture.packIndex()), read back when it's needed
+    stats       - the block's stats chunk (see stats.packStats())
+and the toc has each block's message range, its first, last and latest
+timestamps, and whether they're in order (see CanCapture).
+
+In a compressed session (saveSession(compress=True)) the columns of each
+block are zlib compressed together, and so is its index, so each block
+decompresses on its own: reading messages only decompresses the blocks 
+they're in, found by message index or timestamp from the toc.
+
+Other mailboxes (logs and such) are a run of '<dI' timestamp, length
+records, each followed by the message, saved whole each time.  The 
+session info section is JSON of what changed in everything else in the
+saveSession() dict (bookmarks, bookmark info, comments...): 
+{ 'set' : { key : value }, 'append' : { key : items added to the list } }
+
+Sessions saved by older versions (pickles) still load, and get saved in
+this format from then on: there's no saving back to a pickle.
+'''
+import os
+import sys
+import json
+import mmap
+import zlib
+import struct
+import collections
+import multiprocessing
+from array import array
+from multiprocessing.pool import ThreadPool
+
+from cancat.capture import CanCapture, SpilledBlock, SpilledStats, packIndex, indexCounts
+from cancat.stats import STATS_CHUNK, packStats
+
+SESSION_MAGIC = 'CCSESS\x00\x01'
+SESSION_VERSION = 3
+
+HEADER = '<8sIQI'
+HEADER_LEN = struct.calcsize(HEADER)
+
+MBOX_REC = '<dI'
+MBOX_REC_LEN = struct.calcsize(MBOX_REC)
+
+# CaptureBlock columns, in on-disk order
+COLUMN_TYPES = ('d', 'I', 'B', 'L')
+
+# zlib level for compressed sessions: higher levels are several times
+# slower and barely shrink bus traffic any further
+COMPRESS_LEVEL = 1
+# blocks being compressed at once (per worker) while saving
+COMPRESS_BACKLOG = 2
+
+
+def isSession(filename):
+    '''
+    is filename a session file (as opposed to a pickle or a journal)?
+    '''
+    infile = open(filename, 'rb')
+    try:
+        return infile.read(len(SESSION_MAGIC)) == SESSION_MAGIC
+    finally:
+        infile.close()
+
+def _fromJson(value):
+    '''
+    JSON turns strings into unicode and dict keys into strings: undo that
+    '''
+    if isinstance(value, unicode):
+        try:
+            return value.encode('latin-1')
+        except UnicodeEncodeError:
+            return value
+    if isinstance(value, list):
+        return [_fromJson(item) for item in value]
+    if isinstance(value, dict):
+        out = {}
+        for key, item in value.items():
+            key = _fromJson(key)
+            if key.lstrip('-').isdigit():
+                key = int(key)
+            out[key] = _fromJson(item)
+        return out
+    return value
+
+def _defaultMailbox(cmd, capture):
+    if capture:
+        return CanCapture()
+    return collections.deque()
+
+class SavedSession:
+    '''
+    What a session file holds as of the last save (or load), so the next
+    saveSession() to the same file only appends what's new:
+        filename    - the session file
+        stat        - (inode, size) of the file after the save
+        toc         - (position, length) of the latest table of contents
+        captures    - { cmd : (capture, messages saved) }
+        info        - { key : (JSON saved, list length or None) }
+        compress    - whether the file's blocks are compressed
+    '''
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        self.stat = None
+        self.toc = None
+        self.compress = False
+        self.captures = {}
+        self.info = {}
+
+    def __repr__(self):
+        return "<SavedSession: %s, %s>" % (self.filename, 
+                ', '.join(['%d messages' % count for capture, count in self.captures.values()]))
+
+    def update(self, filename):
+        st = os.stat(filename)
+        self.stat = (st.st_ino, st.st_size)
+
+    def isCurrent(self, filename):
+        '''
+        is the file still as we left it?
+        '''
+        if os.path.abspath(filename) != self.filename or not os.path.exists(filename):
+            return False
+        st = os.stat(filename)
+        return self.stat == (st.st_ino, st.st_size)
+
+    def captureStart(self, cmd, capture):
+        '''
+        where to carry on saving capture from: the number of messages 
+        already saved, or None if it isn't the capture that was saved
+        '''
+        saved = self.captures.get(cmd)
+        if saved == None or saved[0] is not capture or capture._popped or len(capture) < saved[1]:
+            return None
+        return saved[1]
+
+def _jsonInfo(value):
+    return json.dumps(value, encoding='latin-1')
+
+def _infoDelta(me, saved):
+    '''
+    returns the session info (everything but the messages) that changed
+    since the last save: { 'set' : { key : value }, 'append' : { key : 
+    items added to a list } }, and records it in saved
+    '''
+    delta = { 'set' : {}, 'append' : {} }
+    for key, value in me.items():
+        if key == 'messages':
+            continue
+
+        text = _jsonInfo(value)
+        length = None
+        if isinstance(value, list):
+            length = len(value)
+
+        last = saved.info.get(key)
+        if last != None and last[0] == text:
+            continue
+
+        if last != None and length != None and last[1] != None and last[1] <= length and \
+                _jsonInfo(value[:last[1]]) == last[0]:
+            delta['append'][key] = value[last[1]:]
+        else:
+            delta['set'][key] = value
+        saved.info[key] = (text, length)
+    return delta
+
+def _packBlock(block, compress):
+    '''
+    returns (toc entry without the position, block sections) for a block
+    from CanCapture.genSessionBlocks()
+    '''
+    start, count, first_ts, last_ts, max_ts, ordered, payload_base, columns, index, stats = block
+    index = packIndex(index)
+    sizes = [len(column) for column in columns] + [len(index)]
+    packed = None
+    if compress:
+        columns = [zlib.compress(''.join(columns), COMPRESS_LEVEL)]
+        index = zlib.compress(index, COMPRESS_LEVEL)
+        packed = [len(columns[0]), len(index)]
+    stats = packStats(stats)
+    sizes.append(len(stats))
+
+    return [start, count, first_ts, last_ts, payload_base, sizes, packed, max_ts, ordered], columns + [index, stats]
+
+def _writeBlock(outfile, cmd, toc, packed_block):
+    entry, sections = packed_block
+    start, count, first_ts, last_ts, payload_base, sizes, packed, max_ts, ordered = entry
+    toc['blocks'].append([cmd, start, count, first_ts, last_ts, payload_base,
+            outfile.tell(), sizes, packed, max_ts, ordered])
+    for section in sections:
+        outfile.write(section)
+
+def _writeCapture(outfile, cmd, capture, start, stop, toc, pool=None, workers=1):
+    '''
+    write capture's blocks for messages start up to (not including) stop.
+    with a pool (of workers threads), they're compressed a few blocks at a
+    time and written in order
+    '''
+    if pool == None:
+        for block in capture.genSessionBlocks(start, stop):
+            _writeBlock(outfile, cmd, toc, _packBlock(block, False))
+        return
+
+    pending = collections.deque()
+    for block in capture.genSessionBlocks(start, stop):
+        pending.append(pool.apply_async(_packBlock, (block, True)))
+        if len(pending) >= COMPRESS_BACKLOG * workers:
+            _writeBlock(outfile, cmd, toc, pending.popleft().get())
+    while pending:
+        _writeBlock(outfile, cmd, toc, pending.popleft().get())
+
+def _writeMailbox(outfile, cmd, mbox, toc):
+    pos = outfile.tell()
+    records = []
+    for ts, msg in list(mbox):
+        records.append(struct.pack(MBOX_REC, ts, len(msg)))
+        records.append(msg)
+    outfile.write(''.join(records))
+    toc['mailboxes'].append([cmd, pos, outfile.tell() - pos])
+
+def _writeSave(outfile, me, saved, starts, pool=None, workers=1):
+    '''
+    write the sections for a save (everything from captures message 
+    starts[cmd] on) and the table of contents after them, and point the 
+    header at it.  saved (a SavedSession) is brought up to date.  blocks
+    are compressed by pool's workers if there is one.
+    '''
+    toc = { 'byteorder' : sys.byteorder,
+            'offset_size' : array('L').itemsize,
+            'prev' : saved.toc,
+            'captures' : [],
+            'blocks' : [],
+            'mailboxes' : [],
+            }
+
+    captures = {}
+    for cmd, mbox in me.get('messages', {}).items():
+        if isinstance(mbox, CanCapture):
+            # messages arriving during the save are left for the next one
+            count = len(mbox)
+            toc['captures'].append(cmd)
+            _writeCapture(outfile, cmd, mbox, starts.get(cmd, 0), count, toc, pool, workers)
+            captures[cmd] = (mbox, count)
+        else:
+            # mailboxes get read from, so they're saved whole every time
+            _writeMailbox(outfile, cmd, mbox, toc)
+
+    pos = outfile.tell()
+    outfile.write(_jsonInfo(_infoDelta(me, saved)))
+    toc['info'] = [pos, outfile.tell() - pos]
+
+    toc_pos = outfile.tell()
+    toc = json.dumps(toc)
+    outfile.write(toc)
+
+    # everything's on disk before the header points at it
+    outfile.flush()
+    os.fsync(outfile.fileno())
+    outfile.seek(0)
+    outfile.write(struct.pack(HEADER, SESSION_MAGIC, SESSION_VERSION, toc_pos, len(toc)))
+
+    saved.toc = (toc_pos, len(toc))
+    saved.captures = captures
+
+def saveSession(filename, me, saved=None, compress=False, workers=None):
+    '''
+    write a session dict (from CanInterface.saveSession()) to filename,
+    returning a SavedSession describing what's in it.
+
+    compress=True compresses each block of messages separately, on a 
+    pool of worker threads (one per CPU unless workers says otherwise).
+
+    pass the SavedSession from the last save (or readSession()) of the 
+    same file as saved, and only what's been added since gets written: 
+    the frames, bookmarks and comments appended to the file along with a 
+    table of contents that links back to the one before, then the header
+    is pointed at it.  Until then the file is as it was, so a save that 
+    doesn't finish loses nothing.
+
+    otherwise (or to change whether the file is compressed) the whole 
+    session is written to a temporary file and renamed over filename, so
+    a session still mapped from filename carries on working.
+    '''
+    pool = None
+    if compress:
+        workers = workers or multiprocessing.cpu_count()
+        pool = ThreadPool(workers)
+    try:
+        return _saveSession(filename, me, saved, compress, pool, workers)
+    finally:
+        if pool != None:
+            pool.close()
+            pool.join()
+
+def _saveSession(filename, me, saved, compress, pool, workers):
+    if saved != None and saved.compress == compress and saved.isCurrent(filename):
+        starts = {}
+        for cmd, mbox in me.get('messages', {}).items():
+            if isinstance(mbox, CanCapture):
+                starts[cmd] = saved.captureStart(cmd, mbox)
+        # anything saved has to still be there, unchanged
+        for cmd in saved.captures:
+            if cmd not in starts:
+                starts[cmd] = None
+
+        if None not in starts.values():
+            outfile = open(filename, 'r+b')
+            try:
+                outfile.seek(0, 2)
+                _writeSave(outfile, me, saved, starts, pool, workers)
+            finally:
+                outfile.close()
+            saved.update(filename)
+            return saved
+
+    saved = SavedSession(filename)
+    saved.compress = compress
+    tmpname = filename + '.tmp'
+    outfile = open(tmpname, 'wb')
+    try:
+        outfile.write(struct.pack(HEADER, SESSION_MAGIC, SESSION_VERSION, 0, 0))
+        _writeSave(outfile, me, saved, {}, pool, workers)
+    finally:
+        outfile.close()
+
+    if os.name == 'nt' and os.path.exists(filename):
+        # no renaming over files on Windows
+        os.remove(filename)
+    os.rename(tmpname, filename)
+    saved.update(filename)
+    return saved
+
+def _appendBlock(capture, source, spilled, swap):
+    '''
+    copy a block into capture message by message, for files written on a
+    platform with another byte order or offset size than this one
+    '''
+    columns = spilled.unpack(source[spilled.pos:spilled.pos + spilled.size()])
+    payload = columns[4]
+    for num, typecode in enumerate(COLUMN_TYPES[:3]):
+        columns[num] = array(typecode, columns[num])
+        if swap:
+            columns[num].byteswap()
+    timestamps, arbids, lengths = columns[:3]
+    offset = 0
+    for ts, arbid, length in zip(timestamps, arbids, lengths):
+        capture.appendFrame(ts, arbid, payload[offset:offset + length])
+        offset += length
+
+def readSession(filename, newMailbox=None):
+    '''
+    returns (session dict, SavedSession) for filename: the session dict 
+    like CanInterface.saveSession() returns, and what to pass saveSession()
+    to carry on saving to the file.  newMailbox(cmd) creates each mailbox 
+    (a CanCapture for captures, otherwise a deque, by default); captures 
+    are backed by the mmap'd file.
+    '''
+    infile = open(filename, 'rb')
+    try:
+        source = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        infile.close()
+
+    magic, version, toc_pos, toc_len = struct.unpack_from(HEADER, source, 0)
+    if magic != SESSION_MAGIC:
+        raise Exception("%s isn't a CanCat session file" % filename)
+    if version > SESSION_VERSION:
+        raise Exception("%s is a version %d session file, this CanCat only reads up to version %d" %
+                (filename, version, SESSION_VERSION))
+
+    saved = SavedSession(filename)
+
+    # each save's table of contents links back to the one before
+    tocs = []
+    latest = (toc_pos, toc_len)
+    while latest != None:
+        pos, size = latest
+        toc = json.loads(source[pos:pos + size])
+        tocs.insert(0, toc)
+        latest = toc.get('prev')
+
+    # each save records how its blocks were written.  they're only mapped
+    # as they are if every save was native, otherwise they're copied in
+    native = True
+    for toc in tocs:
+        if toc['byteorder'] != sys.byteorder or toc['offset_size'] != array('L').itemsize:
+            native = False
+
+    blocks = {}
+    swaps = {}
+    stats = {}
+    mailboxes = {}
+    info = {}
+    for toc in tocs:
+        swap = toc['byteorder'] != sys.byteorder
+        for cmd in toc['captures']:
+            if cmd not in blocks:
+                blocks[cmd] = []
+                swaps[cmd] = []
+                stats[cmd] = []
+
+        for entry in toc['blocks']:
+            cmd, start, count, first_ts, last_ts, payload_base, pos, sizes = entry[:8]
+            packed = None
+            if len(entry) > 8:
+                packed = entry[8]
+            # older saves kept timestamps in order (see CanCapture)
+            max_ts, ordered = last_ts, True
+            if len(entry) > 9:
+                max_ts, ordered = entry[9:11]
+            if packed == None:
+                packed = [sum(sizes[:5]), sizes[5]]
+                spilled = SpilledBlock(start, count, first_ts, last_ts, payload_base, pos, sizes[:5], source,
+                        max_ts=max_ts, ordered=ordered)
+            else:
+                spilled = SpilledBlock(start, count, first_ts, last_ts, payload_base, pos, sizes[:5], source, 
+                        packed[0], max_ts, ordered)
+            blocks[cmd].append(spilled)
+            swaps[cmd].append(swap)
+            saved.compress = len(entry) > 8 and entry[8] != None
+            if not native:
+                continue
+
+            pos += packed[0]
+            if spilled.packed_size != None:
+                counts = indexCounts(zlib.decompress(source[pos:pos + packed[1]]))
+            else:
+                counts = indexCounts(source, pos)
+            spilled.setIndex(pos, packed[1], counts, spilled.packed_size != None)
+
+            chunk = start / STATS_CHUNK
+            chunks = stats[cmd]
+            if chunk == len(chunks):
+                chunks.append(None)
+            # a block written part way into a chunk has the whole chunk's stats
+            chunks[chunk] = SpilledStats(pos + packed[1], sizes[6], source)
+
+        # mailboxes are saved whole
+        for cmd, pos, size in toc['mailboxes']:
+            mailboxes[cmd] = (pos, size)
+
+        pos, size = toc['info']
+        delta = _fromJson(json.loads(source[pos:pos + size]))
+        info.update(delta['set'])
+        for key, items in delta['append'].items():
+            info[key].extend(items)
+
+    saved.update(filename)
+    saved.toc = (toc_pos, toc_len)
+    for key, value in info.items():
+        length = None
+        if isinstance(value, list):
+            length = len(value)
+        saved.info[key] = (_jsonInfo(value), length)
+
+    messages = {}
+    for cmd in blocks:
+        if newMailbox == None:
+            capture = _defaultMailbox(cmd, True)
+        else:
+            capture = newMailbox(cmd)
+
+        if native:
+            capture.attach(source, blocks[cmd], stats[cmd])
+            saved.captures[cmd] = (capture, len(capture))
+        else:
+            for spilled, swap in zip(blocks[cmd], swaps[cmd]):
+                _appendBlock(capture, source, spilled, swap)
+            # nothing counts as saved, so the next save rewrites the whole
+            # file natively instead of appending native blocks to foreign ones
+        messages[cmd] = capture
+
+    for cmd, (pos, size) in mailboxes.items():
+        if newMailbox == None:
+            mbox = _defaultMailbox(cmd, False)
+        else:
+            mbox = newMailbox(cmd)
+
+        end = pos + size
+        while pos < end:
+            ts, length = struct.unpack_from(MBOX_REC, source, pos)
+            pos += MBOX_REC_LEN
+            mbox.append((ts, source[pos:pos + length]))
+            pos += length
+        messages[cmd] = mbox
+
+    info['messages'] = messages
+    return info, saved
+
+def loadSession(filename, newMailbox=None):
+    '''
+    returns the session dict saved in filename (see readSession())
+    '''
+    return readSession(filename, newMailbox)[0]
@@ -0,0 +1,248 @@
+'''
+Per-arbid timing statistics, kept up to date as messages arrive.
+
+ArbidStats tracks one arbid's message count, first/last timestamps and
+the gaps between its messages: mean and variance, min/max and a
+GapSketch for percentiles.  Stats for consecutive stretches of a capture
+merge into the stats for the whole stretch, exactly for everything but
+the percentiles, which stay within the sketch's accuracy.
+
+ArbidStats.add() runs for every message received, so it's kept flat.
+'''
+import math
+import struct
+
+# relative accuracy of GapSketch percentiles (1%)
+SKETCH_ACCURACY = .01
+# gaps shorter than this (a microsecond) all count as zero
+SKETCH_MIN_GAP = 1e-6
+
+# packStats() layout: arbid, count, first/last timestamp, gap sum of
+# squares/min/max, sketch zeros and bucket count, then (key, count) buckets
+STATS_HDR = '<IIdddddII'
+STATS_HDR_LEN = struct.calcsize(STATS_HDR)
+
+# messages per chunk of per-arbid stats kept by a CanCapture
+STATS_CHUNK = 65536
+
+# rough memory used by an ArbidStats, and by each GapSketch bucket (dict
+# slot and int objects), for statsMemory()
+ARBID_STATS_MEMORY = 1024
+SKETCH_BUCKET_MEMORY = 160
+
+_gamma = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+_inv_log_gamma = 1 / math.log(_gamma)
+_log = math.log
+# bucket keys are offset to stay positive (for any gap over SKETCH_MIN_GAP)
+# so int() rounds them down
+_key_offset = 2048
+
+
+class GapSketch:
+    '''
+    Mergeable quantile sketch (log-bucketed histogram, like DDSketch).
+    Every value lands in a bucket no wider than +/- SKETCH_ACCURACY of
+    itself, so any percentile is within SKETCH_ACCURACY of the real one,
+    while the sketch stays at a few hundred buckets at most.
+    '''
+    def __init__(self):
+        self.buckets = {}
+        self.zeros = 0
+
+    def add(self, value):
+        if value < SKETCH_MIN_GAP:
+            self.zeros += 1
+        else:
+            key = int(_log(value) * _inv_log_gamma + _key_offset)
+            self.buckets[key] = self.buckets.get(key, 0) + 1
+
+    def merge(self, other):
+        buckets = self.buckets
+        for key, count in other.buckets.iteritems():
+            buckets[key] = buckets.get(key, 0) + count
+        self.zeros += other.zeros
+
+    def copy(self):
+        sketch = GapSketch()
+        # dict() copies the buckets in one go, so copying a sketch another
+        # thread is adding to can't fail part way
+        sketch.buckets = dict(self.buckets)
+        sketch.zeros = self.zeros
+        return sketch
+
+    def count(self):
+        return self.zeros + sum(self.buckets.itervalues())
+
+    def quantile(self, q):
+        '''
+        returns the estimated q quantile (0 <= q <= 1), or None if empty
+        '''
+        count = self.count()
+        if not count:
+            return None
+
+        rank = q * (count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+
+        keys = sorted(self.buckets)
+        for key in keys:
+            seen += self.buckets[key]
+            if rank < seen:
+                break
+
+        # middle of the bucket [gamma**k, gamma**(k+1))
+        return 2 * _gamma ** (key - _key_offset + 1) / (_gamma + 1)
+
+
+class ArbidStats:
+    '''
+    Message count, first/last timestamps and inter-arrival gap statistics
+    for one arbid.  There are always count-1 gaps, adding up to
+    last_ts - first_ts.
+    '''
+    def __init__(self):
+        self.count = 0
+        self.first_ts = None
+        self.last_ts = None
+
+        self.gap_sumsq = 0.0
+        self.gap_min = float('inf')
+        self.gap_max = 0.0
+        self.sketch = GapSketch()
+
+    def __repr__(self):
+        return "<ArbidStats: count %d, mean gap %.6f, p50 %s, p99 %s>" % \
+                (self.count, self.mean(), self.quantile(.5), self.quantile(.99))
+
+    def add(self, ts):
+        self.count += 1
+        last = self.last_ts
+        self.last_ts = ts
+        if last == None:
+            self.first_ts = ts
+            return
+
+        gap = ts - last
+        self.gap_sumsq += gap * gap
+        if gap < self.gap_min:
+            self.gap_min = gap
+        if gap > self.gap_max:
+            self.gap_max = gap
+
+        if gap < SKETCH_MIN_GAP:
+            self.sketch.zeros += 1
+        else:
+            key = int(_log(gap) * _inv_log_gamma + _key_offset)
+            buckets = self.sketch.buckets
+            buckets[key] = buckets.get(key, 0) + 1
+
+    def merge(self, other):
+        '''
+        fold in the stats of the *following* stretch of messages.
+        the gap between the two stretches counts as well
+        '''
+        if not other.count:
+            return
+        if not self.count:
+            self.__dict__.update(other.copy().__dict__)
+            return
+
+        gap = other.first_ts - self.last_ts
+        self.gap_sumsq += gap * gap + other.gap_sumsq
+        self.gap_min = min(self.gap_min, gap, other.gap_min)
+        self.gap_max = max(self.gap_max, gap, other.gap_max)
+        self.sketch.add(gap)
+        self.sketch.merge(other.sketch)
+
+        self.count += other.count
+        self.last_ts = other.last_ts
+
+    def copy(self):
+        stats = ArbidStats()
+        stats.__dict__.update(self.__dict__)
+        stats.sketch = self.sketch.copy()
+        return stats
+
+    def gaps(self):
+        return max(self.count - 1, 0)
+
+    def mean(self):
+        if self.count < 2:
+            return 0.0
+        return (self.last_ts - self.first_ts) / (self.count - 1)
+
+    def variance(self):
+        gaps = self.count - 1
+        if gaps < 2:
+            return 0.0
+        mean = self.mean()
+        return max(self.gap_sumsq - gaps * mean * mean, 0.0) / (gaps - 1)
+
+    def stddev(self):
+        return math.sqrt(self.variance())
+
+    def quantile(self, q):
+        '''
+        estimated q quantile of the gaps (clamped to the real min/max)
+        '''
+        value = self.sketch.quantile(q)
+        if value == None:
+            return None
+        return min(max(value, self.gap_min), self.gap_max)
+
+
+def mergeStats(first, second):
+    '''
+    merge two { arbid : ArbidStats } dicts, second following first.
+    first is updated and returned
+    '''
+    for arbid, stats in second.iteritems():
+        mine = first.get(arbid)
+        if mine == None:
+            first[arbid] = stats.copy()
+        else:
+            mine.merge(stats)
+    return first
+
+def statsMemory(stats):
+    '''
+    roughly how many bytes of memory a { arbid : ArbidStats } dict uses
+    '''
+    return sum([ARBID_STATS_MEMORY + SKETCH_BUCKET_MEMORY * len(arbstats.sketch.buckets)
+            for arbstats in stats.itervalues()])
+
+def packStats(stats):
+    '''
+    pack a { arbid : ArbidStats } dict into a string (see unpackStats())
+    '''
+    parts = [struct.pack('<I', len(stats))]
+    for arbid, arbstats in sorted(stats.items()):
+        buckets = sorted(arbstats.sketch.buckets.items())
+        parts.append(struct.pack(STATS_HDR, arbid, arbstats.count, arbstats.first_ts, 
+                arbstats.last_ts, arbstats.gap_sumsq, arbstats.gap_min, arbstats.gap_max, 
+                arbstats.sketch.zeros, len(buckets)))
+        parts.append(struct.pack('<%di' % (2 * len(buckets)), *[item for bucket in buckets for item in bucket]))
+    return ''.join(parts)
+
+def unpackStats(data, offset=0):
+    '''
+    returns the { arbid : ArbidStats } dict packStats() packed into data
+    (starting at offset)
+    '''
+    stats = {}
+    count, = struct.unpack_from('<I', data, offset)
+    offset += 4
+    for x in xrange(count):
+        arbstats = ArbidStats()
+        (arbid, arbstats.count, arbstats.first_ts, arbstats.last_ts, arbstats.gap_sumsq,
+                arbstats.gap_min, arbstats.gap_max, arbstats.sketch.zeros, 
+                nbuckets) = struct.unpack_from(STATS_HDR, data, offset)
+        offset += STATS_HDR_LEN
+
+        items = struct.unpack_from('<%di' % (2 * nbuckets), data, offset)
+        offset += 8 * nbuckets
+        arbstats.sketch.buckets = dict(zip(items[::2], items[1::2]))
+        stats[arbid] = arbstats
+    return stats
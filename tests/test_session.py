@@ -0,0 +1,209 @@
+'''
+Session file round trips (see cancat/session.py).  Run from the top of
+the tree with:
+    python -m unittest discover tests
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import struct
+import tempfile
+import unittest
+import threading
+import collections
+from array import array
+
+from cancat import session
+from cancat.capture import CanCapture
+from cancat.stats import STATS_CHUNK
+
+CMD_CAN_RECV = 0x30
+CMD_LOG = 0x2f
+
+ARBIDS = [0x100, 0x123, 0x7e8, 0x7ff, 0x18fef100]
+
+
+def genFrames(count, seed, ts=1000.0):
+    '''
+    yields count (timestamp, arbid, data) frames, with a step back in time
+    now and then
+    '''
+    rand = random.Random(seed)
+    for num in xrange(count):
+        ts += rand.uniform(.00001, .001)
+        if not rand.randrange(50000):
+            ts -= rand.uniform(0, 2)
+        data = ''.join([chr(rand.randrange(256)) for x in range(rand.randrange(9))])
+        yield ts, rand.choice(ARBIDS), data
+
+def newSession(capture):
+    mbox = collections.deque([(1.0, 'log line'), (2.0, 'another')])
+    return { 'messages' : { CMD_CAN_RECV : capture, CMD_LOG : mbox },
+            'bookmarks' : [10, 70000],
+            'bookmark_info' : { 0 : { 'name' : 'start', 'comment' : None } },
+            'comments' : ['first'],
+            }
+
+def readToc(filename):
+    data = open(filename, 'rb').read()
+    magic, version, pos, size = struct.unpack_from(session.HEADER, data, 0)
+    return json.loads(data[pos:pos + size])
+
+
+class SessionRoundTrip(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='cancat_test_')
+        self.filename = os.path.join(self.tmpdir, 'test.sess')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assertSameCapture(self, loaded, capture, count=None):
+        '''
+        loaded holds the first count messages of capture, and answers the
+        same for them
+        '''
+        if count == None:
+            count = len(capture)
+        stop = count - 1
+        self.assertEqual(len(loaded), count)
+        self.assertEqual(list(loaded.genCanMsgs()), list(capture.genCanMsgs(0, stop)))
+        self.assertEqual(loaded.getArbidCounts(), capture.getArbidCounts(0, stop))
+        for arbid in ARBIDS:
+            self.assertEqual(loaded.getArbidIndexes(arbid), capture.getArbidIndexes(arbid, 0, stop))
+
+        stats = capture.getArbidStats(0, stop)
+        for arbid, arbstats in loaded.getArbidStats().items():
+            self.assertEqual((arbstats.count, arbstats.first_ts, arbstats.last_ts, arbstats.sketch.count()),
+                    (stats[arbid].count, stats[arbid].first_ts, stats[arbid].last_ts, stats[arbid].sketch.count()))
+
+        for ts in [capture.getFrame(idx)[0] for idx in range(0, count, max(count / 50, 1))]:
+            self.assertEqual(loaded.getIndexAtTime(ts), min(capture.getIndexAtTime(ts), count))
+
+    def assertSameInfo(self, loaded, me):
+        for key in ('bookmarks', 'bookmark_info', 'comments'):
+            self.assertEqual(loaded[key], me[key])
+        self.assertEqual(list(loaded['messages'][CMD_LOG]), list(me['messages'][CMD_LOG]))
+
+    def saveAndDelta(self, compress):
+        capture = CanCapture()
+        capture.extendFrames(genFrames(STATS_CHUNK + 1000, 1))
+        me = newSession(capture)
+        saved = session.saveSession(self.filename, me, compress=compress)
+
+        # carry on part way into a chunk, then save just what's new
+        capture.extendFrames(genFrames(STATS_CHUNK * 2, 2, capture.getFrame(-1)[0]))
+        me['bookmarks'].append(len(capture) - 1)
+        me['comments'].append('second')
+        size = os.path.getsize(self.filename)
+        saved = session.saveSession(self.filename, me, saved, compress=compress)
+
+        toc = readToc(self.filename)
+        self.assertNotEqual(toc['prev'], None)
+        self.assertTrue(os.path.getsize(self.filename) > size)
+
+        loaded, saved = session.readSession(self.filename)
+        self.assertSameCapture(loaded['messages'][CMD_CAN_RECV], capture)
+        self.assertSameInfo(loaded, me)
+        return loaded, saved
+
+    def test_fullThenDelta(self):
+        self.saveAndDelta(False)
+
+    def test_compressed(self):
+        self.saveAndDelta(True)
+
+    def test_deltaAfterReload(self):
+        for compress in (False, True):
+            loaded, saved = self.saveAndDelta(compress)
+            capture = loaded['messages'][CMD_CAN_RECV]
+            count = len(capture)
+            capture.extendFrames(genFrames(5000, 3, capture.getFrame(-1)[0]))
+            loaded['comments'].append('after reload')
+            session.saveSession(self.filename, loaded, saved, compress=compress)
+
+            # only the new messages were written
+            toc = readToc(self.filename)
+            self.assertEqual([entry[1] for entry in toc['blocks']], [count])
+
+            reloaded = session.loadSession(self.filename)
+            self.assertSameCapture(reloaded['messages'][CMD_CAN_RECV], capture)
+            self.assertSameInfo(reloaded, loaded)
+
+    def writeForeign(self):
+        '''
+        rewrite self.filename as if it was saved with the other byte order
+        '''
+        data = bytearray(open(self.filename, 'rb').read())
+        magic, version, pos, size = struct.unpack_from(session.HEADER, str(data), 0)
+        toc = json.loads(str(data[pos:pos + size]))
+        self.assertEqual(toc['prev'], None)
+
+        for entry in toc['blocks']:
+            pos, sizes = entry[6], entry[7]
+            for typecode, size in zip(session.COLUMN_TYPES, sizes):
+                column = array(typecode, str(data[pos:pos + size]))
+                column.byteswap()
+                data[pos:pos + size] = column.tostring()
+                pos += size
+
+        toc['byteorder'] = (sys.byteorder == 'little') and 'big' or 'little'
+        toc = json.dumps(toc)
+        data[:session.HEADER_LEN] = struct.pack(session.HEADER, magic, version, len(data), len(toc))
+        data.extend(toc)
+        open(self.filename, 'wb').write(data)
+
+    def test_foreignByteOrder(self):
+        capture = CanCapture()
+        capture.extendFrames(genFrames(STATS_CHUNK + 1000, 4))
+        me = newSession(capture)
+        session.saveSession(self.filename, me)
+        self.writeForeign()
+
+        loaded, saved = session.readSession(self.filename)
+        self.assertSameCapture(loaded['messages'][CMD_CAN_RECV], capture)
+        self.assertEqual(saved.captures, {})
+
+        # the next save rewrites the whole file natively
+        loaded['messages'][CMD_CAN_RECV].appendFrame(capture.getFrame(-1)[0], 0x123, 'new')
+        capture.appendFrame(capture.getFrame(-1)[0], 0x123, 'new')
+        session.saveSession(self.filename, loaded, saved)
+        toc = readToc(self.filename)
+        self.assertEqual((toc['prev'], toc['byteorder']), (None, sys.byteorder))
+
+        reloaded = session.loadSession(self.filename)
+        self.assertSameCapture(reloaded['messages'][CMD_CAN_RECV], capture)
+
+    def test_appendsDuringSave(self):
+        for compress in (False, True):
+            capture = CanCapture()
+            me = newSession(capture)
+            running = [True]
+            def receive():
+                for frame in genFrames(STATS_CHUNK * 8, 5):
+                    if not running[0]:
+                        break
+                    capture.appendFrame(*frame)
+
+            thread = threading.Thread(target=receive)
+            thread.start()
+            saved = None
+            try:
+                stop = time.time() + 1.5
+                while time.time() < stop:
+                    saved = session.saveSession(self.filename, me, saved, compress=compress)
+            finally:
+                running[0] = False
+                thread.join()
+
+            loaded = session.loadSession(self.filename)['messages'][CMD_CAN_RECV]
+            self.assertTrue(len(loaded))
+            self.assertSameCapture(loaded, capture, len(loaded))
+            os.unlink(self.filename)
+
+
+if __name__ == '__main__':
+    unittest.main()